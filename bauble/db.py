@@ -25,6 +25,7 @@ logger = logging.getLogger(__name__)
 from sqlalchemy.orm import class_mapper
 
 import datetime
+import itertools
 import os
 import bauble.error as error
 from bauble.i18n import _
@@ -75,16 +76,269 @@ def natsort(attr, obj):
     step should return a single database object until the last step
     where the result should be a list of objects.
 
+    if the last step is a relation to a :class:`NaturallySorted` class
+    which is not loaded yet then the database does the sorting.
+
     e.g.:
     from functools import partial
     partial(natsort, 'accessions')(species)
     partial(natsort, 'species.accessions')(vern_name)
     """
-    from bauble import utils
     jumps = attr.split('.')
-    for attr in jumps:
+    for attr in jumps[:-1]:
         obj = getattr(obj, attr)
-    return sorted(obj, key=utils.natsort_key)
+    attr = jumps[-1]
+    prop = getattr(getattr(type(obj), attr, None), 'property', None)
+    session = orm.object_session(obj)
+    if isinstance(prop, orm.properties.RelationshipProperty) and \
+            issubclass(prop.mapper.class_, NaturallySorted) and \
+            attr not in obj.__dict__ and session is not None and \
+            obj not in session.new:
+        cls = prop.mapper.class_
+        return session.query(cls).with_parent(obj, attr).\
+            order_by(cls._sort_key, cls.id).all()
+    return sorted(getattr(obj, attr), key=sort_key)
+
+
+def count_related(session, cls, name, ids, chunk_size=500):
+    """
+    Return a dict of id to the number of objects related through the
+    relation name to the object of cls with that id, with one GROUP BY
+    query per chunk of ids.  The ids without related objects are left
+    out.
+
+    Return None if name isn't a one to many relation on a foreign key to
+    the id of cls, the only ones that can be counted this way.
+    """
+    prop = getattr(getattr(cls, name, None), 'property', None)
+    if not isinstance(prop, orm.properties.RelationshipProperty) or \
+            prop.direction is not orm.interfaces.ONETOMANY or \
+            len(prop.local_remote_pairs) != 1:
+        return None
+    local, remote = prop.local_remote_pairs[0]
+    if local.table is not cls.__table__ or local.key != 'id':
+        return None
+    counts = {}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        counts.update(session.query(remote, sa.func.count(remote)).
+                      filter(remote.in_(chunk)).group_by(remote))
+    return counts
+
+
+def sort_key(obj):
+    """
+    A key getter for sort and sorted, the _sort_key of a
+    :class:`NaturallySorted` object, utils.natsort_key(obj) otherwise.
+    """
+    if isinstance(obj, NaturallySorted):
+        return obj._sort_key or obj.get_sort_key()
+    return utils.natsort_key(obj)
+
+
+_change_counter = itertools.count(1)
+_database_generation = 0
+_table_generations = {}
+
+
+def table_changed(table_name):
+    """
+    Record that the content of table_name has changed.
+
+    This is called by the :class:`HistoryExtension` for every insert,
+    update and delete made through the ORM, and should be called by any
+    code that writes to a table bypassing the mappers, like the importers.
+
+    :param table_name: the name of the changed table
+    """
+    _table_generations[table_name] = _change_counter.next()
+
+
+def database_changed():
+    """
+    Record that the whole database might have changed, e.g. because a
+    different database was opened or the tables were recreated.
+    """
+    global _database_generation
+    _database_generation = _change_counter.next()
+
+
+def get_generations():
+    """
+    Return a snapshot of the change counters, to be compared with a later
+    snapshot by :func:`unchanged_since`.
+    """
+    return _database_generation, dict(_table_generations)
+
+
+def unchanged_since(snapshot, table_names=None):
+    """
+    Return True if none of the tables in table_names changed since the
+    snapshot was taken with :func:`get_generations`.
+
+    :param snapshot: a value returned by :func:`get_generations`
+    :param table_names: the names of the tables to check, if None then
+      any change in the database counts.
+    """
+    database_generation, tables = snapshot
+    if database_generation != _database_generation:
+        return False
+    if table_names is None:
+        return tables == _table_generations
+    for name in table_names:
+        if tables.get(name) != _table_generations.get(name):
+            return False
+    return True
+
+
+def get_history_id():
+    """
+    Return the id of the last row of the history table, to be compared
+    later by :func:`history_unchanged_since`.
+
+    Unlike the counters of :func:`get_generations`, which only count the
+    changes made by this process, the history table is shared by all the
+    clients of the database.
+    """
+    if engine is None:
+        return 0
+    return engine.execute(
+        sa.select([sa.func.max(History.__table__.c.id)])).scalar() or 0
+
+
+def history_unchanged_since(history_id, table_names=None):
+    """
+    Return True if no change to the tables in table_names was recorded
+    in the history table after the row history_id, by any client.
+
+    The changes that bypass the mappers, like the imports, are not
+    recorded in the history table.
+
+    :param history_id: a value returned by :func:`get_history_id`
+    :param table_names: the names of the tables to check, if None then
+      any change in the database counts.
+    """
+    if engine is None:
+        return True
+    history = History.__table__
+    where = history.c.id > history_id
+    if table_names is not None:
+        if not table_names:
+            return True
+        where = sa.and_(where, history.c.table_name.in_(list(table_names)))
+    return engine.execute(
+        sa.select([history.c.id], where).limit(1)).first() is None
+
+
+_derived_tables = {}  # table name -> (refresh callable, source table names)
+
+
+def register_derived_table(table_name, refresh, sources):
+    """
+    Register a table whose content is computed from other tables, like
+    the closure of the geography tree.
+
+    :param table_name: the name of the derived table
+    :param refresh: a callable creating the table if it doesn't exist
+      and computing its content again if the sources changed, it should
+      be cheap when they didn't
+    :param sources: the names of the tables the content is computed from
+    """
+    _derived_tables[table_name] = refresh, set(sources)
+
+
+def refresh_derived_tables(table_names):
+    """
+    Refresh the derived tables in table_names and the ones computed from
+    a table in table_names, see :func:`register_derived_table`.
+
+    This is called by the searches before they use the tables and by the
+    importers after they loaded them.
+    """
+    table_names = set(table_names)
+    for name, (refresh, sources) in sorted(_derived_tables.items()):
+        if name in table_names or sources.intersection(table_names):
+            refresh()
+
+
+def get_cancel_handle(connection):
+    """
+    Return a handle that :func:`cancel_statement` can use, from another
+    thread, to cancel the statement running on connection, or None if
+    the database doesn't support cancelling statements.
+
+    :param connection: a :class:`sqlalchemy.engine.base.Connection`
+    """
+    name = connection.engine.name
+    if name == 'postgresql':
+        pid = connection.execute('SELECT pg_backend_pid()').scalar()
+        return name, pid
+    if name == 'sqlite':
+        # the DB-API connection, sqlite3 allows interrupting it from
+        # any thread
+        return name, connection.connection.connection
+    return None
+
+
+def cancel_statement(handle):
+    """
+    Cancel the statement running on the connection of handle, a value
+    returned by :func:`get_cancel_handle`.  The cancelled statement
+    raises an error in the thread that executed it.
+    """
+    if handle is None:
+        return
+    name, value = handle
+    if name == 'postgresql':
+        connection = engine.connect()
+        try:
+            connection.execute(sa.text('SELECT pg_cancel_backend(:pid)'),
+                               pid=value)
+        finally:
+            connection.close()
+    elif name == 'sqlite':
+        value.interrupt()
+
+
+def get_query_plan(connection, statement):
+    """
+    Return the query plan of statement as a list of lines, or None if the
+    database can't explain statements.
+
+    On PostgreSQL the statement is run by EXPLAIN ANALYZE, so the plan
+    includes the actual row counts and timings.  SQLite only has EXPLAIN
+    QUERY PLAN.
+
+    :param connection: a :class:`sqlalchemy.engine.base.Connection`
+    :param statement: a select
+    """
+    name = connection.engine.name
+    if name == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '
+    elif name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+    compiled = statement.compile(dialect=connection.dialect)
+    sql = prefix + unicode(compiled)
+    if compiled.positional:
+        params = [compiled.params[key] for key in compiled.positiontup]
+        rows = connection.execute(sql, *params)
+    else:
+        rows = connection.execute(sql, compiled.params)
+    return [u' '.join(utils.utf8(v) for v in row) for row in rows]
+
+
+def can_use_threads():
+    """
+    Return True if other threads can open their own connections to the
+    current database, i.e. it isn't an in-memory SQLite database.
+    """
+    if engine is None:
+        return False
+    if engine.name == 'sqlite':
+        return engine.url.database not in (None, '', ':memory:')
+    return True
 
 
 class HistoryExtension(orm.MapperExtension):
@@ -99,6 +353,7 @@ class HistoryExtension(orm.MapperExtension):
         """
         Add a new entry to the history table.
         """
+        table_changed(mapper.local_table.name)
         user = None
         from bauble import db
         try:
@@ -130,10 +385,78 @@ class HistoryExtension(orm.MapperExtension):
         self._add('delete', mapper, instance)
 
 
+class SearchIndexExtension(orm.MapperExtension):
+    """
+    SearchIndexExtension keeps the full-text search index, if any, in
+    sync with the mapped tables.  See :mod:`bauble.search_index`.
+    """
+
+    def after_insert(self, mapper, connection, instance):
+        import bauble.search_index as search_index
+        search_index.update_row(connection, mapper, instance)
+
+    def after_update(self, mapper, connection, instance):
+        import bauble.search_index as search_index
+        search_index.update_row(connection, mapper, instance)
+
+    def after_delete(self, mapper, connection, instance):
+        import bauble.search_index as search_index
+        search_index.delete_row(connection, mapper, instance)
+
+
+class SortKeyExtension(orm.MapperExtension):
+    """
+    SortKeyExtension keeps the _sort_key column of the
+    :class:`NaturallySorted` classes up to date.
+    """
+
+    def before_insert(self, mapper, connection, instance):
+        instance._sort_key = instance.get_sort_key()
+
+    def before_update(self, mapper, connection, instance):
+        key = instance.get_sort_key()
+        instance._sort_key_changed = key != instance._sort_key
+        instance._sort_key = key
+
+    def after_update(self, mapper, connection, instance):
+        # only the objects whose string includes the string of this
+        # object need a new key, and only if the key of this object
+        # changed
+        if not getattr(instance, '_sort_key_changed', False):
+            return
+        instance._sort_key_changed = False
+        dependents = instance.sort_dependents()
+        if not dependents:
+            return
+        # the keys are computed in python since the natural sort keys
+        # can't be built by the database, they are written with a
+        # single executemany UPDATE
+        table = dependents[0].__table__
+        keys = [(obj, obj.get_sort_key()) for obj in dependents]
+        connection.execute(
+            table.update().where(table.c.id == sa.bindparam('_id')).
+            values(_sort_key=sa.bindparam('_key')),
+            [{'_id': obj.id, '_key': key} for obj, key in keys])
+        for obj, key in keys:
+            orm.attributes.set_committed_value(obj, '_sort_key', key)
+        table_changed(table.name)
+
+
+_sorted_classes = {}
+
+
+def get_sorted_class(table_name):
+    """
+    Return the :class:`NaturallySorted` class mapped to table_name or None.
+    """
+    return _sorted_classes.get(table_name)
+
+
 class MapperBase(DeclarativeMeta):
     """
     MapperBase adds the id, _created and _last_updated columns to all
-    tables.
+    tables, and the _sort_key column to the tables of the
+    :class:`NaturallySorted` classes.
 
     In general there is no reason to use this class directly other
     than to extend it to add more default columns to all the bauble
@@ -149,7 +472,15 @@ class MapperBase(DeclarativeMeta):
                                           types.DateTime(True),
                                           default=sa.func.now(),
                                           onupdate=sa.func.now())
-            cls.__mapper_args__ = {'extension': HistoryExtension()}
+            extensions = [HistoryExtension(), SearchIndexExtension()]
+            if issubclass(cls, NaturallySorted):
+                # nullable as the column is added to the existing
+                # tables by add_sort_key_columns()
+                cls._sort_key = sa.Column('_sort_key', sa.String(255),
+                                          default='', index=True)
+                extensions.append(SortKeyExtension())
+                _sorted_classes[dict_['__tablename__']] = cls
+            cls.__mapper_args__ = {'extension': extensions}
         super(MapperBase, cls).__init__(classname, bases, dict_)
 
 
@@ -274,6 +605,7 @@ def open(uri, verify=True, show_error_dialogs=False):
         engine = new_engine
         metadata.bind = engine  # make engine implicit for metadata
         Session = sessionmaker(bind=engine, autoflush=False)
+        database_changed()
 
     if new_engine is not None and not verify:
         _bind()
@@ -341,6 +673,7 @@ def create(import_defaults=True):
         transaction.commit()
     finally:
         connection.close()
+        database_changed()
 
     connection = engine.connect()
     transaction = connection.begin()
@@ -496,6 +829,111 @@ class DefiningPictures:
         return result
 
 
+class NaturallySorted:
+    """
+    Mixin for the mapped classes whose objects are sorted naturally by
+    their string.
+
+    MapperBase adds to their table an indexed _sort_key column holding
+    :func:`bauble.utils.natsort_string` of the object, which is kept up to
+    date by the :class:`SortKeyExtension`, so that the database can sort
+    the objects with ORDER BY _sort_key.
+    """
+
+    def get_sort_key(self):
+        return utils.natsort_string(self)
+
+    def sort_dependents(self):
+        """
+        Return the objects whose string includes the string of this
+        object, their _sort_key is updated when this object is updated.
+        """
+        return []
+
+
+def update_sort_keys(cls, session=None, chunk_size=500):
+    """
+    Recompute the _sort_key of all the objects of a :class:`NaturallySorted`
+    class, e.g. after rows were inserted without going through the mappers.
+
+    The objects are only loaded to build their strings, which span their
+    relations, the changed keys are written with one executemany UPDATE
+    per chunk which doesn't go through the mapper extensions.
+    """
+    own_session = session is None
+    if own_session:
+        session = Session()
+    table = cls.__table__
+    update = table.update().where(table.c.id == sa.bindparam('_id')).\
+        values(_sort_key=sa.bindparam('_key'))
+    changed = False
+    try:
+        ids = [row[0] for row in session.query(cls.id)]
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            params = []
+            for obj in session.query(cls).filter(cls.id.in_(chunk)):
+                key = obj.get_sort_key()
+                if key != obj._sort_key:
+                    params.append({'_id': obj.id, '_key': key})
+            if params:
+                session.connection().execute(update, params)
+                changed = True
+            session.commit()
+            session.expunge_all()
+    finally:
+        if own_session:
+            session.close()
+    if changed:
+        table_changed(table.name)
+
+
+def add_sort_key_columns(bind=None):
+    """
+    Add the _sort_key column and its index to the tables of the
+    :class:`NaturallySorted` classes in a database created before it was
+    introduced, and compute the keys of their rows.
+
+    This is called by :func:`bauble.pluginmgr.init` each time a database
+    is opened, once the plugins defining the classes are loaded.  Return
+    the names of the upgraded tables.
+    """
+    from sqlalchemy.engine.reflection import Inspector
+    from sqlalchemy.schema import CreateIndex
+    bind = bind or engine
+    inspector = Inspector.from_engine(bind)
+    existing = set(inspector.get_table_names())
+    upgraded = []
+    for table_name, cls in sorted(_sorted_classes.items()):
+        if table_name not in existing:
+            continue
+        if '_sort_key' in [c['name'] for c in
+                           inspector.get_columns(table_name)]:
+            continue
+        logger.info('adding the sort key column to %s' % table_name)
+        table = cls.__table__
+        column = table.c._sort_key
+        connection = bind.connect()
+        transaction = connection.begin()
+        try:
+            connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                bind.dialect.identifier_preparer.format_table(table),
+                column.name, column.type.compile(dialect=bind.dialect)))
+            for index in table.indexes:
+                if column in list(index.columns):
+                    connection.execute(CreateIndex(index))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        table_changed(table_name)
+        update_sort_keys(cls)
+        upgraded.append(table_name)
+    return upgraded
+
+
 class Serializable:
     import re
     single_cap_re = re.compile('([A-Z])')
@@ -223,6 +223,10 @@ def init(force=False):
         # no plugins to initialize
         return
 
+    # the databases created before the natural sort keys were stored
+    # don't have their column yet
+    db.add_sort_key_columns()
+
     deps, unmet = _create_dependency_pairs(registered)
     ordered = utils.topological_sort(registered, deps)
     if not ordered:
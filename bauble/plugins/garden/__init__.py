@@ -23,7 +23,7 @@ import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-from sqlalchemy.orm import object_session, eagerload
+from sqlalchemy.orm import object_session, eagerload, joinedload_all
 
 import bauble
 from bauble.i18n import _
@@ -43,6 +43,7 @@ from bauble.plugins.garden.source import \
     Collection, collection_context_menu, coll_markup_func
 from bauble.plugins.garden.institution import \
     Institution, InstitutionCommand, InstitutionTool
+from bauble.plugins.garden.spatial import SpatialIndexCommandHandler
 #from bauble.plugins.garden.propagation import *
 import bauble.search as search
 import re
@@ -58,7 +59,7 @@ class GardenPlugin(pluginmgr.Plugin):
 
     depends = ["PlantsPlugin"]
     tools = [InstitutionTool]
-    commands = [InstitutionCommand]
+    commands = [InstitutionCommand, SpatialIndexCommandHandler]
 
     @classmethod
     def install(cls, *args, **kwargs):
@@ -70,7 +71,8 @@ class GardenPlugin(pluginmgr.Plugin):
         mapper_search = search.get_strategy('MapperSearch')
 
         from functools import partial
-        mapper_search.add_meta(('accession', 'acc'), Accession, ['code'])
+        mapper_search.add_meta(('accession', 'acc'), Accession, ['code'],
+                               load_options=[joinedload_all('species.genus')])
         SearchView.row_meta[Accession].set(
             children=partial(db.natsort, "plants"),
             infobox=AccessionInfoBox,
@@ -84,7 +86,9 @@ class GardenPlugin(pluginmgr.Plugin):
             context_menu=loc_context_menu,
             markup_func=loc_markup_func)
 
-        mapper_search.add_meta(('plant', 'plants'), Plant, ['code'])
+        mapper_search.add_meta(
+            ('plant', 'plants'), Plant, ['code'],
+            load_options=[joinedload_all('accession.species.genus')])
         search.add_strategy(PlantSearch)  # special search value strategy
         #search.add_strategy(SpeciesSearch)  # special search value strategy
         SearchView.row_meta[Plant].set(
@@ -111,12 +115,14 @@ class GardenPlugin(pluginmgr.Plugin):
         mapper_search.add_meta(('collection', 'col', 'coll'),
                                Collection, ['locale'])
         coll_kids = lambda coll: sorted(coll.source.accession.plants,
-                                        key=utils.natsort_key)
+                                        key=db.sort_key)
         SearchView.row_meta[Collection].set(
             children=coll_kids,
             infobox=AccessionInfoBox,
             markup_func=coll_markup_func,
-            context_menu=collection_context_menu)
+            context_menu=collection_context_menu,
+            load_options=[
+                joinedload_all('source.accession.species.genus')])
 
         # done here b/c the Species table is not part of this plugin
         SearchView.row_meta[Species].child = "accessions"
@@ -167,8 +173,8 @@ def init_location_comboentry(presenter, combo, on_select, required=True):
     combo.set_cell_data_func(cell, cell_data_func)
 
     model = gtk.ListStore(object)
-    locations = sorted(presenter.session.query(Location).all(),
-                       key=lambda loc: utils.natsort_key(loc.code))
+    locations = presenter.session.query(Location).\
+        order_by(Location._sort_key).all()
     map(lambda loc: model.append([loc]), locations)
     combo.set_model(model)
     completion.set_model(model)
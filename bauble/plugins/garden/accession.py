@@ -483,7 +483,7 @@ class AccessionNote(db.Base, db.Serializable):
         return result
 
 
-class Accession(db.Base, db.Serializable):
+class Accession(db.Base, db.Serializable, db.NaturallySorted):
     """
     :Table name: accession
 
@@ -641,6 +641,10 @@ class Accession(db.Base, db.Serializable):
     def __str__(self):
         return self.code
 
+    def sort_dependents(self):
+        # the string of a plant starts with the code of its accession
+        return self.plants
+
     def species_str(self, authors=False, markup=False):
         """
         Return the string of the species with the id qualifier(id_qual)
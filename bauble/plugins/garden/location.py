@@ -100,7 +100,7 @@ def loc_markup_func(location):
         return utils.xml_safe(str(location))
 
 
-class Location(db.Base, db.Serializable):
+class Location(db.Base, db.Serializable, db.NaturallySorted):
     """
     :Table name: location
 
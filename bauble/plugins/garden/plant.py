@@ -218,6 +218,9 @@ class PlantSearch(SearchStrategy):
             logger.debug("%s %s" % (e.__class__.name, e))
             return []
 
+    def get_tables(self, text, session=None):
+        return ['plant', 'accession']
+
 
 # TODO: what would happen if the PlantRemove.plant_id and PlantNote.plant_id
 # were out of synch.... how could we avoid these sort of cycles
@@ -415,7 +418,8 @@ acc_type_values = {u'Plant': _('Plant'),
                    None: ''}
 
 
-class Plant(db.Base, db.Serializable, db.DefiningPictures):
+class Plant(db.Base, db.Serializable, db.DefiningPictures,
+            db.NaturallySorted):
     """
     :Table name: plant
 
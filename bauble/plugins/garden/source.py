@@ -255,6 +255,24 @@ class Collection(db.Base):
     def __str__(self):
         return _('Collection at %s') % (self.locale or repr(self))
 
+    @classmethod
+    def near_clause(cls, entity, latitude, longitude, radius_km):
+        """
+        Return the clause of the search predicate 'near (latitude,
+        longitude, radius_km)' on entity, this class or an alias of it.
+        """
+        from bauble.plugins.garden import spatial
+        return spatial.near_clause(entity, latitude, longitude, radius_km)
+
+    @classmethod
+    def within_clause(cls, entity, south, west, north, east):
+        """
+        Return the clause of the search predicate 'within (south, west,
+        north, east)' on entity, this class or an alias of it.
+        """
+        from bauble.plugins.garden import spatial
+        return spatial.within_clause(entity, south, west, north, east)
+
 
 class SourceDetailEditorView(editor.GenericEditorView):
 
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+"""
+Spatial searches on the coordinates of the collections.
+
+The latitude and longitude of a :class:`Collection` are stored as
+decimal degrees in text columns.  The near and within predicates of the
+search language compare them as numbers, see
+:meth:`Collection.near_clause` and :meth:`Collection.within_clause`.
+
+The spatialindex command creates an index serving these predicates:
+
+* on SQLite an rtree virtual table, kept in sync with the collection
+  table by triggers, so the imports keep it up to date too
+* on PostgreSQL a GiST index on a cube of the coordinates, which needs
+  the cube extension
+
+Without the index the predicates still work, scanning the table.
+"""
+
+import math
+
+import gtk
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+import bauble.db as db
+from bauble.i18n import _
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+KM_PER_DEGREE = 6371.0 * math.pi / 180
+
+RTREE = 'collection_rtree'
+PG_INDEX = 'collection_coordinates_idx'
+
+_present = None  # (database generation, whether the index exists)
+
+_sqlite_ddl = [
+    'CREATE VIRTUAL TABLE %(rtree)s USING '
+    'rtree(id, min_lat, max_lat, min_lon, max_lon)',
+    'INSERT INTO %(rtree)s SELECT id, %(lat)s, %(lat)s, %(lon)s, %(lon)s '
+    'FROM collection WHERE %(not_null)s',
+    'CREATE TRIGGER %(rtree)s_insert AFTER INSERT ON collection '
+    'WHEN %(new_not_null)s BEGIN '
+    'INSERT INTO %(rtree)s VALUES (new.id, %(new_lat)s, %(new_lat)s, '
+    '%(new_lon)s, %(new_lon)s); END',
+    'CREATE TRIGGER %(rtree)s_update AFTER UPDATE OF latitude, longitude '
+    'ON collection BEGIN '
+    'DELETE FROM %(rtree)s WHERE id = old.id; '
+    'INSERT INTO %(rtree)s SELECT new.id, %(new_lat)s, %(new_lat)s, '
+    '%(new_lon)s, %(new_lon)s WHERE %(new_not_null)s; END',
+    'CREATE TRIGGER %(rtree)s_delete AFTER DELETE ON collection BEGIN '
+    'DELETE FROM %(rtree)s WHERE id = old.id; END',
+    ]
+
+_sqlite_names = {
+    'rtree': RTREE,
+    'lat': 'CAST(latitude AS REAL)',
+    'lon': 'CAST(longitude AS REAL)',
+    'not_null': "latitude <> '' AND longitude <> ''",
+    'new_lat': 'CAST(new.latitude AS REAL)',
+    'new_lon': 'CAST(new.longitude AS REAL)',
+    'new_not_null': "new.latitude <> '' AND new.longitude <> ''",
+    }
+
+
+def get_backend(engine=None):
+    """
+    Return the name of the spatial index backend for engine, or None if
+    the database doesn't support one.
+    """
+    engine = engine or db.engine
+    if engine is None:
+        return None
+    if engine.name in ('sqlite', 'postgresql'):
+        return engine.name
+    return None
+
+
+def is_indexed():
+    """
+    Return True if the current database has the spatial index.
+    """
+    global _present
+    generation = db.get_generations()[0]
+    if _present is None or _present[0] != generation:
+        backend = get_backend()
+        indexed = False
+        if backend == 'sqlite':
+            # the triggers are dropped with the collection table, the
+            # rtree table is not
+            indexed = db.engine.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name IN (?, ?)",
+                RTREE, RTREE + '_insert').scalar() == 2
+        elif backend == 'postgresql':
+            indexed = db.engine.execute(
+                "SELECT count(*) FROM pg_indexes WHERE indexname = %s",
+                PG_INDEX).scalar() == 1
+        _present = generation, indexed
+    return _present[1]
+
+
+def _coordinates(entity):
+    """
+    Return the latitude and longitude columns of entity, a Collection
+    class or alias, as numbers.
+    """
+    return (sa.cast(sa.func.nullif(entity.latitude, u''), sa.Float),
+            sa.cast(sa.func.nullif(entity.longitude, u''), sa.Float))
+
+
+def _pg_index_expression():
+    return "cube(cube(CAST(NULLIF(latitude, '') AS FLOAT)), " \
+        "CAST(NULLIF(longitude, '') AS FLOAT))"
+
+
+def within_clause(entity, south, west, north, east):
+    """
+    Return the clause selecting the collections of entity whose
+    coordinates are inside the bounding box.
+    """
+    lat, lon = _coordinates(entity)
+    clause = sa.and_(lat >= south, lat <= north, lon >= west, lon <= east)
+    if not is_indexed():
+        return clause
+    if get_backend() == 'sqlite':
+        rtree = table(RTREE, column('id'), column('min_lat'),
+                      column('max_lat'), column('min_lon'), column('max_lon'))
+        # the rtree stores the points as boxes rounded outwards to 32 bit
+        # floats, a point on the edge of the box can have a rounded box
+        # sticking out of it, so the prefilter selects the boxes that
+        # overlap the box and the clause keeps it exact
+        ids = sa.select([rtree.c.id]).where(sa.and_(
+            rtree.c.max_lat >= south, rtree.c.min_lat <= north,
+            rtree.c.max_lon >= west, rtree.c.min_lon <= east))
+        return sa.and_(entity.id.in_(ids), clause)
+    point = sa.func.cube(sa.func.cube(lat), lon)
+    box = sa.literal_column('cube(ARRAY[%r, %r], ARRAY[%r, %r])' % (
+        float(south), float(west), float(north), float(east)))
+    return sa.and_(point.op('<@')(box), clause)
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Return the (south, west, north, east) box containing the circle of
+    radius_km around the point.  The box spans all the longitudes when
+    the circle reaches a pole or the antimeridian.
+    """
+    delta = radius_km / KM_PER_DEGREE
+    south = max(latitude - delta, -90.0)
+    north = min(latitude + delta, 90.0)
+    widest = math.cos(math.radians(max(abs(south), abs(north))))
+    if widest <= 0 or delta / widest >= 180:
+        return south, -180.0, north, 180.0
+    west = longitude - delta / widest
+    east = longitude + delta / widest
+    if west < -180 or east > 180:
+        return south, -180.0, north, 180.0
+    return south, west, north, east
+
+
+def near_clause(entity, latitude, longitude, radius_km):
+    """
+    Return the clause selecting the collections of entity within
+    radius_km of the point.
+
+    The bounding box of the circle uses the index, the distance is the
+    equirectangular approximation, accurate to well under a percent for
+    the radiuses of a collecting trip but not across the antimeridian.
+    """
+    south, west, north, east = bounding_box(latitude, longitude, radius_km)
+    lat, lon = _coordinates(entity)
+    scale = math.cos(math.radians(latitude))
+    dlat = lat - latitude
+    dlon = (lon - longitude) * scale
+    return sa.and_(within_clause(entity, south, west, north, east),
+                   dlat * dlat + dlon * dlon <=
+                   (radius_km / KM_PER_DEGREE) ** 2)
+
+
+def drop_index(engine=None):
+    """
+    Drop the spatial index of the collection coordinates.
+    """
+    global _present
+    engine = engine or db.engine
+    backend = get_backend(engine)
+    if backend is None:
+        return
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        if backend == 'sqlite':
+            for suffix in ('_insert', '_update', '_delete'):
+                connection.execute('DROP TRIGGER IF EXISTS %s%s'
+                                   % (RTREE, suffix))
+            connection.execute('DROP TABLE IF EXISTS %s' % RTREE)
+            db.table_changed(RTREE)
+        else:
+            connection.execute('DROP INDEX IF EXISTS %s' % PG_INDEX)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+        _present = None
+
+
+def create_index(engine=None):
+    """
+    (Re)create the spatial index of the collection coordinates.
+    """
+    global _present
+    engine = engine or db.engine
+    backend = get_backend(engine)
+    if backend is None:
+        raise NotImplementedError(
+            _('Spatial indexes are not supported on %s') % engine.name)
+    drop_index(engine)
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        if backend == 'sqlite':
+            for ddl in _sqlite_ddl:
+                connection.execute(ddl % _sqlite_names)
+            db.table_changed(RTREE)
+        else:
+            connection.execute('CREATE EXTENSION IF NOT EXISTS cube')
+            connection.execute('CREATE INDEX %s ON collection USING gist '
+                               '((%s))' % (PG_INDEX, _pg_index_expression()))
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+        _present = None
+
+
+class SpatialIndexCommandHandler(pluginmgr.CommandHandler):
+    """
+    :spatialindex builds the index of the collection coordinates,
+    :spatialindex=drop removes it
+    """
+
+    command = 'spatialindex'
+
+    def __call__(self, cmd, arg):
+        if arg == 'drop':
+            drop_index()
+            utils.message_dialog(_('The spatial index was removed.'))
+            return
+        try:
+            create_index()
+        except Exception, e:
+            utils.message_dialog(utils.xml_safe(unicode(e)),
+                                 gtk.MESSAGE_ERROR)
+            return
+        utils.message_dialog(_('The spatial index was created.'))
@@ -287,6 +287,31 @@ class PlantTests(GardenTestCase):
     def test_editor_addnote(self):
         raise SkipTest('Not Implemented')
 
+    def test_sort_key(self):
+        "plants are sorted by the database in natural order"
+        for code in (u'10', u'2'):
+            self.create(Plant, accession=self.accession,
+                        location=self.location, code=code, quantity=1)
+        self.session.commit()
+        self.session.expire(self.accession)
+        plants = db.natsort('plants', self.accession)
+        self.assertEquals([p.code for p in plants], [u'1', u'2', u'10'])
+        self.assertEquals(self.plant._sort_key,
+                          utils.natsort_string(self.plant))
+
+        # changing the accession code changes the key of its plants
+        self.accession.code = u'2015.0001'
+        self.session.commit()
+        self.session.expire(self.plant)
+        self.assertEquals(self.plant._sort_key,
+                          utils.natsort_string('2015.0001.1'))
+
+        # changing anything else doesn't touch the plants
+        snapshot = db.get_generations()
+        self.accession.quantity_recvd = 5
+        self.session.commit()
+        self.assertTrue(db.unchanged_since(snapshot, ['plant']))
+
     def test_duplicate(self):
         """
         Test Plant.duplicate()
@@ -1154,6 +1179,40 @@ class LocationTests(GardenTestCase):
     def tearDown(self):
         super(LocationTests, self).tearDown()
 
+    def test_add_sort_key_columns(self):
+        "the sort key column is added to the tables of an old database"
+        import sqlalchemy as sa
+        self.session.close()
+        table = Location.__table__
+        table.drop(bind=db.engine)
+        metadata = sa.MetaData()
+        old_table = sa.Table(table.name, metadata,
+                             *[c.copy() for c in table.c
+                               if c.name != '_sort_key'])
+        old_table.create(bind=db.engine)
+        db.engine.execute(old_table.insert(), code=u'B10', name=u'bed 10')
+        self.assertEquals(db.add_sort_key_columns(), [table.name])
+        self.assertEquals(db.add_sort_key_columns(), [])
+        loc = self.session.query(Location).one()
+        self.assertEquals(loc._sort_key, utils.natsort_string(loc))
+
+    def test_update_sort_keys(self):
+        "the keys of the rows inserted without the mappers are computed"
+        table = Location.__table__
+        db.engine.execute(table.insert(), [dict(code=u'B%s' % i, name=None)
+                                           for i in (2, 10, 1)])
+        snapshot = db.get_generations()
+        db.update_sort_keys(Location, chunk_size=2)
+        self.assertFalse(db.unchanged_since(snapshot, [table.name]))
+        query = self.session.query(Location).order_by(Location._sort_key)
+        self.assertEquals([loc.code for loc in query],
+                          [u'B1', u'B2', u'B10'])
+
+        # nothing is written when the keys are up to date
+        snapshot = db.get_generations()
+        db.update_sort_keys(Location)
+        self.assertTrue(db.unchanged_since(snapshot, [table.name]))
+
     def test_location_editor(self):
         loc = self.create(Location, name=u'some site', code=u'STE')
         self.session.commit()
@@ -1627,6 +1686,71 @@ class PlantSearchTest(GardenTestCase):
         self.assertEqual(a, expect)
 
 
+class SpatialSearchTests(GardenTestCase):
+
+    def setUp(self):
+        super(SpatialSearchTests, self).setUp()
+        # Belize City, Belmopan (about 70 km away) and Kew
+        self.collections = []
+        for i, (lat, lon) in enumerate([(u'17.5', u'-88.2'),
+                                        (u'17.25', u'-88.77'),
+                                        (u'51.48', u'-0.29')]):
+            acc = self.create(Accession, species=self.species,
+                              code=u'%s' % i)
+            acc.source = Source()
+            acc.source.collection = Collection(
+                locale=u'locale%s' % i, latitude=lat, longitude=lon)
+            self.collections.append(acc.source.collection)
+        self.session.commit()
+
+    def tearDown(self):
+        import bauble.plugins.garden.spatial as spatial
+        spatial.drop_index()
+        super(SpatialSearchTests, self).tearDown()
+
+    def check_results(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('collection near (17.5, -88.2, 10)',
+                                       self.session)
+        self.assertEquals(results, set(self.collections[:1]))
+        results = mapper_search.search('collection near (17.5, -88.2, 100)',
+                                       self.session)
+        self.assertEquals(results, set(self.collections[:2]))
+        results = mapper_search.search(
+            'collection within (15, -90, 19, -87)', self.session)
+        self.assertEquals(results, set(self.collections[:2]))
+        results = mapper_search.search(
+            'accession where source.collection near (51.5, -0.3, 10)',
+            self.session)
+        self.assertEquals(results,
+                          set([self.collections[2].source.accession]))
+
+    def test_spatial_search(self):
+        "near and within work without the spatial index"
+        self.check_results()
+
+    def test_spatial_index(self):
+        "near and within use the spatial index, kept in sync with changes"
+        import bauble.plugins.garden.spatial as spatial
+        try:
+            spatial.create_index()
+        except Exception, e:
+            raise SkipTest('no spatial index support: %s' % e)
+        self.assertTrue(spatial.is_indexed())
+        self.check_results()
+        # a point on the edge of the box, the rtree rounds it outwards
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search(
+            'collection within (17.25, -88.77, 18, -88)', self.session)
+        self.assertEquals(results, set(self.collections[:2]))
+        self.collections[1].latitude = u'51.49'
+        self.collections[1].longitude = u'-0.3'
+        self.session.commit()
+        results = mapper_search.search('collection near (51.5, -0.3, 10)',
+                                       self.session)
+        self.assertEquals(results, set(self.collections[1:]))
+
+
 from bauble.plugins.garden.accession import get_next_code
 from bauble.plugins.garden.location import mergevalues
 
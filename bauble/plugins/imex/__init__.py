@@ -27,7 +27,8 @@
 
 import bauble.pluginmgr as pluginmgr
 from bauble.plugins.imex.csv_ import CSVImportTool, CSVExportTool, \
-    CSVExportCommandHandler, CSVImportCommandHandler
+    CSVExportCommandHandler, CSVImportCommandHandler, \
+    ResetSequencesCommandHandler
 from bauble.plugins.imex.iojson import JSONImportTool, JSONExportTool
 from bauble.plugins.imex.xml import XMLExportTool, XMLExportCommandHandler
 
@@ -47,7 +48,7 @@ class ImexPlugin(pluginmgr.Plugin):
     tools = [CSVImportTool, CSVExportTool,
              JSONImportTool, JSONExportTool, XMLExportTool]
     commands = [CSVExportCommandHandler, CSVImportCommandHandler,
-                XMLExportCommandHandler]
+                ResetSequencesCommandHandler, XMLExportCommandHandler]
 
 
 plugin = ImexPlugin
@@ -26,6 +26,10 @@
 
 import os
 import csv
+import cStringIO
+import itertools
+import threading
+import time
 import traceback
 
 import logging
@@ -33,7 +37,9 @@ logger = logging.getLogger(__name__)
 
 import gtk
 
-from sqlalchemy import ColumnDefault, Boolean
+from sqlalchemy import ColumnDefault, Boolean, bindparam, Column, Table, \
+    MetaData, ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy.schema import AddConstraint
 
 import bauble
 import bauble.db as db
@@ -41,6 +47,8 @@ from bauble.i18n import _
 from bauble.error import BaubleError
 import bauble.utils as utils
 import bauble.pluginmgr as pluginmgr
+import bauble.prefs as prefs
+import bauble.search_index as search_index
 import bauble.task
 from bauble import pb_set_fraction
 
@@ -71,6 +79,9 @@ from bauble import pb_set_fraction
 QUOTE_STYLE = csv.QUOTE_MINIMAL
 QUOTE_CHAR = '"'
 
+# the number of threads loading the tables of an import concurrently
+IMPORT_WORKERS = 4
+
 
 class UnicodeReader(object):
 
@@ -124,6 +135,279 @@ class UnicodeWriter(object):
             self.writerow(row)
 
 
+def get_row_builder(table, column_keys, defaults):
+    """
+    Return a function turning a line read by a :class:`UnicodeReader`,
+    where the empty values are already None, into the values of a row of
+    table.  The coercions of the columns are worked out once per table
+    rather than for every line.
+
+    :param column_keys: the keys of the values of the rows
+    :param defaults: a dict of column name to the value of the columns
+      missing or empty in the lines
+    """
+    defaults = defaults.items()
+    # in SA 0.5.5 and only on an SQLite database the 'False' will import
+    # as True for some reason whereas True will import as True
+    # automatically...probably because bool('False') == True
+    booleans = [key for key in column_keys
+                if key in table.c and isinstance(table.c[key].type, Boolean)]
+    to_bool = {'True': True, 'False': False}
+
+    def build_row(line):
+        for key, value in defaults:
+            if line.get(key) is None:
+                line[key] = value
+        for key in booleans:
+            line[key] = to_bool.get(line.get(key), line.get(key))
+        return line
+    return build_row
+
+
+class BulkLoader(object):
+    """
+    Load the rows of a table with a precompiled INSERT statement executed
+    with executemany, batch_size rows at a time.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.table = None
+        self.column_keys = None
+        self.insert = None
+
+    def setup(self):
+        """
+        Called before the first table is loaded.
+        """
+        pass
+
+    def teardown(self):
+        """
+        Called after the last table is loaded, or the import failed.
+        """
+        pass
+
+    def prepare(self, table, column_keys):
+        """
+        Prepare the loading of table, the rows will have the values of
+        column_keys, the keys which aren't columns of table are ignored.
+        """
+        self.table = table
+        self.column_keys = [key for key in column_keys if key in table.c]
+        self.insert = table.insert(bind=self.connection).\
+            compile(column_keys=self.column_keys)
+
+    def load(self, rows):
+        """
+        Insert rows, a list of dicts, in the prepared table.
+        """
+        self.connection.execute(self.insert, *rows)
+
+
+class SQLiteBulkLoader(BulkLoader):
+    """
+    Load the rows in large batches, with the journal kept in memory and
+    without waiting for the disk on each commit while importing.
+
+    An import interrupted by a crash of the system can corrupt the
+    database file, as with any other unsynchronised write.
+    """
+
+    batch_size = 10000
+
+    def __init__(self, connection):
+        super(SQLiteBulkLoader, self).__init__(connection)
+        self._pragmas = []
+
+    def setup(self):
+        for pragma, value in (('synchronous', 'OFF'),
+                              ('journal_mode', 'MEMORY')):
+            try:
+                current = self.connection.execute(
+                    'PRAGMA %s' % pragma).scalar()
+                self.connection.execute('PRAGMA %s = %s' % (pragma, value))
+                self._pragmas.append((pragma, current))
+            except Exception, e:
+                logger.debug('could not set PRAGMA %s: %s' % (pragma, e))
+
+    def teardown(self):
+        while self._pragmas:
+            pragma, value = self._pragmas.pop()
+            try:
+                self.connection.execute('PRAGMA %s = %s' % (pragma, value))
+            except Exception, e:
+                logger.debug('could not reset PRAGMA %s: %s' % (pragma, e))
+
+
+def get_copy_field(value):
+    """
+    Return value as a field of the CSV read by COPY.  COPY reads an
+    unquoted empty field as NULL, so None is written that way and all the
+    other values are quoted, so that an empty string stays one.
+    """
+    if value is None:
+        return ''
+    return '"%s"' % utils.utf8(value).encode('utf-8').replace('"', '""')
+
+
+class PostgreSQLBulkLoader(BulkLoader):
+    """
+    Load the rows with COPY ... FROM STDIN, streaming batch_size rows
+    at a time as CSV to the server, see :func:`get_copy_field`.
+    """
+
+    batch_size = 10000
+
+    def prepare(self, table, column_keys):
+        super(PostgreSQLBulkLoader, self).prepare(table, column_keys)
+        preparer = self.connection.dialect.identifier_preparer
+        self.copy = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv, ' \
+            "ENCODING 'UTF8')" % (
+                preparer.format_table(table),
+                ', '.join(preparer.quote_identifier(key)
+                          for key in self.column_keys))
+
+    def load(self, rows):
+        data = cStringIO.StringIO()
+        keys = self.column_keys
+        for row in rows:
+            data.write(','.join(get_copy_field(row.get(key)) for key in keys))
+            data.write('\n')
+        data.seek(0)
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.copy_expert(self.copy, data)
+        finally:
+            cursor.close()
+
+
+def get_bulk_loader(connection):
+    """
+    Return the :class:`BulkLoader` for the database of connection.
+    """
+    name = connection.dialect.name
+    if name == 'sqlite':
+        return SQLiteBulkLoader(connection)
+    elif name in ('postgres', 'postgresql'):
+        return PostgreSQLBulkLoader(connection)
+    return BulkLoader(connection)
+
+
+def get_bare_table(table):
+    """
+    Return a copy of table, in a metadata of its own, with its columns
+    and primary key only: no foreign keys, unique constraints or indexes.
+    """
+    columns = [Column(column.name, column.type,
+                      primary_key=column.primary_key,
+                      nullable=column.nullable,
+                      autoincrement=column.autoincrement)
+               for column in table.c]
+    return Table(table.name, MetaData(), *columns)
+
+
+def create_constraints(connection, table):
+    """
+    Create the foreign keys, unique constraints and indexes of table,
+    left out by :func:`get_bare_table`.  The rows already in table are
+    checked against the constraints.
+    """
+    for constraint in table.constraints:
+        if isinstance(constraint, (ForeignKeyConstraint, UniqueConstraint)):
+            connection.execute(AddConstraint(constraint))
+    for index in table.indexes:
+        index.create(bind=connection)
+
+
+def get_import_workers(connection):
+    """
+    Return the number of threads loading the tables of an import on the
+    database of connection.
+
+    SQLite allows a single writer at a time and an in-memory database
+    isn't shared among connections, so its tables are loaded one after
+    the other.
+    """
+    if connection.dialect.name == 'sqlite' or not db.can_use_threads():
+        return 1
+    return IMPORT_WORKERS
+
+
+def get_parent_tables(tables):
+    """
+    Return a dict of each table of tables to the set of the other tables
+    of tables it refers to through its foreign keys.
+    """
+    tables = set(tables)
+    return dict((table, set(key.column.table for key in table.foreign_keys
+                            if key.column.table is not table
+                            and key.column.table in tables))
+                for table in tables)
+
+
+class ImportScheduler(object):
+    """
+    Hand out the tables of an import to the threads loading them, each
+    table once the tables it refers to are loaded, so that the tables
+    without a foreign key path between them are loaded concurrently.
+
+    :param tables: the tables to load, sorted by dependency
+    :param independent: if True the tables are loaded in any order,
+      when their foreign keys are created after loading them
+    """
+
+    def __init__(self, tables, independent=False):
+        self.pending = list(tables)
+        if independent:
+            self.parents = dict((table, set()) for table in tables)
+        else:
+            self.parents = get_parent_tables(tables)
+        self.done = set()
+        self.running = []
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def next(self):
+        """
+        Return the next table to load, waiting for its parents to be
+        loaded, or None if there are no more tables to load.
+        """
+        with self.condition:
+            while not self.stopped and self.pending:
+                ready = [table for table in self.pending
+                         if self.parents[table] <= self.done]
+                if not ready and not self.running:
+                    # a cycle, load them in the sorted order
+                    ready = self.pending
+                if ready:
+                    table = ready[0]
+                    self.pending.remove(table)
+                    self.running.append(table)
+                    return table
+                self.condition.wait()
+            return None
+
+    def finish(self, table):
+        """
+        Mark table as loaded, the tables referring to it can be loaded.
+        """
+        with self.condition:
+            self.running.remove(table)
+            self.done.add(table)
+            self.condition.notify_all()
+
+    def stop(self):
+        """
+        Hand out no more tables.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
 class Importer(object):
 
     def start(self, **kwargs):
@@ -164,8 +448,10 @@ class CSVImporter(Importer):
         self.__cancel = False  # flag to cancel importing
         self.__pause = False   # flag to pause importing
         self.__error_exc = False
+        self.__deferred = False  # flag to create the constraints last
 
-    def start(self, filenames=None, metadata=None, force=False):
+    def start(self, filenames=None, metadata=None, force=False,
+              deferred=None):
         '''start the import process. this is a non blocking method: we queue
         the process as a bauble task. there is no callback informing whether
         it is successfully completed or not.
@@ -179,63 +465,9 @@ class CSVImporter(Importer):
         if filenames is None:
             return
 
-        bauble.task.queue(self.run(filenames, metadata, force))
+        bauble.task.queue(self.run(filenames, metadata, force, deferred))
 
-    @staticmethod
-    def _toposort_file(filename, key_pairs):
-        """
-        filename: the csv file to sort
-
-        key_pairs: tuples of the form (parent, child) where for each
-        line in the file the line[parent] needs to be sorted before
-        any of the line[child].  parent is usually the name of the
-        foreign_key column and child is usually the column that the
-        foreign key points to, e.g ('parent_id', 'id')
-        """
-        f = open(filename, 'rb')
-        reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                               quoting=QUOTE_STYLE)
-
-        # create a dictionary of the lines mapped to the child field
-        bychild = {}
-        for line in reader:
-            for parent, child in key_pairs:
-                bychild[line[child]] = line
-        f.close()
-        fields = reader.reader.fieldnames
-        del reader
-
-        # create pairs from the values in the lines where pair[0]
-        # should come before pair[1] when the lines are sorted
-        pairs = []
-        for line in bychild.values():
-            for parent, child in key_pairs:
-                if line[parent] and line[child]:
-                    pairs.append((line[parent], line[child]))
-
-        # sort the keys and flatten the lines back into a list
-        sorted_keys = utils.topological_sort(bychild.keys(), pairs)
-        sorted_lines = []
-        for key in sorted_keys:
-            sorted_lines.append(bychild[key])
-
-        # write a temporary file of the sorted lines
-        import tempfile
-        tmppath = tempfile.mkdtemp()
-        head, tail = os.path.split(filename)
-        filename = os.path.join(tmppath, tail)
-        tmpfile = open(filename, 'wb')
-        tmpfile.write('%s\n' % ','.join(fields))
-        #writer = UnicodeWriter(tmpfile, fields, quotechar=QUOTE_CHAR,
-        writer = csv.DictWriter(tmpfile, fields, quotechar=QUOTE_CHAR,
-                                quoting=QUOTE_STYLE)
-        writer.writerows(sorted_lines)
-        tmpfile.flush()
-        tmpfile.close()
-        del writer
-        return filename
-
-    def run(self, filenames, metadata, force=False):
+    def run(self, filenames, metadata, force=False, deferred=None):
         '''
         A generator method for importing filenames into the database.
         This method periodically yields control so that the GUI can
@@ -244,7 +476,14 @@ class CSVImporter(Importer):
         :param filenames:
         :param metadata:
         :param force: default=False
+        :param deferred: if True the tables are created without their
+          indexes and constraints, which are created once all the rows
+          are loaded; default=None, use the
+          :data:`bauble.prefs.import_defer_constraints_pref` preference
         '''
+        if deferred is None:
+            deferred = prefs.prefs.get(prefs.import_defer_constraints_pref,
+                                       False)
         transaction = None
         connection = None
         self.__error_exc = BaubleError(_('Unknown Error.'))
@@ -293,24 +532,28 @@ class CSVImporter(Importer):
             utils.message_dialog(msg, gtk.MESSAGE_ERROR)
             return
 
-        total_lines = 0
-        filesizes = {}
-        for filename in filenames:
-            #get the total number of lines for all the files
-            nlines = len(open(filename).readlines())
-            filesizes[filename] = nlines
-            total_lines += nlines
+        # the progress is measured on the bytes read, so that the files
+        # are read once, as a stream
+        total_bytes = sum(os.path.getsize(filename) for filename in filenames)
 
+        # sqlite can't add the constraints to an existing table
+        deferred = deferred and connection.dialect.name != 'sqlite'
+        self.__deferred = deferred
         created_tables = []
+        bare_tables = []
 
         def create_table(table):
-            table.create(bind=connection)
+            if deferred:
+                get_bare_table(table).create(bind=connection)
+                if table not in bare_tables:
+                    bare_tables.append(table)
+            else:
+                table.create(bind=connection)
             if table.name not in created_tables:
                 created_tables.append(table.name)
 
-        steps_so_far = 0
         cleaned = None
-        insert = None
+        loaded = []  # the tables loaded, in the order they were committed
         depends = set()  # the type will be changed to a [] later
         try:
             ## get all the dependencies
@@ -344,26 +587,19 @@ class CSVImporter(Importer):
             transaction.commit()
             transaction = connection.begin()
 
-            # update_every determines how many rows we will insert at
-            # a time and consequently how often we update the gui
-            update_every = 127
-
-            # import the tables one at a time, breaking every so often
-            # so the GUI can update
+            # create the tables first, so that the questions are all
+            # asked before the data is loaded, possibly in other threads
+            to_load = []
             for table, filename in reversed(sorted_tables):
                 if self.__cancel or self.__error:
                     break
-                msg = _('importing %(table)s table from %(filename)s') \
-                    % {'table': table.name, 'filename': filename}
-                #log.info(msg)
-                bauble.task.set_message(msg)
-                yield  # allow progress bar update
-
-                # don't do anything if the file is empty:
-                if filesizes[filename] <= 1:
+                # don't do anything if the file is empty, the files
+                # with a header but no rows are found by _import_table()
+                if os.path.getsize(filename) <= 1:
                     if not table.exists():
                         create_table(table)
                     continue
+                to_load.append((table, filename))
                 # check if the table was in the depends because they
                 # could have been dropped whereas table.exists() can
                 # return true for a dropped table if the transaction
@@ -392,130 +628,64 @@ class CSVImporter(Importer):
                         table.drop(bind=connection)
                         create_table(table)
 
-                if self.__cancel or self.__error:
-                    break
-
-                # commit the drop of the table we're importing
-                transaction.commit()
-                transaction = connection.begin()
-
-                # open a temporary reader to get the column keys so we
-                # can later precompile our insert statement
-                f = open(filename, "rb")
-                tmp = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                    quoting=QUOTE_STYLE)
-                tmp.next()
-                csv_columns = set(tmp.reader.fieldnames)
-                del tmp
-                f.close()
-
-                # precompute the defaults...this assumes that the
-                # default function doesn't depend on state after each
-                # row...it shouldn't anyways since we do an insert
-                # many instead of each row at a time
-                defaults = {}
-                for column in table.c:
-                    if isinstance(column.default, ColumnDefault):
-                        defaults[column.name] = column.default.execute()
-                column_names = table.c.keys()
-
-                # check if there are any foreign keys to on the table
-                # that refer to itself, if so create a new file with
-                # the lines sorted in order of dependency so that we
-                # don't get errors about importing values into a
-                # foreign_key that don't reference and existin row
-                self_keys = filter(lambda f: f.column.table == table,
-                                   table.foreign_keys)
-                if self_keys:
-                    key_pairs = map(lambda x: (x.parent.name, x.column.name),
-                                    self_keys)
-                    filename = self._toposort_file(filename, key_pairs)
-
-                # the column keys for the insert are a union of the
-                # columns in the CSV file and the columns with
-                # defaults
-                column_keys = list(csv_columns.union(defaults.keys()))
-                insert = table.insert(bind=connection).\
-                    compile(column_keys=column_keys)
-
-                values = []
-
-                def do_insert():
-                    if values:
-                        connection.execute(insert, *values)
-                    del values[:]
-                    percent = float(steps_so_far)/float(total_lines)
-                    if 0 < percent < 1.0:
-                        pb_set_fraction(percent)
-
-                isempty = lambda v: v in ('', None)
-
-                f = open(filename, "rb")
-                reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                       quoting=QUOTE_STYLE)
-                # NOTE: we shouldn't get this far if the file doesn't
-                # have any rows to import but if so there is a chance
-                # that this loop could cause problems
-                for line in reader:
-                    while self.__pause:
-                        yield
-                    if self.__cancel or self.__error:
-                        break
+            # commit the creation of the tables we're importing, the
+            # tables are loaded in transactions of their own
+            transaction.commit()
+            transaction = None
 
-                    # fill in default values and None for "empty"
-                    # columns in line
-                    for column in table.c.keys():
-                        if column in defaults \
-                                and (column not in line
-                                     or isempty(line[column])):
-                            line[column] = defaults[column]
-                        elif column in line and isempty(line[column]):
-                            line[column] = None
-                        elif column in line and line[column] == 'False' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'False' string
-                            line[column] = False
-                        elif column in line and line[column] == 'True' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'True' string
-                            line[column] = True
-                            # in SA 0.5.5 and only on an SQLite
-                            # database the 'False' will import as True
-                            # for some reason whereas True will import
-                            # as True automatically...probably because
-                            # bool('False') == True
-                    values.append(line)
-                    steps_so_far += 1
-                    if steps_so_far % update_every == 0:
-                        do_insert()
-                        yield
-
-                if self.__error or self.__cancel:
-                    break
+            # the bytes read of each file, to update the progress bar
+            progress = dict((filename, 0) for table, filename in to_load)
 
-                # insert the remainder that were less than update every
-                do_insert()
+            def update_progress():
+                percent = float(sum(progress.values())) / total_bytes
+                if 0 < percent < 1.0:
+                    pb_set_fraction(percent)
 
-                # we have commit after create after each table is imported
-                # or Postgres will complain if two tables that are
-                # being imported have a foreign key relationship
-                transaction.commit()
-                logger.debug('%s: %s' % (
-                    table.name,
-                    table.select().alias().count().execute().fetchone()[0]))
-                transaction = connection.begin()
+            workers = get_import_workers(connection)
+            if workers > 1:
+                tasks = self._import_parallel(metadata.bind, to_load,
+                                              progress, loaded, workers)
+            else:
+                tasks = self._import_sequential(connection, to_load,
+                                                progress, loaded)
+            try:
+                for step in tasks:
+                    update_progress()
+                    yield
+            finally:
+                tasks.close()
+                for table in loaded:
+                    db.table_changed(table.name)
 
+            transaction = connection.begin()
             logger.debug('creating: %s' % ', '.join([d.name for d in depends]))
             # TODO: need to get those tables from depends that need to
             # be created but weren't created already
             metadata.create_all(connection, depends, checkfirst=True)
+            if deferred:
+                bauble.task.set_message(_('creating the indexes and '
+                                          'constraints'))
+                yield
+                for table in bare_tables:
+                    create_constraints(connection, table)
+                # the sequences are set in the same transaction
+                utils.reset_sequences([table for table, filename
+                                       in sorted_tables], connection)
         except GeneratorExit, e:
-            transaction.rollback()
+            if transaction is not None:
+                transaction.rollback()
+            if bare_tables:
+                self._restore_tables(connection, metadata, bare_tables,
+                                     depends, _('The import was cancelled.'))
             raise
         except Exception, e:
             logger.error(e)
             logger.error(traceback.format_exc())
-            transaction.rollback()
+            if transaction is not None:
+                transaction.rollback()
+            if bare_tables:
+                self._restore_tables(connection, metadata, bare_tables,
+                                     depends, traceback.format_exc())
             self.__error = True
             self.__error_exc = e
             raise
@@ -524,24 +694,38 @@ class CSVImporter(Importer):
 
         # unfortunately inserting an explicit value into a column that
         # has a sequence doesn't update the sequence, we shortcut this
-        # by setting the sequence manually to the max(column)+1
-        col = None
+        # by setting the sequence manually to the max(column)+1, the
+        # deferred import already did with the constraints
         try:
-            for table, filename in sorted_tables:
-                for col in table.c:
-                    utils.reset_sequence(col)
+            if not deferred:
+                utils.reset_sequences([table for table, filename
+                                       in sorted_tables])
         except Exception, e:
-            col_name = None
-            try:
-                col_name = col.name
-            except Exception:
-                pass
-            msg = _('Error: Could not set the sequence for column: %s') \
-                % col_name
+            msg = _('Error: Could not set the sequences of the imported '
+                    'tables')
             utils.message_details_dialog(utils.xml_safe(msg),
                                          traceback.format_exc(),
                                          type=gtk.MESSAGE_ERROR)
 
+        # the rows were inserted without going through the mappers so
+        # their natural sort keys still have to be computed
+        for table, filename in sorted_tables:
+            cls = db.get_sorted_class(table.name)
+            if cls is not None:
+                db.update_sort_keys(cls)
+                yield
+
+        # the tables computed from the imported ones, like the closure of
+        # the geography tree, are computed again
+        db.refresh_derived_tables([table.name for table in loaded])
+
+        # and so are the full-text indexes of the tables loaded or emptied,
+        # their rows didn't go through the SearchIndexExtension either
+        changed = set(created_tables)
+        changed.update(table.name for table in loaded)
+        changed.update(table.name for table in depends)
+        search_index.rebuild_index(sorted(changed))
+
 # TODO: we don't use the progress dialog any more but we'll leave this
 # around to remind us when we support cancelling via the progress statusbar
 #
@@ -556,6 +740,241 @@ class CSVImporter(Importer):
 #             self.__cancel = True
 ##         self.__pause = False
 
+    def _restore_tables(self, connection, metadata, tables, depends,
+                        details):
+        """
+        Drop tables, created without their constraints by a deferred
+        import which didn't complete, and create them again empty with
+        their full schema, along with the tables depending on them.
+        Then tell the user in which state the database is left.
+
+        :param details: the details of the error dialog
+        """
+        names = utils.xml_safe(', '.join(table.name for table in tables))
+        transaction = connection.begin()
+        try:
+            for table in tables:
+                table.drop(bind=connection, checkfirst=True)
+            metadata.create_all(connection, list(set(tables).union(depends)),
+                                checkfirst=True)
+            transaction.commit()
+        except Exception, e:
+            logger.error(e)
+            logger.error(traceback.format_exc())
+            transaction.rollback()
+            msg = _('The import failed and the tables <b>%s</b> could not '
+                    'be restored: they hold the rows imported so far '
+                    'without their indexes, unique constraints and foreign '
+                    'keys.\n\nImport the files again or restore the '
+                    'database from a backup.') % names
+        else:
+            msg = _('The import failed.  The tables <b>%s</b> were emptied '
+                    'and created again with their indexes and '
+                    'constraints, none of the rows of the files were '
+                    'kept.') % names
+        for table in tables:
+            db.table_changed(table.name)
+        utils.message_details_dialog(msg, details, type=gtk.MESSAGE_ERROR)
+
+    def _import_sequential(self, connection, tables, progress, loaded):
+        """
+        Load tables, a list of (table, filename) in the order they are
+        loaded, one after the other on connection.  A generator yielding
+        after each batch of rows.
+        """
+        loader = get_bulk_loader(connection)
+        loader.setup()
+        try:
+            for table, filename in tables:
+                if self.__cancel or self.__error:
+                    break
+                msg = _('importing %(table)s table from %(filename)s') \
+                    % {'table': table.name, 'filename': filename}
+                bauble.task.set_message(msg)
+                yield  # allow progress bar update
+                for step in self._import_table(connection, loader, table,
+                                               filename, progress):
+                    yield
+                loaded.append(table)
+        finally:
+            loader.teardown()
+
+    def _import_parallel(self, bind, tables, progress, loaded, workers):
+        """
+        Load tables, a list of (table, filename), with workers threads
+        each using a connection of its own; a table is loaded as soon as
+        the tables it refers to are.  A generator yielding while the
+        threads run.
+        """
+        filenames = dict(tables)
+        scheduler = ImportScheduler([table for table, filename in tables],
+                                    independent=self.__deferred)
+        errors = []
+
+        def work():
+            connection = bind.connect()
+            loader = get_bulk_loader(connection)
+            loader.setup()
+            try:
+                table = scheduler.next()
+                while table is not None:
+                    if self.__cancel or errors:
+                        break
+                    for step in self._import_table(connection, loader, table,
+                                                   filenames[table],
+                                                   progress):
+                        while self.__pause and not self.__cancel:
+                            time.sleep(0.1)
+                    loaded.append(table)
+                    scheduler.finish(table)
+                    table = scheduler.next()
+            except Exception, e:
+                logger.error(e)
+                logger.error(traceback.format_exc())
+                errors.append(e)
+                scheduler.stop()
+            finally:
+                loader.teardown()
+                connection.close()
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        running = None
+        try:
+            alive = threads
+            while alive:
+                alive[0].join(0.1)
+                if running != scheduler.running:
+                    running = list(scheduler.running)
+                    if running:
+                        bauble.task.set_message(
+                            _('importing %s') % ', '.join(
+                                table.name for table in running))
+                yield  # allow progress bar update
+                alive = [thread for thread in threads if thread.is_alive()]
+        finally:
+            if alive:
+                # the import was closed, let the threads roll back
+                self.__cancel = True
+                scheduler.stop()
+                for thread in alive:
+                    thread.join()
+        if errors:
+            raise errors[0]
+
+    def _import_table(self, connection, loader, table, filename, progress):
+        """
+        Load the rows of filename in table, in a transaction of its own
+        on connection.  A generator yielding after each batch of rows.
+
+        :param progress: a dict of filename to the bytes read, updated
+          after each batch
+        """
+        transaction = connection.begin()
+        f = open(filename, "rb")
+        try:
+            reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
+                                   quoting=QUOTE_STYLE)
+
+            try:
+                first_line = reader.next()
+            except StopIteration:
+                # no rows, the table was created empty
+                logger.debug('%s: no rows in %s' % (table.name, filename))
+                progress[filename] = os.path.getsize(filename)
+                transaction.commit()
+                return
+
+            # the column keys to precompile our insert statement
+            csv_columns = set(reader.reader.fieldnames)
+
+            # precompute the defaults...this assumes that the default
+            # function doesn't depend on state after each row...it
+            # shouldn't anyways since we do an insert many instead of
+            # each row at a time
+            defaults = {}
+            for column in table.c:
+                if isinstance(column.default, ColumnDefault):
+                    defaults[column.name] = column.default.execute()
+
+            # check if there are any foreign keys to on the table that
+            # refer to itself, if so the rows are inserted without them
+            # and the keys are set once all the rows exist, so that we
+            # don't get errors about importing values into a foreign_key
+            # that don't reference an existing row, without sorting the
+            # file first
+            key_pairs = [(k.parent.name, k.column.name)
+                         for k in table.foreign_keys
+                         if k.column.table == table
+                         and not self.__deferred]
+            self_references = dict((pair, []) for pair in key_pairs)
+
+            # the column keys for the insert are a union of the columns
+            # in the CSV file and the columns with defaults, the columns
+            # of the file the table doesn't have are ignored
+            ignored = sorted(key for key in csv_columns if key not in table.c)
+            if ignored:
+                logger.warning('%s: ignoring the columns %s of %s' % (
+                    table.name, ', '.join(ignored), filename))
+            column_keys = [key for key in csv_columns.union(defaults.keys())
+                           if key in table.c]
+            loader.prepare(table, column_keys)
+            build_row = get_row_builder(table, column_keys, defaults)
+
+            values = []
+
+            def do_insert():
+                if values:
+                    loader.load(values)
+                del values[:]
+                progress[filename] = f.tell()
+
+            for line in itertools.chain([first_line], reader):
+                while self.__pause:
+                    yield
+                if self.__cancel or self.__error:
+                    break
+
+                line = build_row(line)
+                for (parent, child), pairs in self_references.iteritems():
+                    if line.get(parent) is not None:
+                        pairs.append({'_parent': line[parent],
+                                      '_child': line[child]})
+                        line[parent] = None
+                values.append(line)
+                if len(values) >= loader.batch_size:
+                    do_insert()
+                    yield
+
+            if not (self.__error or self.__cancel):
+                # insert the remainder that were less than a batch
+                do_insert()
+                progress[filename] = os.path.getsize(filename)
+
+                # set the self references now that all the rows exist
+                for (parent, child), pairs in self_references.iteritems():
+                    update = table.update().\
+                        where(table.c[child] == bindparam('_child')).\
+                        values({parent: bindparam('_parent')})
+                    for i in range(0, len(pairs), 1000):
+                        connection.execute(update, pairs[i:i + 1000])
+
+            # we have commit after each table is imported or Postgres
+            # will complain if two tables that are being imported have a
+            # foreign key relationship
+            transaction.commit()
+            logger.debug('%s: %s' % (
+                table.name,
+                connection.execute(
+                    table.select().alias().count()).fetchone()[0]))
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            f.close()
+
     def _get_filenames(self):
         def on_selection_changed(filechooser, data=None):
             """
@@ -684,6 +1103,25 @@ class CSVImportCommandHandler(pluginmgr.CommandHandler):
         importer.start(arg)
 
 
+class ResetSequencesCommandHandler(pluginmgr.CommandHandler):
+    """
+    :resetsequences sets the sequences of all the tables for the next
+    available id, e.g. after rows were inserted with explicit ids
+    """
+
+    command = 'resetsequences'
+
+    def __call__(self, cmd, arg):
+        try:
+            count = utils.reset_sequences()
+        except Exception, e:
+            utils.message_details_dialog(
+                utils.xml_safe(_('Could not reset the sequences.')),
+                traceback.format_exc(), type=gtk.MESSAGE_ERROR)
+            return
+        utils.message_dialog(_('%s sequences were reset.') % count)
+
+
 class CSVExportCommandHandler(pluginmgr.CommandHandler):
 
     command = 'excsv'
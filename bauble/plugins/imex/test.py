@@ -26,9 +26,12 @@ import os
 import shutil
 import tempfile
 
-from sqlalchemy import Column, Integer, Boolean
+from nose import SkipTest
+from sqlalchemy import Column, Integer, Boolean, select
 
 import bauble.db as db
+import bauble.search as search
+import bauble.search_index as search_index
 from bauble.plugins.plants import (
     Familia, Family, Genus, Species, VernacularName)
 from bauble.plugins.garden import Accession, Location, Plant
@@ -36,6 +39,7 @@ import bauble.plugins.garden.test as garden_test
 import bauble.plugins.plants.test as plants_test
 from bauble.plugins.imex.csv_ import CSVImporter, CSVExporter, QUOTE_CHAR, \
     QUOTE_STYLE
+import bauble.plugins.imex.csv_ as csv_
 from bauble.plugins.imex.iojson import JSONImporter, JSONExporter
 from bauble.test import BaubleTestCase
 import json
@@ -179,6 +183,88 @@ class CSVTests(ImexTestCase):
         self.assert_(t.col1 is False)
         table.drop(bind=db.engine)
 
+    def test_import_in_batches(self):
+        """
+        Test that the rows are all imported when they span several
+        batches of the bulk loader.
+        """
+        data = [{'id': i, 'family': u'Family%s' % i} for i in range(1, 26)]
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        format = {'delimiter': ',', 'quoting': QUOTE_STYLE,
+                  'quotechar': QUOTE_CHAR}
+        fields = data[0].keys()
+        f.write('%s\n' % ','.join(fields))
+        writer = csv.DictWriter(f, fields, **format)
+        writer.writerows(data)
+        f.flush()
+        f.close()
+        loaders = (csv_.BulkLoader, csv_.SQLiteBulkLoader,
+                   csv_.PostgreSQLBulkLoader)
+        sizes = [loader.__dict__['batch_size'] for loader in loaders]
+        try:
+            for loader in loaders:
+                loader.batch_size = 10
+            importer = TestImporter()
+            importer.start([filename], force=True)
+        finally:
+            for loader, size in zip(loaders, sizes):
+                loader.batch_size = size
+        self.session.expunge_all()
+        families = self.session.query(Family).order_by(Family.id).all()
+        self.assertEquals([f.family for f in families],
+                          [d['family'] for d in data])
+        self.assert_(all(f.qualifier == '' for f in families))
+
+    def test_import_unknown_columns(self):
+        """
+        Test that the columns of the file the table doesn't have are
+        ignored.
+        """
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        f.write('id,family,not_a_column\n1,Orchidaceae,x\n')
+        f.close()
+        importer = TestImporter()
+        importer.start([filename], force=True)
+        self.session.expunge_all()
+        family = self.session.query(Family).one()
+        self.assertEquals(family.family, u'Orchidaceae')
+        connection = db.engine.connect()
+        try:
+            loader = csv_.get_bulk_loader(connection)
+            loader.prepare(Family.__table__, ['id', 'not_a_column'])
+            self.assertEquals(loader.column_keys, ['id'])
+        finally:
+            connection.close()
+
+    def test_import_rebuilds_search_index(self):
+        """
+        Test that the full-text index of the imported tables is rebuilt,
+        the imported rows don't go through the mappers.
+        """
+        try:
+            search_index.create_index()
+        except Exception, e:
+            raise SkipTest('no full-text support: %s' % e)
+        try:
+            filename = os.path.join(self.path, 'family.txt')
+            f = open(filename, 'wb')
+            f.write('id,family\n1,Bromeliaceae\n')
+            f.close()
+            importer = TestImporter()
+            importer.start([filename], force=True)
+            self.session.expunge_all()
+            mapper_search = search.get_strategy('MapperSearch')
+            results = mapper_search.search('bromel', self.session)
+            self.assertEquals([r.family for r in results
+                               if isinstance(r, Family)], [u'Bromeliaceae'])
+            results = mapper_search.search('orchid', self.session)
+            self.assertEquals([r for r in results if isinstance(r, Family)],
+                              [])
+        finally:
+            search_index.drop_index()
+
     def test_with_open_connection(self):
         """
         Test that the import doesn't stall if we have a connection
@@ -309,6 +395,229 @@ class CSVTests(ImexTestCase):
         self.assert_(row['cv_group'] == '')
 
 
+class ImportSchedulerTests(BaubleTestCase):
+
+    def test_parents_first(self):
+        """
+        Test that a table is handed out once the tables it refers to
+        are loaded and that the unrelated tables don't wait.
+        """
+        tables = [db.metadata.tables[name] for name in
+                  ('family', 'genus', 'geography')]
+        family, genus, geography = tables
+        scheduler = csv_.ImportScheduler(tables)
+        self.assertEquals(csv_.get_parent_tables(tables),
+                          {family: set(), genus: set([family]),
+                           geography: set()})
+        self.assertEquals(scheduler.next(), family)
+        self.assertEquals(scheduler.next(), geography)
+        scheduler.finish(geography)
+        scheduler.finish(family)
+        self.assertEquals(scheduler.next(), genus)
+        scheduler.finish(genus)
+        self.assertEquals(scheduler.next(), None)
+
+    def test_stop(self):
+        """
+        Test that a stopped scheduler hands out no more tables.
+        """
+        scheduler = csv_.ImportScheduler([db.metadata.tables['family']])
+        scheduler.stop()
+        self.assertEquals(scheduler.next(), None)
+
+
+class StubConnection(object):
+    """
+    A connection recording the statements instead of executing them.
+    """
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def connect(self):
+        return self
+
+    def begin(self):
+        return self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def execute(self, statement, *args):
+        self.statements.append(statement)
+        return self
+
+    def fetchone(self):
+        return [0]
+
+
+class CopyLoaderTests(BaubleTestCase):
+
+    def test_copy_empty_string(self):
+        """
+        Test that the PostgreSQL loader sends an empty string and None
+        as different values, COPY reads only the latter as NULL.
+        """
+        from sqlalchemy import MetaData, Table, Unicode
+        metadata = MetaData()
+        table = Table('test_copy', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('name', Unicode(10)))
+        rows = [{'id': 1, 'name': u''}, {'id': 2, 'name': None},
+                {'id': 3, 'name': u'a "b"'}]
+        copied = []
+
+        class StubCursor(object):
+            def copy_expert(self, sql, data):
+                copied.append(data.read())
+
+            def close(self):
+                pass
+
+        class StubConnection(object):
+            dialect = db.engine.dialect
+
+            def __init__(self):
+                self.connection = self
+
+            def cursor(self):
+                return StubCursor()
+
+        loader = csv_.PostgreSQLBulkLoader(StubConnection())
+        loader.prepare(table, ['id', 'name'])
+        loader.load(rows)
+        self.assertEquals(copied, ['"1",""\n"2",\n"3","a ""b"""\n'])
+
+        if db.engine.name not in ('postgres', 'postgresql'):
+            return
+        # the round trip through the server
+        connection = db.engine.connect()
+        table.create(bind=connection)
+        try:
+            loader = csv_.PostgreSQLBulkLoader(connection)
+            loader.prepare(table, ['id', 'name'])
+            loader.load(rows)
+            names = [row[0] for row in connection.execute(
+                select([table.c.name]).order_by(table.c.id))]
+            self.assertEquals(names, [u'', None, u'a "b"'])
+        finally:
+            table.drop(bind=connection)
+            connection.close()
+
+
+class ImportParallelTests(BaubleTestCase):
+
+    def test_import_parallel(self):
+        """
+        Test that the threads of the parallel import load every table
+        after the tables it refers to, and skip the files with no rows.
+        """
+        path = tempfile.mkdtemp()
+        files = {'family': 'id,family\n1,Orchidaceae\n2,Rosaceae\n',
+                 'genus': 'id,genus,family_id\n1,Rosa,2\n',
+                 'geography': 'id,name\n'}
+        tables = []
+        for name in ('family', 'genus', 'geography'):
+            filename = os.path.join(path, '%s.txt' % name)
+            f = open(filename, 'wb')
+            f.write(files[name])
+            f.close()
+            tables.append((db.metadata.tables[name], filename))
+        loads = []
+
+        class StubLoader(csv_.BulkLoader):
+            batch_size = 1
+
+            def prepare(self, table, column_keys):
+                self.table = table
+                self.column_keys = column_keys
+
+            def load(self, rows):
+                loads.append((self.table.name, [row['id'] for row in rows]))
+
+        get_bulk_loader = csv_.get_bulk_loader
+        csv_.get_bulk_loader = StubLoader
+        try:
+            importer = TestImporter()
+            loaded = []
+            progress = {}
+            for step in importer._import_parallel(StubConnection([]), tables,
+                                                  progress, loaded, 2):
+                pass
+        finally:
+            csv_.get_bulk_loader = get_bulk_loader
+            shutil.rmtree(path)
+        family, genus, geography = [table for table, filename in tables]
+        self.assertEquals(set(loaded), set([family, genus, geography]))
+        self.assert_(loaded.index(family) < loaded.index(genus))
+        self.assertEquals(sorted(loads), [('family', [u'1']),
+                                          ('family', [u'2']),
+                                          ('genus', [u'1'])])
+        self.assertEquals(sorted(progress.values()),
+                          sorted(len(data) for data in files.values()))
+
+
+class DeferredConstraintsTests(BaubleTestCase):
+
+    def test_bare_table(self):
+        """
+        Test that the bare copy of a table keeps its columns and primary
+        key but not its foreign keys, unique constraints and indexes.
+        """
+        genus = db.metadata.tables['genus']
+        bare = csv_.get_bare_table(genus)
+        self.assertEquals(bare.c.keys(), genus.c.keys())
+        self.assertEquals([c.name for c in bare.primary_key],
+                          [c.name for c in genus.primary_key])
+        self.assert_(bare.metadata is not db.metadata)
+        self.assertEquals(len(bare.foreign_keys), 0)
+        self.assertEquals(len(bare.indexes), 0)
+        self.assertEquals(len(bare.constraints), 1)
+        self.assert_(len(genus.indexes) > 0)
+        self.assert_(len(genus.foreign_keys) > 0)
+
+    def test_restore_tables(self):
+        """
+        Test that the bare tables of a failed deferred import are
+        emptied and created again with their full schema.
+        """
+        from sqlalchemy import MetaData, Table, Unicode
+        from sqlalchemy.engine.reflection import Inspector
+        import bauble.utils as utils
+        metadata = MetaData()
+        table = Table('test_restore', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('name', Unicode(10), index=True))
+        csv_.get_bare_table(table).create(bind=db.engine)
+        db.engine.execute(table.insert(), id=1, name=u'x')
+        messages = []
+        message_details_dialog = utils.message_details_dialog
+        utils.message_details_dialog = \
+            lambda msg, details, type=None: messages.append(msg)
+        connection = db.engine.connect()
+        try:
+            TestImporter()._restore_tables(connection, metadata, [table],
+                                           set(), 'details')
+            self.assertEquals(connection.execute(
+                table.count()).scalar(), 0)
+            indexes = Inspector.from_engine(db.engine).get_indexes(
+                'test_restore')
+            self.assertEquals([i['column_names'] for i in indexes],
+                              [['name']])
+            self.assertEquals(len(messages), 1)
+            self.assert_('test_restore' in messages[0])
+        finally:
+            utils.message_details_dialog = message_details_dialog
+            connection.close()
+            table.drop(bind=db.engine)
+
+
 class CSVTests2(ImexTestCase):
 
     def test_sequences(self):
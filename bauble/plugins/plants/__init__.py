@@ -35,6 +35,8 @@
 import os
 import sys
 
+from sqlalchemy.orm import joinedload, joinedload_all, subqueryload
+
 import bauble
 import bauble.db as db
 import bauble.paths as paths
@@ -80,7 +82,8 @@ class PlantsPlugin(pluginmgr.Plugin):
                                         context_menu=family_context_menu,
                                         markup_func=family_markup_func)
 
-        mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'])
+        mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'],
+                               load_options=[joinedload('family')])
         SearchView.row_meta[Genus].set(children="species",
                                        infobox=GenusInfoBox,
                                        context_menu=genus_context_menu,
@@ -90,15 +93,18 @@ class PlantsPlugin(pluginmgr.Plugin):
         search.add_strategy(SynonymSearch)
         mapper_search.add_meta(('species', 'sp'), Species,
                                ['sp', 'sp2', 'infrasp1', 'infrasp2',
-                                'infrasp3', 'infrasp4'])
+                                'infrasp3', 'infrasp4'],
+                               load_options=[joinedload_all('genus.family')])
         SearchView.row_meta[Species].set(
             children=partial(db.natsort, 'accessions'),
             infobox=SpeciesInfoBox,
             context_menu=species_context_menu,
-            markup_func=species_markup_func)
+            markup_func=species_markup_func,
+            load_options=[subqueryload('vernacular_names')])
 
         mapper_search.add_meta(('vernacular', 'vern', 'common'),
-                               VernacularName, ['name'])
+                               VernacularName, ['name'],
+                               load_options=[joinedload_all('species.genus')])
         SearchView.row_meta[VernacularName].set(
             children=partial(db.natsort, 'species.accessions'),
             infobox=VernacularNameInfoBox,
@@ -137,5 +143,8 @@ class PlantsPlugin(pluginmgr.Plugin):
         #import_exc = None
         csv.start(filenames, metadata=db.metadata, force=True)
 
+        from bauble.plugins.plants.geography import update_closure
+        update_closure()
+
 
 plugin = PlantsPlugin
@@ -118,7 +118,7 @@ def family_markup_func(family):
 #
 # Family
 #
-class Family(db.Base, db.Serializable):
+class Family(db.Base, db.Serializable, db.NaturallySorted):
     """
     :Table name: family
 
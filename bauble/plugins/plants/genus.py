@@ -127,7 +127,7 @@ def genus_markup_func(genus):
     return utils.xml_safe(genus), utils.xml_safe(genus.family)
 
 
-class Genus(db.Base, db.Serializable):
+class Genus(db.Base, db.Serializable, db.NaturallySorted):
     """
     :Table name: genus
 
@@ -238,6 +238,10 @@ class Genus(db.Base, db.Serializable):
     def __repr__(self):
         return Genus.str(self)
 
+    def sort_dependents(self):
+        # the string of a species starts with the string of its genus
+        return self.species
+
     @staticmethod
     def str(genus, author=False):
         # TODO: the genus should be italicized for markup
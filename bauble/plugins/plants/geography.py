@@ -21,46 +21,125 @@
 # geography.py
 #
 from operator import itemgetter
+import threading
 
 import gtk
 
+import sqlalchemy as sa
 from sqlalchemy import select, Column, Unicode, String, Integer, ForeignKey
 from sqlalchemy.orm import object_session, relation, backref
 
 import bauble.db as db
 
+CLOSURE_KEY = u'geography_closure'
+
+_closure_snapshot = None  # db.get_generations() at the last check
+_closure_lock = threading.Lock()  # the searches can run in threads
+
 
 def get_species_in_geography(geo):
     """
-    Return all the Species that have distribution in geo
+    Return all the Species that have distribution in geo or in any of
+    the geographies it contains, with a single join on the closure table.
     """
     session = object_session(geo)
     if not session:
         ValueError('get_species_in_geography(): geography is not in a session')
 
-    # get all the geography children under geo
     from bauble.plugins.plants.species_model import SpeciesDistribution, \
         Species
-    # get the children of geo
-    geo_table = geo.__table__
-    master_ids = set([geo.id])
-    # populate master_ids with all the geography ids that represent
-    # the children of particular geography id
-
-    def get_geography_children(parent_id):
-        stmt = select([geo_table.c.id], geo_table.c.parent_id == parent_id)
-        kids = [r[0] for r in db.engine.execute(stmt).fetchall()]
-        for kid in kids:
-            grand_kids = get_geography_children(kid)
-            master_ids.update(grand_kids)
-        return kids
-    geokids = get_geography_children(geo.id)
-    master_ids.update(geokids)
+    update_closure()
     q = session.query(Species).join(SpeciesDistribution).\
-        filter(SpeciesDistribution.geography_id.in_(master_ids))
+        join((closure_table, SpeciesDistribution.geography_id ==
+              closure_table.c.descendant_id)).\
+        filter(closure_table.c.ancestor_id == geo.id).\
+        order_by(Species.id).distinct()
     return list(q)
 
 
+def _get_signature(connection):
+    """
+    Return a string that changes whenever the geography tree changes.
+    """
+    geo_table = Geography.__table__
+    row = connection.execute(select([
+        sa.func.count(geo_table.c.id), sa.func.max(geo_table.c.id),
+        sa.func.sum(sa.func.coalesce(geo_table.c.parent_id, 0)),
+        sa.func.max(geo_table.c._last_updated)])).fetchone()
+    return u':'.join(unicode(value) for value in row)
+
+
+def rebuild_closure(connection):
+    """
+    Fill the geography_closure table with a row for each pair of a
+    geography and one of the geographies it contains, itself included,
+    computed from the parent_id column in one pass.
+    """
+    geo_table = Geography.__table__
+    parents = dict(connection.execute(
+        select([geo_table.c.id, geo_table.c.parent_id])).fetchall())
+    rows = []
+    for geo_id in parents:
+        ancestor_id, depth = geo_id, 0
+        while ancestor_id is not None and depth <= len(parents):
+            rows.append({'ancestor_id': ancestor_id,
+                         'descendant_id': geo_id, 'depth': depth})
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    connection.execute(closure_table.delete())
+    for i in range(0, len(rows), 1000):
+        connection.execute(closure_table.insert(), rows[i:i + 1000])
+    db.table_changed(closure_table.name)
+
+
+def update_closure(engine=None):
+    """
+    Rebuild the geography_closure table if the geography tree changed
+    since it was last built, as recorded in the bauble meta table.
+
+    Within the process the tree is only checked again after a change
+    of the geography table, like the ones made by the importers.  This
+    is called through :func:`bauble.db.refresh_derived_tables` by the
+    searches using the closure table and after the imports.
+    """
+    with _closure_lock:
+        _update_closure(engine)
+
+
+def _update_closure(engine):
+    global _closure_snapshot
+    if _closure_snapshot is not None and \
+            db.unchanged_since(_closure_snapshot, ['geography']):
+        return
+    engine = engine or db.engine
+    import bauble.meta as meta
+    meta_table = meta.BaubleMeta.__table__
+    snapshot = db.get_generations()
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        closure_table.create(bind=connection, checkfirst=True)
+        signature = _get_signature(connection)
+        stored = connection.execute(
+            select([meta_table.c.value],
+                   meta_table.c.name == CLOSURE_KEY)).scalar()
+        if stored != signature:
+            rebuild_closure(connection)
+            if stored is None:
+                connection.execute(meta_table.insert(), name=CLOSURE_KEY,
+                                   value=signature)
+            else:
+                connection.execute(meta_table.update().where(
+                    meta_table.c.name == CLOSURE_KEY), value=signature)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+    _closure_snapshot = snapshot
+
+
 class GeographyMenu(gtk.Menu):
 
     def __init__(self, callback):
@@ -180,6 +259,20 @@ class Geography(db.Base):
         return self.name
 
 
+# derived from the geography table, without foreign keys so that the
+# importers don't have to drop it with the geography table
+closure_table = sa.Table(
+    'geography_closure', db.metadata,
+    Column('ancestor_id', Integer, primary_key=True, autoincrement=False),
+    Column('descendant_id', Integer, primary_key=True, autoincrement=False,
+           index=True),
+    Column('depth', Integer, nullable=False))
+"""
+The transitive closure of the geography tree, see :func:`update_closure`.
+"""
+db.register_derived_table(closure_table.name, update_closure, ['geography'])
+
+
 # late bindings
 Geography.children = relation(
     Geography,
@@ -188,3 +281,21 @@ Geography.children = relation(
     backref=backref("parent",
                     remote_side=[Geography.__table__.c.id]),
     order_by=[Geography.name])
+
+# the geographies containing a geography and the ones it contains, both
+# including the geography itself, e.g. for searching
+# 'species where distribution.geography.ancestors.name=Mexico'
+Geography.ancestors = relation(
+    Geography, secondary=closure_table,
+    primaryjoin=Geography.id == closure_table.c.descendant_id,
+    secondaryjoin=Geography.id == closure_table.c.ancestor_id,
+    foreign_keys=[closure_table.c.ancestor_id,
+                  closure_table.c.descendant_id],
+    viewonly=True)
+Geography.descendants = relation(
+    Geography, secondary=closure_table,
+    primaryjoin=Geography.id == closure_table.c.ancestor_id,
+    secondaryjoin=Geography.id == closure_table.c.descendant_id,
+    foreign_keys=[closure_table.c.ancestor_id,
+                  closure_table.c.descendant_id],
+    viewonly=True)
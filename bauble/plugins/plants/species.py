@@ -149,6 +149,29 @@ from bauble.view import InfoBox, InfoBoxPage, InfoExpander, \
     select_in_search_results
 
 
+def get_accepted(session, cls, synonym_cls, accepted_col, synonym_ids,
+                 chunk_size=500):
+    """
+    Return the objects of type cls that have any of synonym_ids as a
+    synonym, using one query per chunk of synonym_ids.
+
+    :param cls: the mapped class, e.g. Species
+    :param synonym_cls: the association class, e.g. SpeciesSynonym
+    :param accepted_col: the column of synonym_cls referring to the
+      accepted object, e.g. SpeciesSynonym.species_id
+    :param synonym_ids: the ids of the synonyms
+    """
+    synonym_ids = list(synonym_ids)
+    results = []
+    for i in range(0, len(synonym_ids), chunk_size):
+        chunk = synonym_ids[i:i + chunk_size]
+        query = session.query(cls).\
+            join(synonym_cls, accepted_col == cls.id).\
+            filter(synonym_cls.synonym_id.in_(chunk))
+        results.extend(query.distinct())
+    return results
+
+
 class SynonymSearch(search.SearchStrategy):
     """
     Return any synonyms for matching species.
@@ -156,6 +179,7 @@ class SynonymSearch(search.SearchStrategy):
     This can by setting bauble.search.return_synonyms in the prefs to False.
     """
     return_synonyms_pref = 'bauble.search.return_synonyms'
+    base_strategy = 'MapperSearch'
 
     def __init__(self):
         super(SynonymSearch, self).__init__()
@@ -163,33 +187,43 @@ class SynonymSearch(search.SearchStrategy):
             prefs[self.return_synonyms_pref] = True
             prefs.save()
 
-    def search(self, text, session):
+    def search(self, text, session, base_results=None):
+        """
+        :param base_results: the results of MapperSearch for text, if
+          None then MapperSearch is run again.
+        """
         from genus import Genus, GenusSynonym
         super(SynonymSearch, self).search(text, session)
         if not prefs[self.return_synonyms_pref]:
-            return
-        mapper_search = search.get_strategy('MapperSearch')
-        r1 = mapper_search.search(text, session)
+            return []
+        r1 = base_results
+        if r1 is None:
+            mapper_search = search.get_strategy('MapperSearch')
+            r1 = mapper_search.search(text, session)
         if not r1:
             return []
-        results = []
+        # collect the ids of the matching species and genera, vernacular
+        # names stand for their species
+        species_ids = set()
+        genus_ids = set()
         for result in r1:
-            # iterate through the results and see if we can find some
-            # synonyms for the returned values
             if isinstance(result, Species):
-                q = session.query(SpeciesSynonym).\
-                    filter_by(synonym_id=result.id)
-                results.extend([syn.species for syn in q])
+                species_ids.add(result.id)
             elif isinstance(result, Genus):
-                q = session.query(GenusSynonym).\
-                    filter_by(synonym_id=result.id)
-                results.extend([syn.genus for syn in q])
-            elif isinstance(results, VernacularName):
-                q = session.query(SpeciesSynonym).\
-                    filter_by(synonym_id=result.species.id)
-                results.extend([syn.species for syn in q])
+                genus_ids.add(result.id)
+            elif isinstance(result, VernacularName):
+                species_ids.add(result.species_id)
+        results = get_accepted(session, Species, SpeciesSynonym,
+                               SpeciesSynonym.species_id, species_ids)
+        results.extend(get_accepted(session, Genus, GenusSynonym,
+                                    GenusSynonym.genus_id, genus_ids))
         return results
 
+    def get_tables(self, text, session=None):
+        mapper_search = search.get_strategy('MapperSearch')
+        tables = mapper_search.get_tables(text, session)
+        return sorted(set(tables) | set(['species_synonym', 'genus_synonym']))
+
 
 #
 # Species infobox for SearchView
@@ -71,7 +71,8 @@ infrasp_rank_values = {u'subsp.': _('subsp.'),
 # make sure that at least one of the specific epithet, cultivar name
 # or cultivar group is specificed
 
-class Species(db.Base, db.Serializable, db.DefiningPictures):
+class Species(db.Base, db.Serializable, db.DefiningPictures,
+              db.NaturallySorted):
     """
     :Table name: species
 
@@ -32,7 +32,7 @@ import bauble.utils as utils
 import bauble.db as db
 from bauble.plugins.plants.species import (
     Species, VernacularName, SpeciesSynonym, edit_species,
-    DefaultVernacularName, SpeciesDistribution, SpeciesNote)
+    DefaultVernacularName, SpeciesDistribution, SpeciesNote, SynonymSearch)
 from bauble.plugins.plants.family import (
     Family, FamilySynonym, FamilyEditor, FamilyNote)
 from bauble.plugins.plants.genus import \
@@ -692,6 +692,16 @@ class GenusSynonymyTests(PlantTestCase):
         self.assertEquals(len(bu.synonyms), 2)
         self.assertTrue(he in bu.synonyms)
 
+    def test_synonym_search_returns_accepted(self):
+        bu = self.session.query(
+            Genus).filter(
+            Genus.genus == u'Bulbophyllum').one()
+        zy = self.session.query(
+            Genus).filter(
+            Genus.genus == u'Zygoglossum').one()
+        results = SynonymSearch().search(u'Zygoglossum', self.session, [zy])
+        self.assertEquals(results, [bu])
+
     def test_can_redefine_accepted(self):
         # Altamiranoa Rose used to refer to Villadia Rose for its accepted
         # name, it is now updated to Sedum L.
@@ -960,6 +970,16 @@ class SpeciesTests(PlantTestCase):
 
         self.session.expunge_all()
 
+    def test_synonym_search_species_and_vernacular(self):
+        "synonyms are resolved for species and vernacular names"
+        sp1 = self.session.query(Species).get(1)
+        sp2 = self.session.query(Species).get(2)
+        vn = self.session.query(VernacularName).get(1)
+        strategy = SynonymSearch()
+        self.assertEquals(strategy.search(u'', self.session, [sp1]), [sp2])
+        self.assertEquals(strategy.search(u'', self.session, [vn]), [sp2])
+        self.assertEquals(strategy.search(u'', self.session, [sp2]), [])
+
 
 class GeographyTests(PlantTestCase):
 
@@ -1018,6 +1038,61 @@ class GeographyTests(PlantTestCase):
         species = get_species_in_geography(north_america)
         self.assert_([s.id for s in species] == [sp1.id, sp2.id, sp3.id])
 
+        # the closure table backs the ancestors relation in the queries
+        import bauble.search as search
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search(
+            'species where distribution.geography.ancestors.id=%s'
+            % mexico_id, self.session)
+        self.assertEquals(results, set([sp1, sp2]))
+        self.assertEquals(set(g.id for g in oaxaca.ancestors),
+                          set([oaxaca_id, oaxaca.parent_id, mexico_id,
+                               northern_america_id]))
+
+        # the closure table follows the changes of the tree
+        oaxaca.parent_id = western_canada_id
+        self.session.commit()
+        species = get_species_in_geography(mexico)
+        self.assertEquals([s.id for s in species], [sp1.id])
+
+    def test_closure_kept_fresh(self):
+        "the searches and the imports bring the closure table up to date"
+        import bauble.paths as paths
+        import bauble.search as search
+        import bauble.plugins.plants.geography as geography
+        # a database created before the closure table
+        geography.closure_table.drop(bind=db.engine)
+        geography._closure_snapshot = None
+        filename = os.path.join(paths.lib_dir(), "plugins", "plants",
+                                "default", 'geography.txt')
+        from bauble.plugins.imex.csv_ import CSVImporter
+        importer = CSVImporter()
+        importer.start([filename], force=True)
+        # the import built the closure table
+        self.assertTrue(db.engine.execute(
+            geography.closure_table.count()).scalar() > 0)
+
+        mexico_id = 53
+        oaxaca_id = 665
+        western_canada_id = 45
+        sp = Species(genus=self.genus, sp=u'sp')
+        sp.distribution.append(SpeciesDistribution(geography_id=oaxaca_id))
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+        text = 'species where distribution.geography.ancestors.id=%s'
+        results = mapper_search.search(text % mexico_id, self.session)
+        self.assertEquals(results, set([sp]))
+
+        # the search sees the changes of the tree
+        oaxaca = self.session.query(Geography).get(oaxaca_id)
+        oaxaca.parent_id = western_canada_id
+        self.session.commit()
+        results = mapper_search.search(text % mexico_id, self.session)
+        self.assertEquals(results, set())
+        results = mapper_search.search(text % western_canada_id,
+                                       self.session)
+        self.assertEquals(results, set([sp]))
+
 
 # TODO: maybe the following could be in a seperate file called
 # profile.py or something that would profile everything in the plants
@@ -504,7 +504,7 @@ class XSLFormatterPlugin(FormatterPlugin):
         adapted = []
         if source_type == plant_source_type:
             plants = sorted(get_plants_pertinent_to(objs, session=session),
-                            key=utils.natsort_key)
+                            key=db.sort_key)
             if len(plants) == 0:
                 utils.message_dialog(_('There are no plants in the search '
                                        'results.  Please try another search.'))
@@ -516,7 +516,7 @@ class XSLFormatterPlugin(FormatterPlugin):
                     adapted.append(PlantABCDAdapter(p, for_labels=True))
         elif source_type == species_source_type:
             species = sorted(get_species_pertinent_to(objs, session=session),
-                             key=utils.natsort_key)
+                             key=db.sort_key)
             if len(species) == 0:
                 utils.message_dialog(_('There are no species in the search '
                                        'results.  Please try another search.'))
@@ -526,7 +526,7 @@ class XSLFormatterPlugin(FormatterPlugin):
         elif source_type == accession_source_type:
             accessions = sorted(get_accessions_pertinent_to(objs,
                                                             session=session),
-                                key=utils.natsort_key)
+                                key=db.sort_key)
             if len(accessions) == 0:
                 utils.message_dialog(_('There are no accessions in the search '
                                        'results.  Please try another search.'))
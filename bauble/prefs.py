@@ -100,6 +100,45 @@ The preferences key for the default units for Bauble.
 Values: metric, imperial
 """
 
+search_cache_size_pref = 'bauble.search.parse_cache_size'
+"""
+The preferences key for the number of parsed search strings that are
+kept in memory, so that repeated searches are not parsed again.  Set it
+to 0 to disable the cache.
+"""
+
+search_packrat_pref = 'bauble.search.packrat'
+"""
+The preferences key for enabling the packrat optimization of the search
+language parser.  Once enabled it stays on until Bauble is restarted.
+
+Values: True, False
+"""
+
+search_as_you_type_pref = 'bauble.search.as_you_type'
+"""
+The preferences key for searching while the search string is typed in
+the main entry, without waiting for the search button to be clicked.
+
+Values: True, False
+"""
+
+search_as_you_type_delay_pref = 'bauble.search.as_you_type_delay'
+"""
+The preferences key for the number of milliseconds the main entry has
+to stay unchanged before searching as you type.
+"""
+
+import_defer_constraints_pref = 'bauble.import.defer_constraints'
+"""
+The preferences key for creating the indexes and constraints of the
+tables imported from CSV files once their rows are loaded, rather than
+before, which loads much faster on PostgreSQL.  It has no effect on
+SQLite.
+
+Values: True, False
+"""
+
 
 from ConfigParser import RawConfigParser
 
@@ -153,6 +192,15 @@ class _prefs(dict):
         if units_pref not in self:
             self[units_pref] = 'metric'
 
+        if search_cache_size_pref not in self:
+            self[search_cache_size_pref] = 128
+        if search_packrat_pref not in self:
+            self[search_packrat_pref] = False
+        if search_as_you_type_pref not in self:
+            self[search_as_you_type_pref] = False
+        if search_as_you_type_delay_pref not in self:
+            self[search_as_you_type_delay_pref] = 300
+
     @staticmethod
     def _parse_key(name):
         index = name.rfind(".")
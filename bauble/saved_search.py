@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+"""
+Saved searches, materialised in the database.
+
+A saved search is a named search string of the query language of
+:class:`bauble.search.MapperSearch`.  Its results are kept as (table
+name, id) rows of the saved_search_result table, so that opening it is
+an indexed lookup rather than running the query again.
+
+The results are refreshed incrementally from the rows added to the
+history table since the last refresh: when only the table of the
+searched objects changed, the query is only run again for the changed
+rows, when one of the joined tables changed it is run again in full.
+The changes that bypass the mappers, like the imports, don't write to
+the history table; saving the search again recomputes its results.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sqlalchemy as sa
+from sqlalchemy import Column, Unicode, UnicodeText, Integer
+from sqlalchemy.sql.util import find_tables
+
+import bauble.db as db
+from bauble.error import check
+from bauble.i18n import _
+import bauble.search as search
+
+
+class SavedSearch(db.Base):
+    """
+    :Table name: saved_search
+
+    :Columns:
+      *name*:
+        The unique name of the saved search.
+
+      *query*:
+        The search string.
+
+      *history_id*:
+        The id of the last row of the history table applied to the
+        results.
+    """
+    __tablename__ = 'saved_search'
+    name = Column(Unicode(64), unique=True, nullable=False)
+    query = Column(UnicodeText, nullable=False)
+    history_id = Column(Integer, nullable=False, default=0)
+
+
+result_table = sa.Table(
+    'saved_search_result', db.metadata,
+    Column('saved_search_id', Integer,
+           sa.ForeignKey('saved_search.id', ondelete='CASCADE'),
+           primary_key=True, autoincrement=False),
+    Column('table_name', sa.String(64), primary_key=True),
+    Column('object_id', Integer, primary_key=True, autoincrement=False))
+
+
+def create_tables(connection):
+    """
+    Create the saved search tables if they don't exist yet, for the
+    databases created before they were introduced.
+    """
+    SavedSearch.__table__.create(bind=connection, checkfirst=True)
+    result_table.create(bind=connection, checkfirst=True)
+
+
+def _get_class(table_name):
+    for cls in db.Base._decl_class_registry.values():
+        if getattr(cls, '__tablename__', None) == table_name:
+            return cls
+    return None
+
+
+def _last_history_id(session):
+    return session.query(sa.func.max(db.History.id)).scalar() or 0
+
+
+def _evaluate(session, text, ids=None):
+    """
+    Return the set of (table name, id) of the results of text.
+
+    :param ids: if not None, a dict of table name to the ids the queries
+      are restricted to, the queries on the other tables are skipped.
+    """
+    mapper_search = search.get_strategy('MapperSearch')
+    statement = mapper_search._parse(text)
+    replace = getattr(statement.content, 'replace_results', False)
+    keys = set()
+    for query in mapper_search.get_queries(statement, session):
+        cls = query.column_descriptions[0]['type']
+        if replace:
+            keys.update((search.replacement(obj).__tablename__,
+                         search.replacement(obj).id) for obj in query)
+            continue
+        if ids is None:
+            keys.update((cls.__tablename__, row[0]) for row in
+                        query.order_by(None).from_self(cls.id))
+            continue
+        changed = list(ids.get(cls.__tablename__, []))
+        for i in range(0, len(changed), 500):
+            chunk = query.order_by(None).filter(cls.id.in_(
+                changed[i:i + 500]))
+            keys.update((cls.__tablename__, row[0])
+                        for row in chunk.from_self(cls.id))
+    return keys
+
+
+def _store(session, saved, keys, ids=None):
+    """
+    Replace the results of saved with keys, only the rows of the ids in
+    ids if it is not None.
+    """
+    table = result_table
+    where = table.c.saved_search_id == saved.id
+    if ids is None:
+        session.execute(table.delete().where(where))
+    else:
+        for table_name, changed in ids.iteritems():
+            changed = list(changed)
+            for i in range(0, len(changed), 500):
+                session.execute(table.delete().where(sa.and_(
+                    where, table.c.table_name == table_name,
+                    table.c.object_id.in_(changed[i:i + 500]))))
+    if keys:
+        session.execute(table.insert(), [
+            {'saved_search_id': saved.id, 'table_name': table_name,
+             'object_id': object_id} for table_name, object_id in keys])
+    db.table_changed(table.name)
+
+
+def save(session, name, text):
+    """
+    Save text as the saved search called name, replacing the saved
+    search with the same name if any, and compute its results.  The
+    session is committed.
+    """
+    create_tables(session.connection())
+    # checks the syntax before anything is written
+    search.get_strategy('MapperSearch')._parse(text)
+    saved = session.query(SavedSearch).filter_by(name=name).first()
+    if saved is None:
+        saved = SavedSearch(name=name)
+        session.add(saved)
+    saved.query = text
+    # the changes made while the results are computed are applied again
+    # by the next refresh, which is harmless
+    saved.history_id = _last_history_id(session)
+    session.flush()
+    _store(session, saved, _evaluate(session, text))
+    session.commit()
+    return saved
+
+
+def remove(session, name):
+    """
+    Remove the saved search called name.  The session is committed.
+    """
+    saved = get(session, name)
+    session.execute(result_table.delete().where(
+        result_table.c.saved_search_id == saved.id))
+    session.delete(saved)
+    session.commit()
+
+
+def get(session, name):
+    """
+    Return the saved search called name.
+    """
+    create_tables(session.connection())
+    saved = session.query(SavedSearch).filter_by(name=name).first()
+    check(saved is not None, _('No saved search called %s') % name)
+    return saved
+
+
+def get_names(session):
+    """
+    Return the sorted names of the saved searches.
+    """
+    create_tables(session.connection())
+    return [row[0] for row in
+            session.query(SavedSearch.name).order_by(SavedSearch.name)]
+
+
+def refresh(session, saved):
+    """
+    Apply to the results of saved the history rows added since its last
+    refresh.  The session is committed.
+    """
+    history = db.History.__table__
+    last = _last_history_id(session)
+    if last <= saved.history_id:
+        return
+    changes = {}
+    for table_name, table_id in session.execute(
+            sa.select([history.c.table_name, history.c.table_id]).where(
+                sa.and_(history.c.id > saved.history_id,
+                        history.c.id <= last))):
+        changes.setdefault(table_name, set()).add(table_id)
+
+    mapper_search = search.get_strategy('MapperSearch')
+    statement = mapper_search._parse(saved.query)
+    replace = getattr(statement.content, 'replace_results', False)
+    domains = set()
+    tables = set()
+    for query in statement.get_queries(mapper_search, session):
+        domains.add(query.column_descriptions[0]['type'].__tablename__)
+        tables.update(t.name for t in find_tables(query.statement))
+
+    if not tables.intersection(changes):
+        pass
+    elif replace or tables.intersection(changes).difference(domains):
+        # the changed rows can't be mapped to the results they affect
+        logger.debug('full refresh of saved search %s' % saved.name)
+        _store(session, saved, _evaluate(session, saved.query))
+    else:
+        ids = dict((name, changes[name]) for name in domains
+                   if name in changes)
+        _store(session, saved, _evaluate(session, saved.query, ids), ids)
+    saved.history_id = last
+    session.commit()
+
+
+def get_keys(session, name):
+    """
+    Return the (class, id) pairs of the results of the saved search
+    called name, refreshed first.
+    """
+    saved = get(session, name)
+    refresh(session, saved)
+    keys = []
+    classes = {}
+    for table_name, object_id in session.execute(
+            sa.select([result_table.c.table_name, result_table.c.object_id]).
+            where(result_table.c.saved_search_id == saved.id)):
+        if table_name not in classes:
+            classes[table_name] = _get_class(table_name)
+        if classes[table_name] is not None:
+            keys.append((classes[table_name], object_id))
+    return keys
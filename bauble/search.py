@@ -19,34 +19,666 @@
 # along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
 
 
+import threading
+import time
+import traceback
 import weakref
 
+import gobject
 import gtk
 
 import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, func
 from sqlalchemy import Unicode
 from sqlalchemy import UnicodeText
-from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import aliased, class_mapper
 from sqlalchemy.orm.properties import (
     ColumnProperty, RelationshipProperty)
+from sqlalchemy.sql.util import find_tables
 RelationProperty = RelationshipProperty
 
 import bauble
+import bauble.db as db
 from bauble.error import check
+import bauble.prefs as prefs
+import bauble.search_index as search_index
 import bauble.utils as utils
 from bauble.i18n import _
 
 
 def search(text, session=None):
-    results = set()
-    for strategy in _search_strategies.values():
-        logger.debug("applying search strategy %s" % strategy)
-        results.update(strategy.search(text, session))
-    return list(results)
+    """
+    Apply all the registered search strategies to text and return the
+    union of their results.
+
+    The strategies that do not build on the results of another strategy
+    are independent of each other.  When the database allows it they are
+    run concurrently, each in its own session.  They only select the
+    (class, id) pairs of their results, which are then loaded in session
+    with the loader options of their class.  The strategies with a
+    base_strategy are then given the results of their base, so that these
+    are only computed once.
+    """
+    if session is None:
+        results = set()
+        for name, strategy in _search_strategies.items():
+            logger.debug("applying search strategy %s" % strategy)
+            results.update(strategy.search(text, session) or [])
+        return list(results)
+
+    independent, dependent = _split_strategies()
+
+    loaded = {}  # (class, id) -> object in session
+    # strategy name -> list of (class, id)
+    found = _search_independent(text, session, independent)
+
+    for name, strategy in dependent:
+        keys = _result_cache.get(name, text)
+        if keys is None:
+            base = _load_keys(found[strategy.base_strategy], session, loaded)
+            results = _apply_strategy(name, strategy, text, session, base)
+            keys = get_keys(results)
+            loaded.update(zip(keys, results))
+        found[name] = keys
+
+    all_keys = set()
+    for keys in found.values():
+        all_keys.update(keys)
+    return _load_keys(list(all_keys), session, loaded)
+
+
+def _search_independent(text, session, independent, connections=None):
+    """
+    Return a dict of the name of each of the independent strategies to
+    the (class, id) pairs of its results, from the result cache or by
+    running the strategies, concurrently when the database allows it.
+
+    :param connections: a :class:`SearchConnections` the connections of
+      the sessions opened for the concurrent strategies are added to
+    """
+    found = {}
+    pending = []
+    for name, strategy in independent:
+        keys = _result_cache.get(name, text)
+        if keys is None:
+            pending.append((name, strategy))
+        else:
+            found[name] = keys
+
+    if len(pending) > 1 and _can_search_concurrently():
+        pool = _get_pool()
+        tasks = [(name, pool.apply_async(_search_in_new_session,
+                                         (name, strategy, text,
+                                          connections)))
+                 for name, strategy in pending]
+        for name, task in tasks:
+            found[name] = task.get()
+    else:
+        for name, strategy in pending:
+            found[name] = _apply_strategy(name, strategy, text, session,
+                                          keys_only=True)
+    return found
+
+
+def _split_strategies():
+    """
+    Return the lists of (name, strategy) of the independent strategies and
+    of the strategies refining the results of a base strategy.
+    """
+    independent = [(name, strategy)
+                   for name, strategy in _search_strategies.items()
+                   if strategy.base_strategy not in _search_strategies]
+    dependent = [(name, strategy)
+                 for name, strategy in _search_strategies.items()
+                 if strategy.base_strategy in _search_strategies]
+    return independent, dependent
+
+
+class PagedResults(object):
+    """
+    The results of a search, iterating over it yields lists of objects,
+    :meth:`keys` yields the lists of their (class, id) pairs instead.
+    The pages can only be gone through once, either way.
+
+    count is known before any object is loaded, it is the number of
+    distinct results of the independent strategies and of the cached
+    results of the strategies refining them.  The other results of the
+    refining strategies are only known while paging.
+    """
+
+    def __init__(self, count, pages, session):
+        self.count = count
+        self._pages = pages
+        self._session = session
+
+    def keys(self):
+        """
+        Return an iterator over the pages of (class, id) pairs, the
+        objects are only loaded when a refining strategy needs them.
+        """
+        return self._pages
+
+    def __iter__(self):
+        for keys in self._pages:
+            page = _load_keys(keys, self._session, {})
+            if page:
+                yield page
+
+
+def search_pages(text, session, page_size=500, connections=None):
+    """
+    Like :func:`search` but return a :class:`PagedResults`, so that
+    the results can be counted first and then loaded a page at a time.
+    Pages don't repeat objects already yielded.
+
+    The (class, id) pairs of the results of the independent strategies
+    are found like in :func:`search`, through the result cache and
+    concurrently, without loading the objects.  The strategies refining
+    their results are given the objects of each page they refine, their
+    results are stored in the result cache once all the pages are loaded.
+
+    :param connections: a :class:`SearchConnections` the connections of
+      the sessions opened for the concurrent strategies are added to, so
+      that cancelling it also cancels their queries
+    """
+    independent, dependent = _split_strategies()
+    found = _search_independent(text, session, independent, connections)
+
+    keys = []
+    seen = set()
+
+    def add_keys(new_keys):
+        for key in new_keys:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+
+    for name, strategy in independent:
+        add_keys(found[name])
+    pending = []
+    for name, strategy in dependent:
+        cached = _result_cache.get(name, text)
+        if cached is None:
+            pending.append((name, strategy))
+        else:
+            add_keys(cached)
+
+    def pages():
+        snapshot = db.get_generations()
+        history_id = db.get_history_id()
+        collected = dict((name, []) for name, strategy in pending)
+        bases = dict((name, set(found.get(strategy.base_strategy, [])))
+                     for name, strategy in pending)
+        for i in range(0, len(keys), page_size):
+            page = keys[i:i + page_size]
+            yield page
+            extra = []
+            loaded = {}
+            for name, strategy in pending:
+                base = _load_keys([key for key in page if key in bases[name]],
+                                  session, loaded)
+                if not base:
+                    continue
+                results = list(strategy.search(text, session, base) or [])
+                collected[name].extend(get_keys(results))
+                for key in get_keys(results):
+                    if key not in seen:
+                        seen.add(key)
+                        extra.append(key)
+            if extra:
+                yield extra
+        for name, strategy in pending:
+            _result_cache.store(name, text, collected[name], snapshot,
+                                strategy.get_tables(text, session),
+                                history_id)
+    return PagedResults(len(keys), pages(), session)
+
+
+class SearchExplanation(object):
+    """
+    The report of :func:`explain`.
+
+    :ivar text: the search string
+    :ivar parse_tree: the string of the parsed statement
+    :ivar queries: list of (strategy name, SQL, query plan, number of
+      rows), the SQL and query plan are None for the strategies that
+      don't expose them.
+    :ivar timings: list of (phase, seconds), the phases being parse,
+      sql, hydration (building the objects from the rows) and the ones
+      added by the caller, like the view population.
+    :ivar keys: the (class, id) pairs of the distinct results
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.parse_tree = None
+        self.queries = []
+        self.timings = []
+        self.keys = []
+
+    def add_timing(self, phase, seconds):
+        """
+        Add seconds to the time spent in phase.
+        """
+        for i, (name, total) in enumerate(self.timings):
+            if name == phase:
+                self.timings[i] = name, total + seconds
+                return
+        self.timings.append((phase, seconds))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __unicode__(self):
+        lines = ['search: %s' % utils.utf8(self.text),
+                 'parse tree: %s' % utils.utf8(self.parse_tree),
+                 'results: %s' % len(self.keys), '']
+        for phase, seconds in self.timings:
+            lines.append('%s: %.1f ms' % (phase, seconds * 1000))
+        for name, sql, plan, rows in self.queries:
+            lines.extend(['', '%s, %s rows' % (name, rows)])
+            if sql is not None:
+                lines.append(utils.utf8(sql))
+            if plan is not None:
+                lines.extend(['', 'query plan:'] + plan)
+        return u'\n'.join(lines)
+
+
+def explain(text, session=None):
+    """
+    Search text like :func:`search` and return a
+    :class:`SearchExplanation` telling how: the parse tree, the SQL of
+    each query and its query plan, the number of rows and the time spent
+    in each phase.  The result cache is not used.
+    """
+    close = session is None
+    if close:
+        session = db.Session()
+    explanation = SearchExplanation(text)
+    try:
+        independent, dependent = _split_strategies()
+        found = {}
+        for name, strategy in independent:
+            found[name] = strategy.explain(text, session, explanation)
+        for name, strategy in dependent:
+            start = time.time()
+            results = list(strategy.search(
+                text, session, found[strategy.base_strategy]) or [])
+            explanation.add_timing('sql', time.time() - start)
+            explanation.queries.append((name, None, None, len(results)))
+            found[name] = results
+        seen = set()
+        for name, strategy in independent + dependent:
+            for key in get_keys(found[name]):
+                if key not in seen:
+                    seen.add(key)
+                    explanation.keys.append(key)
+    finally:
+        if close:
+            session.close()
+    return explanation
+
+
+_max_search_threads = 4
+_search_pool = None
+
+
+def _get_pool():
+    global _search_pool
+    if _search_pool is None:
+        from multiprocessing.pool import ThreadPool
+        _search_pool = ThreadPool(_max_search_threads)
+    return _search_pool
+
+
+def _can_search_concurrently():
+    """
+    Return True if the strategies can run in separate threads.
+
+    Each thread uses its own connection, with SQLite this either means a
+    different in-memory database or serialized access to the same file,
+    so we don't bother.
+    """
+    return db.engine is not None and db.engine.name != 'sqlite'
+
+
+def _apply_strategy(name, strategy, text, session, base=None,
+                    keys_only=False):
+    """
+    Run strategy and store its results in the result cache.  Return the
+    results, or only their (class, id) pairs if keys_only.
+    """
+    logger.debug("applying search strategy %s" % strategy)
+    snapshot = db.get_generations()
+    history_id = db.get_history_id()
+    if keys_only:
+        results = keys = list(strategy.search_keys(text, session))
+    else:
+        if base is None:
+            results = strategy.search(text, session)
+        else:
+            results = strategy.search(text, session, base)
+        results = list(results or [])
+        keys = get_keys(results)
+    _result_cache.store(name, text, keys, snapshot,
+                        strategy.get_tables(text, session), history_id)
+    return results
+
+
+def _search_in_new_session(name, strategy, text, connections=None):
+    """
+    Run strategy in a session of its own and return the (class, id)
+    pairs of the results.  The connection of the session is added to
+    connections while the strategy runs.
+    """
+    session = db.Session()
+    handle = None
+    try:
+        if connections is not None:
+            handle = connections.add(session.connection())
+        return _apply_strategy(name, strategy, text, session, keys_only=True)
+    finally:
+        if connections is not None:
+            connections.remove(handle)
+        session.close()
+
+
+def _load_keys(keys, session, loaded):
+    """
+    Return the objects for keys, using the objects already in loaded and
+    adding to it the ones that had to be fetched from session.
+    """
+    missing = [key for key in keys if key not in loaded]
+    for obj in get_objects(missing, session):
+        loaded[(type(obj), obj.id)] = obj
+    return [loaded[key] for key in keys if key in loaded]
+
+
+def get_keys(objects):
+    """
+    Return the (class, id) pairs identifying the mapped objects.
+    """
+    return [(type(obj), obj.id) for obj in objects]
+
+
+def get_objects(keys, session, chunk_size=500, load_options=None):
+    """
+    Return the objects identified by keys, a sequence of (class, id)
+    pairs, loading them in session with one IN query per class and chunk.
+
+    :param load_options: a callable returning the loader options of the
+      queries of a class, default :func:`get_load_options`
+    """
+    if load_options is None:
+        load_options = get_load_options
+    ids_by_class = {}
+    for cls, obj_id in keys:
+        ids_by_class.setdefault(cls, []).append(obj_id)
+    results = []
+    for cls, ids in ids_by_class.iteritems():
+        query = session.query(cls).options(*load_options(cls))
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            results.extend(query.filter(cls.id.in_(chunk)))
+    return results
+
+
+def get_sort_column(cls):
+    """
+    Return the column the objects of cls are sorted by in the results:
+    their natural sort key, or the first property passed to
+    :meth:`MapperSearch.add_meta` for the classes without one, or their
+    id.
+    """
+    properties = MapperSearch._properties.get(cls)
+    if issubclass(cls, db.NaturallySorted):
+        return cls._sort_key
+    elif properties:
+        return func.coalesce(getattr(cls, properties[0]), u'')
+    return cls.id
+
+
+def keyset_pages(query, cls, page_size):
+    """
+    Iterate over lists of at most page_size objects of query, which
+    selects objects of cls, with one ordered and limited query per page.
+
+    The objects are sorted by their natural sort key, or the first
+    property passed to :meth:`MapperSearch.add_meta` for the classes
+    without one, then by id.  Each page starts after the last key of the
+    previous one, so that every page is a cheap indexed query however
+    deep into the results.
+    """
+    sort_col = get_sort_column(cls)
+    query = query.add_column(sort_col)
+    last = None
+    while True:
+        page_query = query
+        if last is not None:
+            value, last_id = last
+            page_query = page_query.filter(
+                or_(sort_col > value,
+                    and_(sort_col == value, cls.id > last_id)))
+        rows = page_query.order_by(None).order_by(sort_col, cls.id).\
+            limit(page_size).all()
+        if not rows:
+            return
+        yield [obj for obj, value in rows]
+        if len(rows) < page_size:
+            return
+        obj, value = rows[-1]
+        last = value, obj.id
+
+
+def get_load_options(cls):
+    """
+    Return the loader options passed to :meth:`MapperSearch.add_meta`
+    for cls.
+    """
+    return MapperSearch._load_options.get(cls, [])
+
+
+class SearchCancelled(Exception):
+    """
+    Raised when a connection is added to a cancelled
+    :class:`SearchConnections`.
+    """
+    pass
+
+
+class SearchConnections(object):
+    """
+    The connections a search is running its statements on: the one of
+    its session and the ones of the sessions opened for the strategies
+    run concurrently.  Cancelling it cancels the statements running on
+    all of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = set()
+        self.cancelled = False
+
+    def add(self, connection):
+        """
+        Add connection and return its cancel handle, raise
+        :class:`SearchCancelled` if the search was already cancelled.
+        """
+        handle = db.get_cancel_handle(connection)
+        with self._lock:
+            if self.cancelled:
+                raise SearchCancelled()
+            if handle is not None:
+                self._handles.add(handle)
+        return handle
+
+    def remove(self, handle):
+        """
+        Remove the connection of handle, before it's given back to the
+        pool.
+        """
+        with self._lock:
+            self._handles.discard(handle)
+
+    def cancel(self):
+        """
+        Cancel the statements running on the connections.
+        """
+        # the lock is held while cancelling so that a connection can't
+        # go back to the pool, and run someone else's statement, before
+        # its own statement is cancelled
+        with self._lock:
+            self.cancelled = True
+            for handle in self._handles:
+                try:
+                    db.cancel_statement(handle)
+                except Exception, e:
+                    logger.debug('could not cancel search: %s'
+                                 % utils.utf8(e))
+            self._handles.clear()
+
+
+class BackgroundSearch(object):
+    """
+    Run searches on a worker thread, each in a session of its own, so
+    that a slow query doesn't block the main loop.  Starting a search
+    cancels the one still running, also on the database server, in all
+    the sessions it uses.
+
+    :param callback: called on the main loop as callback(text, keys,
+      error, details), where keys are the (class, id) pairs of the
+      results, error is the exception raised by the search or None and
+      details its traceback.  It's never called for a cancelled search.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._connections = None
+
+    def start(self, text):
+        """
+        Cancel the running search and start searching text.
+        """
+        generation, connections = self.prepare()
+        worker = threading.Thread(target=self._run,
+                                  args=(generation, text, connections))
+        worker.daemon = True
+        worker.start()
+
+    def prepare(self):
+        """
+        Cancel the running search and return the generation and the
+        :class:`SearchConnections` of the next one.
+        """
+        generation = self.cancel()
+        connections = SearchConnections()
+        with self._lock:
+            if self.is_current(generation):
+                self._connections = connections
+        return generation, connections
+
+    def cancel(self):
+        """
+        Cancel the running search, if any, and return the generation
+        of the next search.
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            connections, self._connections = self._connections, None
+        if connections is not None:
+            connections.cancel()
+        return generation
+
+    def is_current(self, generation):
+        return generation == self._generation
+
+    def _run(self, generation, text, connections):
+        keys = []
+        error = details = None
+        session = db.Session()
+        handle = None
+        try:
+            handle = connections.add(session.connection())
+            results = search_pages(text, session, connections=connections)
+            for page in results.keys():
+                if not self.is_current(generation):
+                    return
+                keys.extend(page)
+        except SearchCancelled:
+            return
+        except Exception, e:
+            error, details = e, traceback.format_exc()
+        finally:
+            connections.remove(handle)
+            session.close()
+        gobject.idle_add(self._deliver, generation, text, keys, error,
+                         details)
+
+    def _deliver(self, generation, text, keys, error, details):
+        if self.is_current(generation):
+            self.callback(text, keys, error, details)
+        return False
+
+
+class ResultCache(object):
+    """
+    The results of the latest searches, per strategy and search text.
+
+    Only the (class, id) pairs of the results are stored, the objects
+    are loaded again in the session of the search that hits the cache.
+    An entry is valid as long as the tables the strategy depends on have
+    not changed, according to the counters in :mod:`bauble.db` for the
+    changes made by this process and to the history table for the
+    changes made by the other clients of a shared database.
+    """
+
+    def __init__(self, size=32):
+        self._entries = utils.LRUCache(size)
+
+    def get(self, strategy_name, text):
+        """
+        Return the cached (class, id) pairs or None if there is no valid
+        entry for the strategy and text.
+        """
+        key = (strategy_name, text.strip())
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        snapshot, history_id, tables, keys = entry
+        if not db.unchanged_since(snapshot, tables) or \
+                (history_id is not None and
+                 not db.history_unchanged_since(history_id, tables)):
+            self._entries.pop(key)
+            return None
+        logger.debug('%s: cached results for "%s"' % (strategy_name, text))
+        return keys
+
+    def store(self, strategy_name, text, keys, snapshot, tables=None,
+              history_id=None):
+        """
+        :param keys: the (class, id) pairs of the objects found by the
+          strategy
+        :param snapshot: the value of db.get_generations() taken before
+          the search was run
+        :param tables: the names of the tables the results depend on, None
+          meaning any table.
+        :param history_id: the value of db.get_history_id() taken before
+          the search was run, None to only check the counters
+        """
+        key = (strategy_name, text.strip())
+        self._entries[key] = (snapshot, history_id, tables, list(keys))
+
+    def clear(self):
+        self._entries.clear()
+
+
+_result_cache = ResultCache()
 
 
 class NoneToken(object):
@@ -114,12 +746,21 @@ class TypedValueToken(ValueABC):
                    }
 
     def __init__(self, t):
+        self._constructor = None
         try:
             constructor, converter = self.constructor[t[1]]
         except KeyError:
             return
-        params = tuple(converter(i) for i in t[3].express())
-        self.value = constructor(*params)
+        self._constructor = constructor
+        self._params = tuple(converter(i) for i in t[3].express())
+
+    @property
+    def value(self):
+        # constructed on request: parsed statements are cached and a value
+        # like |now||| must not be frozen at parse time.
+        if self._constructor is None:
+            return None
+        return self._constructor(*self._params)
 
     def __repr__(self):
         return "%s" % (self.value)
@@ -132,26 +773,16 @@ class IdentifierToken(object):
     def __repr__(self):
         return '.'.join(self.value)
 
-    def evaluate(self, env):
-        """return pair (query, attribute)
-
-        the value associated to the identifier is an altered query where the
-        joinpoint is the one relative to the attribute, and the attribute
-        itself.
+    def get_attribute(self, env):
         """
-
-        query = env.session.query(env.domain)
-        if len(self.value) == 1:
-            # identifier is an attribute of the table being queried
-            cls = env.domain
-        elif len(self.value) > 1:
-            # identifier is an attribute of a joined table
-            query = query.join(*self.value[:-1], aliased=True)
-            cls = query._joinpoint['_joinpoint_entity']
+        Return the attribute the identifier refers to, on the domain or
+        on the alias joined for its relation path by the planner of env.
+        """
+        cls = env.planner.get_entity(self.value[:-1])
         attr = getattr(cls, self.value[-1])
         logger.debug('IdentifierToken for %s, %s evaluates to %s'
                      % (cls, self.value[-1], attr))
-        return query, attr
+        return attr
 
     def needs_join(self, env):
         return self.value[:-1]
@@ -190,16 +821,18 @@ class IdentExpressionToken(object):
     def __repr__(self):
         return "(%s %s %s)" % (self.operands[0], self.op, self.operands[1])
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
+    def get_clause(self, env):
+        a = self.operands[0].get_attribute(env)
         if self.operands[1].express() == set():
             # check against the empty set
             if self.op in ('is', '=', '=='):
-                return q.filter(~a.any())
+                return ~a.any()
             elif self.op in ('not', '<>', '!='):
-                return q.filter(a.any())
-        clause = lambda x: self.operation(a, x)
-        return q.filter(clause(self.operands[1].express()))
+                return a.any()
+        return self.operation(a, self.operands[1].express())
+
+    def collect_joins(self, planner, outer=False):
+        planner.add_path(self.operands[0].needs_join(None), outer)
 
     def needs_join(self, env):
         return [self.operands[0].needs_join(env)]
@@ -212,17 +845,120 @@ class BetweenExpressionAction(object):
     def __repr__(self):
         return "(BETWEEN %s %s %s)" % tuple(self.operands)
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
-        clause_low = lambda low: low <= a
-        clause_high = lambda high: a <= high
-        return q.filter(and_(clause_low(self.operands[1].express()),
-                             clause_high(self.operands[2].express())))
+    def get_clause(self, env):
+        a = self.operands[0].get_attribute(env)
+        return and_(self.operands[1].express() <= a,
+                    a <= self.operands[2].express())
+
+    def collect_joins(self, planner, outer=False):
+        planner.add_path(self.operands[0].needs_join(None), outer)
 
     def needs_join(self, env):
         return [self.operands[0].needs_join(env)]
 
 
+class AggregateToken(object):
+    def __init__(self, t):
+        self.function = t[0][0].lower()
+        self.identifier = t[0][1]
+
+    def __repr__(self):
+        return "%s(%s)" % (self.function, self.identifier)
+
+    def get_column(self, planner):
+        """
+        Plan the joins of the identifier and return the aggregated
+        expression.
+
+        count() of a relation path counts the related objects, the other
+        functions apply to a column at the end of a relation path.
+        """
+        path = self.identifier.value
+        planner.add_path(path[:-1], outer=True)
+        attr = getattr(planner.get_entity(path[:-1]), path[-1])
+        if isinstance(getattr(attr, 'property', None), RelationshipProperty):
+            check(self.function == 'count',
+                  _('%s() needs a column, not the relation %s')
+                  % (self.function, self.identifier))
+            planner.add_path(path, outer=True)
+            attr = planner.get_entity(path).id
+        # the relations are outer joined, with no related rows count()
+        # and sum() are 0 rather than NULL
+        if self.function == 'count':
+            return func.count(attr)
+        elif self.function == 'sum':
+            return func.coalesce(func.sum(attr), 0)
+        return getattr(func, self.function)(attr)
+
+
+class AggregateExpressionAction(IdentExpressionToken):
+    """
+    A comparison of an aggregate of the objects related to the domain,
+    like count(accessions) > 3 or sum(plants.quantity) >= 10, compiled
+    to 'id IN (SELECT id ... GROUP BY id HAVING ...)'.
+    """
+
+    def get_clause(self, env):
+        planner = JoinPlanner(env.domain)
+        aggregate = self.operands[0].get_column(planner)
+        ids = planner.apply(env.session.query(env.domain.id),
+                            distinct=False).\
+            group_by(env.domain.id).\
+            having(self.operation(aggregate, self.operands[1].express()))
+        return env.domain.id.in_(ids.statement.correlate(None))
+
+    def collect_joins(self, planner, outer=False):
+        # the subquery plans its own joins
+        pass
+
+    def needs_join(self, env):
+        return []
+
+
+def get_spatial_clause(cls, entity, op, values):
+    """
+    Return the clause of the spatial predicate op, near or within, on
+    entity, cls or an alias of it.  The classes with coordinates define
+    the near_clause and within_clause class methods.
+    """
+    method = getattr(cls, '%s_clause' % op, None)
+    check(method is not None,
+          _('%s has no coordinates to search') % cls.__name__)
+    expected = {'near': 3, 'within': 4}[op]
+    check(len(values) == expected,
+          _('%(op)s takes %(count)s numbers') % {'op': op,
+                                                 'count': expected})
+    return method(entity, *values)
+
+
+class SpatialExpressionAction(object):
+    """
+    A spatial predicate on the objects at the end of a relation path,
+    like source.collection near (17.25, -88.77, 10), see
+    :func:`get_spatial_clause`
+    """
+
+    def __init__(self, t):
+        self.operands = [t[0][0]]
+        self.op = t[0][1].lower()
+        self.values = [v.express() for v in t[0][2]]
+
+    def __repr__(self):
+        return "(%s %s %s)" % (self.operands[0], self.op, tuple(self.values))
+
+    def get_clause(self, env):
+        path = self.operands[0].value
+        return get_spatial_clause(env.planner.get_class(path),
+                                  env.planner.get_entity(path),
+                                  self.op, self.values)
+
+    def collect_joins(self, planner, outer=False):
+        planner.add_path(self.operands[0].value, outer)
+
+    def needs_join(self, env):
+        return [self.operands[0].value]
+
+
 class UnaryLogical(object):
     ## abstract base class. `name` is defined in derived classes
     def __init__(self, t):
@@ -252,31 +988,45 @@ class BinaryLogical(object):
 class SearchAndAction(BinaryLogical):
     name = 'AND'
 
-    def evaluate(self, env):
-        result = self.operands[0].evaluate(env)
-        for i in self.operands[1:]:
-            result = result.intersect(i.evaluate(env))
-        return result
+    def get_clause(self, env):
+        return and_(*[i.get_clause(env) for i in self.operands])
+
+    def collect_joins(self, planner, outer=False):
+        for i in self.operands:
+            i.collect_joins(planner, outer)
 
 
 class SearchOrAction(BinaryLogical):
     name = 'OR'
 
-    def evaluate(self, env):
-        result = self.operands[0].evaluate(env)
-        for i in self.operands[1:]:
-            result = result.union(i.evaluate(env))
-        return result
+    def get_clause(self, env):
+        return or_(*[i.get_clause(env) for i in self.operands])
+
+    def collect_joins(self, planner, outer=False):
+        # a row missing the relations of one alternative can still
+        # match another one
+        for i in self.operands:
+            i.collect_joins(planner, True)
 
 
 class SearchNotAction(UnaryLogical):
     name = 'NOT'
 
-    def evaluate(self, env):
-        q = env.session.query(env.domain)
-        for i in env.domains:
-            q.join(*i)
-        return q.except_(self.operand.evaluate(env))
+    def get_clause(self, env):
+        # the operand is planned in a subquery of its own, so that NOT
+        # of a condition on a to-many relation means that none of the
+        # related objects satisfies it
+        sub_env = QueryEnvironment(env.search_strategy, env.domain)
+        self.operand.collect_joins(sub_env.planner)
+        ids = sub_env.planner.apply(env.session.query(env.domain.id),
+                                    distinct=False)
+        ids = ids.filter(self.operand.get_clause(sub_env))
+        # the subquery selects from the domain table too, it must not be
+        # correlated to the enclosing query
+        return ~env.domain.id.in_(ids.statement.correlate(None))
+
+    def collect_joins(self, planner, outer=False):
+        pass
 
 
 class ParenthesisedQuery(object):
@@ -286,8 +1036,11 @@ class ParenthesisedQuery(object):
     def __repr__(self):
         return "(%s)" % self.query.__repr__()
 
-    def evaluate(self, env):
-        return self.query.evaluate(env)
+    def get_clause(self, env):
+        return self.query.get_clause(env)
+
+    def collect_joins(self, planner, outer=False):
+        self.query.collect_joins(planner, outer)
 
     def needs_join(self, env):
         return self.query.needs_join(env)
@@ -297,42 +1050,237 @@ class QueryAction(object):
     def __init__(self, t):
         self.domain = t[0]
         self.filter = t[1][0]
+        self.group_by = len(t) > 2 and t[2] or None
+        self.aggregate = len(t) > 3 and t[3] or None
 
     def __repr__(self):
+        if self.group_by is not None:
+            return "SELECT * FROM %s WHERE %s GROUP BY %s%s" % (
+                self.domain, self.filter, self.group_by,
+                self.aggregate is not None and ' %s' % self.aggregate or '')
         return "SELECT * FROM %s WHERE %s" % (self.domain, self.filter)
 
-    def invoke(self, search_strategy):
+    def get_queries(self, search_strategy, session):
         """
-        update search_strategy object with statement results
+        return the list of queries implementing the statement
+
+        the filter tree is compiled into the WHERE clause of a single
+        query, the relations it refers to are joined once each by a
+        :class:`JoinPlanner`.
 
         Queries can use more database specific features.  This also
         means that the same query might not work the same on different
         database types. For example, on a PostgreSQL database you can
         use ilike but this would raise an error on SQLite.
         """
+        env = self.get_environment(search_strategy, session)
+        if session is None:
+            return []
+        if self.group_by is not None:
+            return [self.get_group_query(env)]
+        query = env.planner.apply(env.session.query(env.domain))
+        return [query.filter(self.filter.get_clause(env))]
+
+    def get_environment(self, search_strategy, session):
+        """
+        Return the :class:`QueryEnvironment` of the filter, with its
+        joins planned.
+        """
+        domain = search_strategy._shorthand.get(self.domain, self.domain)
+        check(domain in search_strategy._domains,
+              'Unknown search domain: %s' % self.domain)
+        env = QueryEnvironment(search_strategy, session,
+                               search_strategy._domains[domain][0])
+        self.filter.collect_joins(env.planner)
+        return env
+
+    def get_groups(self, env):
+        """
+        Return the subquery grouping the objects matching the filter by
+        the object the group by relation path reaches from them, it
+        selects the group_id and the value of the aggregate of each
+        group: the aggregate following the relation, like in 'plant
+        where ... group by location sum(quantity)', or the number of
+        matching objects.
+        """
+        path = self.group_by.value
+        env.planner.add_path(path)
+        group = env.planner.get_entity(path)
+        if self.aggregate is None:
+            value = func.count(env.domain.id.distinct())
+        else:
+            value = self.aggregate.get_column(env.planner)
+        query = env.session.query(group.id.label('group_id'),
+                                  value.label('value'))
+        return env.planner.apply(query, distinct=False).\
+            filter(self.filter.get_clause(env)).\
+            group_by(group.id).subquery()
+
+    def get_group_query(self, env, with_values=False):
+        """
+        Return the query of the groups of :meth:`get_groups`, like the
+        locations of the plants with 'plant where ... group by
+        location', or of (group, value) rows if with_values.
+        """
+        groups = self.get_groups(env)
+        cls = env.planner.get_class(self.group_by.value)
+        query = env.session.query(cls)
+        if with_values:
+            query = query.add_column(groups.c.value)
+        return query.join((groups, cls.id == groups.c.group_id))
+
+    def get_group_values(self, search_strategy, session):
+        """
+        Return the (group, value) pairs of a statement with a group by.
+        """
+        check(self.group_by is not None,
+              _('%s has no group by') % self)
+        env = self.get_environment(search_strategy, session)
+        query = self.get_group_query(env, with_values=True)
+        db.refresh_derived_tables(t.name for t in find_tables(query.statement))
+        return query.all()
+
+    def invoke(self, search_strategy, session):
+        """
+        update search_strategy object with statement results
+        """
 
-        domain = self.domain
-        check(domain in search_strategy._domains or
-              domain in search_strategy._shorthand,
-              'Unknown search domain: %s' % domain)
-        self.domain = search_strategy._shorthand.get(domain, domain)
-        self.domain = search_strategy._domains[domain][0]
+        result = set()
+        for query in self.get_queries(search_strategy, session):
+            result.update(query.all())
+        return result
+
+
+class JoinPlanner(object):
+    """
+    Join the relation paths used in the filter of a QueryAction to the
+    query of its domain, each distinct path once with an alias of its
+    own, so an identifier used several times in a filter always refers
+    to the same joined row.
+
+    The paths only used in conjunctions are inner joined, the ones used
+    under an OR are outer joined so that the other alternatives can
+    still match.  The query is only made DISTINCT when a to-many
+    relation is joined, the only case in which the joins can repeat the
+    rows of the domain.
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.to_many = False
+        self._paths = []  # in join order, a path after its prefixes
+        self._aliases = {}
+        self._classes = {}
+        self._outer = {}
+
+    def add_path(self, path, outer=False):
+        """
+        Plan the joins of path, a list of relation names starting from
+        the domain.
+        """
+        path = tuple(path)
+        for i in range(1, len(path) + 1):
+            prefix = path[:i]
+            if prefix in self._aliases:
+                self._outer[prefix] = self._outer[prefix] or outer
+                continue
+            prop = getattr(self.get_entity(prefix[:-1]), prefix[-1]).property
+            check(isinstance(prop, RelationshipProperty),
+                  _('%s is not a relation') % '.'.join(prefix))
+            self._aliases[prefix] = aliased(prop.mapper.class_)
+            self._classes[prefix] = prop.mapper.class_
+            self._outer[prefix] = outer
+            self._paths.append(prefix)
+            if prop.uselist:
+                self.to_many = True
+
+    def get_entity(self, path):
+        """
+        Return the alias joined for path, or the domain for an empty path.
+        """
+        path = tuple(path)
+        if not path:
+            return self.domain
+        return self._aliases[path]
+
+    def get_class(self, path):
+        """
+        Return the mapped class of the entity joined for path.
+        """
+        path = tuple(path)
+        if not path:
+            return self.domain
+        return self._classes[path]
+
+    def apply(self, query, distinct=True):
+        """
+        Return query with the planned joins.
+        """
+        for path in self._paths:
+            target = (self._aliases[path],
+                      getattr(self.get_entity(path[:-1]), path[-1]))
+            if self._outer[path]:
+                query = query.outerjoin(target)
+            else:
+                query = query.join(target)
+        if distinct and self.to_many:
+            query = query.distinct()
+        return query
+
+
+class QueryEnvironment(object):
+    """
+    the environment in which the filter of a QueryAction is evaluated.
+
+    it holds the session, the mapped class corresponding to the domain
+    and the planner of the joins, so that neither the parsed statement
+    nor the search strategy, which are shared by the searches running
+    in other threads, are altered by the evaluation.
+    """
+
+    def __init__(self, search_strategy, session, domain):
         self.search_strategy = search_strategy
+        self.session = session
+        self.domain = domain
+        self.planner = JoinPlanner(domain)
 
-        result = set()
-        if search_strategy._session is not None:
-            self.domains = self.filter.needs_join(self)
-            self.session = search_strategy._session
-            records = self.filter.evaluate(self).all()
-            result.update(records)
 
+class SpatialStatementAction(object):
+    """
+    created when the parser hits a spatial predicate on a domain, like
+    collection near (17.25, -88.77, 10), see :func:`get_spatial_clause`
+    """
+
+    def __init__(self, t):
+        self.domain = t[0]
+        self.op = t[1].lower()
+        self.values = [v.express() for v in t[2]]
+
+    def __repr__(self):
+        return "%s %s %s" % (self.domain, self.op, tuple(self.values))
+
+    def get_queries(self, search_strategy, session):
+        domain = search_strategy._shorthand.get(self.domain, self.domain)
+        check(domain in search_strategy._domains,
+              'Unknown search domain: %s' % self.domain)
+        cls = search_strategy._domains[domain][0]
+        query = session.query(cls)
+        return [query.filter(
+            get_spatial_clause(cls, cls, self.op, self.values))]
+
+    def invoke(self, search_strategy, session):
+        result = set()
+        for query in self.get_queries(search_strategy, session):
+            result.update(query.all())
         return result
 
 
 class StatementAction(object):
     def __init__(self, t):
         self.content = t[0]
-        self.invoke = lambda x: self.content.invoke(x)
+        self.invoke = lambda x, session: self.content.invoke(x, session)
+        self.get_queries = \
+            lambda x, session: self.content.get_queries(x, session)
 
     def __repr__(self):
         return repr(self.content)
@@ -351,13 +1299,19 @@ class BinomialNameAction(object):
     def __repr__(self):
         return "%s %s" % (self.genus_epithet, self.species_epithet)
 
-    def invoke(self, search_strategy):
+    def get_queries(self, search_strategy, session):
         from bauble.plugins.plants.genus import Genus
         from bauble.plugins.plants.species import Species
-        result = search_strategy._session.query(Species).filter(
+        query = session.query(Species).filter(
             Species.sp.startswith(self.species_epithet)).join(Genus).filter(
-            Genus.genus.startswith(self.genus_epithet)).all()
-        return set(result)
+            Genus.genus.startswith(self.genus_epithet))
+        return [query]
+
+    def invoke(self, search_strategy, session):
+        result = set()
+        for query in self.get_queries(search_strategy, session):
+            result.update(query.all())
+        return result
 
 
 class DomainExpressionAction(object):
@@ -378,26 +1332,29 @@ class DomainExpressionAction(object):
     def __repr__(self):
         return "%s %s %s" % (self.domain, self.cond, self.values)
 
-    def invoke(self, search_strategy):
+    def get_queries(self, search_strategy, session):
+        """
+        return the list of queries implementing the domain expression
+
+        all properties and all values are combined in one OR clause, so
+        that the domain is scanned once and the database takes care of
+        removing duplicates.
+        """
+        domain = search_strategy._shorthand.get(self.domain, self.domain)
         try:
-            if self.domain in search_strategy._shorthand:
-                self.domain = search_strategy._shorthand[self.domain]
-            cls, properties = search_strategy._domains[self.domain]
+            cls, properties = search_strategy._domains[domain]
         except KeyError:
             raise KeyError(_('Unknown search domain: %s') % self.domain)
 
-        query = search_strategy._session.query(cls)
+        query = session.query(cls)
 
         ## here is the place where to optionally filter out unrepresented
         ## domain values. each domain class should define its own 'I have
         ## accessions' filter. see issue #42
 
-        result = set()
-
         # select all objects from the domain
         if self.values == '*':
-            result.update(query.all())
-            return result
+            return [query]
 
         mapper = class_mapper(cls)
 
@@ -414,15 +1371,33 @@ class DomainExpressionAction(object):
             condition = lambda col: \
                 lambda val: mapper.c[col].op(self.cond)(val)
 
-        for col in properties:
-            ors = or_(*map(condition(col), self.values.express()))
-            result.update(query.filter(ors).all())
+        values = self.values.express()
+        clauses = [condition(col)(val) for col in properties for val in values]
+        return [query.filter(or_(*clauses))]
 
+    def invoke(self, search_strategy, session):
+        result = set()
+        for query in self.get_queries(search_strategy, session):
+            result.update(query.all())
         return result
 
 
+def replacement(obj):
+    """
+    Return the object the user really wants when obj is found by a value
+    search, e.g. the species of a vernacular name.
+    """
+    try:
+        return obj.replacement()
+    except:
+        return obj
+
+
 class ValueListAction(object):
 
+    # value searches return the replacement() of the results
+    replace_results = True
+
     def __init__(self, t):
         logger.debug("ValueListAction::__init__(%s)" % t)
         self.values = t[0]
@@ -433,13 +1408,13 @@ class ValueListAction(object):
     def express(self):
         return [i.express() for i in self.values]
 
-    def invoke(self, search_strategy):
+    def get_queries(self, search_strategy, session):
         """
-        Called when the whole search string is a value list.
+        return one query per domain class, each of them matching any of
+        the values in any of the properties configured with add_meta()
 
-        Search with a list of values is the broadest search and
-        searches all the mapper and the properties configured with
-        add_meta()
+        classes with a full-text index match the values as word prefixes
+        through the index, see :mod:`bauble.search_index`
         """
 
         # make searches case-insensitive, in postgres use ilike,
@@ -447,7 +1422,7 @@ class ValueListAction(object):
         like = lambda table, col, val: \
             utils.ilike(table.c[col], ('%%%s%%' % val))
 
-        result = set()
+        queries = []
         for cls, columns in search_strategy._properties.iteritems():
             column_cross_value = [(c, v) for c in columns
                                   for v in self.express()]
@@ -463,19 +1438,34 @@ class ValueListAction(object):
                     return v
 
             table = class_mapper(cls)
-            q = search_strategy._session.query(cls)  # prepares SELECT
-            q = q.filter(or_(*[like(table, c, unicol(c, v))
-                               for c, v in column_cross_value]))
+            q = session.query(cls)  # prepares SELECT
+            ids = None
+            if search_index.is_indexed(cls.__tablename__):
+                ids = search_index.match_ids(cls.__tablename__,
+                                             self.express())
+            if ids is not None:
+                q = q.filter(cls.id.in_(ids))
+            else:
+                q = q.filter(or_(*[like(table, c, unicol(c, v))
+                                   for c, v in column_cross_value]))
+            queries.append(q)
+        return queries
+
+    def invoke(self, search_strategy, session):
+        """
+        Called when the whole search string is a value list.
+
+        Search with a list of values is the broadest search and
+        searches all the mapper and the properties configured with
+        add_meta()
+        """
+
+        result = set()
+        for q in self.get_queries(search_strategy, session):
             result.update(q.all())
 
         logger.debug("result is now %s" % result)
-
-        def replace(i):
-            try:
-                return i.replacement()
-            except:
-                return i
-        result = set([replace(i) for i in result])
+        result = set([replacement(i) for i in result])
         logger.debug("result is now %s" % result)
         return result
 
@@ -485,7 +1475,7 @@ from pyparsing import (
     OneOrMore, oneOf, alphas, alphanums, Group, Literal,
     CaselessLiteral, WordStart, WordEnd, srange,
     stringEnd, Keyword, quotedString,
-    infixNotation, opAssoc, Forward)
+    infixNotation, opAssoc, Forward, Optional, ParserElement)
 
 
 class SearchParser(object):
@@ -549,36 +1539,85 @@ class SearchParser(object):
     between_expression = Group(
         identifier + BETWEEN_ + value + AND_ + value
         ).setParseAction(BetweenExpressionAction)
+    aggregate = Group(
+        oneOf('count sum min max avg', caseless=True) +
+        Literal('(').suppress() + identifier + Literal(')').suppress()
+        ).setParseAction(AggregateToken)
+    aggregate_expression = Group(
+        aggregate + binop + value
+        ).setParseAction(AggregateExpressionAction)
+    SPATIAL_OP = oneOf('near within', caseless=True)
+    coordinates = (Literal('(').suppress() + Group(delimitedList(
+        numeric_value.copy())) + Literal(')').suppress())
+    spatial_expression = Group(
+        identifier + SPATIAL_OP + coordinates
+        ).setParseAction(SpatialExpressionAction)
     query_expression << infixNotation(
-        (ident_expression | between_expression),
+        (aggregate_expression | spatial_expression | ident_expression |
+         between_expression),
         [(NOT_, 1, opAssoc.RIGHT, SearchNotAction),
          (AND_, 2, opAssoc.LEFT,  SearchAndAction),
          (OR_,  2, opAssoc.LEFT,  SearchOrAction)])
+    GROUP_BY_ = (Keyword('group', caseless=True) +
+                 Keyword('by', caseless=True)).suppress()
     query = (domain + Keyword('where', caseless=True).suppress() +
-             Group(query_expression) + stringEnd).setParseAction(QueryAction)
+             Group(query_expression) +
+             Optional(GROUP_BY_ + identifier + Optional(aggregate)) +
+             stringEnd).setParseAction(QueryAction)
+
+    spatial_statement = (
+        domain + SPATIAL_OP + coordinates + stringEnd
+        ).setParseAction(SpatialStatementAction)
 
     statement = (query('query')
                  | domain_expression('domain')
+                 | spatial_statement('spatial')
                  | binomial_name('binomial')
                  | value_list('value_list')
                  ).setParseAction(StatementAction)('statement')
 
+    def __init__(self, cache_size=128):
+        self.cache = utils.LRUCache(cache_size)
+
+    @staticmethod
+    def enable_packrat():
+        '''enable the pyparsing packrat optimization
+
+        this affects all pyparsing grammars in the process and can't be
+        undone.
+        '''
+        ParserElement.enablePackrat()
+
     def parse_string(self, text):
         '''request pyparsing object to parse text
 
         `text` can be either a query, or a domain expression, or a list of
         values. the `self.statement` pyparsing object parses the input text
         and return a pyparsing.ParseResults object that represents the input
+
+        parsed statements are kept in a LRU cache keyed by the stripped
+        text, so they must not be altered when they are invoked.
         '''
 
-        return self.statement.parseString(text)
+        key = text.strip()
+        results = self.cache.get(key)
+        if results is None:
+            results = self.statement.parseString(key)
+            self.cache[key] = results
+        return results
 
 
 class SearchStrategy(object):
     """
     Interface for adding search strategies to a view.
+
+    A strategy that refines the results of another strategy names it in
+    base_strategy, its search method then receives the results of the
+    base strategy as a third argument.
     """
 
+    base_strategy = None
+
     def search(self, text, session=None):
         '''
         :param text: the search string
@@ -590,6 +1629,42 @@ class SearchStrategy(object):
         logger.debug('SearchStrategy "%s" %s)' % (text, session))
         pass
 
+    def search_keys(self, text, session):
+        '''
+        Return the (class, id) pairs of the results, in the order they
+        are shown.
+
+        The default implementation takes them from the results of
+        search(), strategies that can select them without loading the
+        objects should override it.
+        '''
+        return get_keys(self.search(text, session) or [])
+
+    def explain(self, text, session, explanation):
+        '''
+        Search text adding to explanation, a :class:`SearchExplanation`,
+        how it's done, and return the results.
+
+        The default implementation only times search(), strategies that
+        run their own queries should override it.
+        '''
+        start = time.time()
+        results = list(self.search(text, session) or [])
+        explanation.add_timing('sql', time.time() - start)
+        explanation.queries.append(
+            (self.__class__.__name__, None, None, len(results)))
+        return results
+
+    def get_tables(self, text, session=None):
+        '''
+        Return the names of the tables the results of searching text
+        depend on, or None if a change to any table could alter them.
+
+        This is used to tell when the cached results of a search are out
+        of date.
+        '''
+        return None
+
 
 class MapperSearch(SearchStrategy):
 
@@ -606,13 +1681,13 @@ class MapperSearch(SearchStrategy):
     _domains = {}
     _shorthand = {}
     _properties = {}
+    _load_options = {}
 
     def __init__(self):
         super(MapperSearch, self).__init__()
-        self._results = set()
         self.parser = SearchParser()
 
-    def add_meta(self, domain, cls, properties):
+    def add_meta(self, domain, cls, properties, load_options=None):
         """Add a domain to the search space
 
         an example of domain is a database table, where the properties would
@@ -626,6 +1701,12 @@ class MapperSearch(SearchStrategy):
         :param cls: the class the domain will resolve to
         :param properties: a list of string names of the properties to
                            search by default
+        :param load_options: a list of loader options, like
+                             joinedload('genus'), applied when the
+                             results of cls are loaded by their ids so
+                             that the related objects used to show them
+                             are loaded with them instead of one query
+                             per object
         """
 
         logger.debug('%s.add_meta(%s, %s, %s)' %
@@ -644,6 +1725,16 @@ class MapperSearch(SearchStrategy):
         else:
             self._domains[domain] = cls, properties
         self._properties[cls] = properties
+        self._load_options[cls] = list(load_options or [])
+
+    def configure_parser(self):
+        """
+        apply the search preferences to the parser
+        """
+        size = prefs.prefs.get(prefs.search_cache_size_pref, 128)
+        self.parser.cache.resize(int(size))
+        if prefs.prefs.get(prefs.search_packrat_pref, False):
+            SearchParser.enable_packrat()
 
     @classmethod
     def get_domain_classes(cls):
@@ -660,14 +1751,99 @@ class MapperSearch(SearchStrategy):
         have been processed or it is possible that some database backends
         could cause deadlocks.
         """
-        self._session = session
+        statement = self._parse(text)
+        replace = getattr(statement.content, 'replace_results', False)
+
+        results = set()
+        for query in self.get_queries(statement, session):
+            objects = query.all()
+            if replace:
+                objects = [replacement(obj) for obj in objects]
+            results.update(objects)
+        return results
+
+    def _parse(self, text):
+        """
+        Return the statement parsed from text.
 
-        self._results.clear()
-        results = self.parser.parse_string(text.decode())
-        self._results.update(results.statement.invoke(self))
+        The strategy is shared by all the searches, so the statement
+        doesn't hold their session, it's passed to its get_queries().
+        """
+        self.configure_parser()
+        return self.parser.parse_string(text.decode()).statement
 
-        # these _results get filled in when the parse actions are called
-        return self._results
+    def get_queries(self, statement, session):
+        """
+        Return the queries of statement in session, once the derived
+        tables they use are up to date, see
+        :func:`bauble.db.refresh_derived_tables`.
+        """
+        queries = statement.get_queries(self, session)
+        tables = set()
+        for query in queries:
+            tables.update(t.name for t in find_tables(query.statement))
+        db.refresh_derived_tables(tables)
+        return queries
+
+    def search_keys(self, text, session):
+        """
+        Select the ids of the results of each query of the statement,
+        sorted like the results view shows them, see
+        :func:`get_sort_column`.
+        """
+        statement = self._parse(text)
+        if getattr(statement.content, 'replace_results', False):
+            return super(MapperSearch, self).search_keys(text, session)
+        keys = []
+        for query in self.get_queries(statement, session):
+            cls = query.column_descriptions[0]['type']
+            ids = query.order_by(None).from_self(cls.id).\
+                order_by(get_sort_column(cls), cls.id)
+            keys.extend((cls, row[0]) for row in ids)
+        return keys
+
+    def explain(self, text, session, explanation):
+        """
+        Parse text bypassing the parse cache, then run each query of the
+        statement twice: first the bare SQL, then through the ORM, the
+        difference being the time spent building the objects.
+        """
+        self.configure_parser()
+        start = time.time()
+        statement = self.parser.statement.parseString(
+            text.decode().strip()).statement
+        explanation.add_timing('parse', time.time() - start)
+        explanation.parse_tree = repr(statement)
+        replace = getattr(statement.content, 'replace_results', False)
+        connection = session.connection()
+        results = []
+        for query in self.get_queries(statement, session):
+            start = time.time()
+            rows = connection.execute(query.statement).fetchall()
+            sql_time = time.time() - start
+            start = time.time()
+            objects = query.all()
+            explanation.add_timing('sql', sql_time)
+            explanation.add_timing(
+                'hydration', max(time.time() - start - sql_time, 0))
+            explanation.queries.append(
+                ('MapperSearch', unicode(query.statement.compile(
+                    dialect=connection.dialect)),
+                 db.get_query_plan(connection, query.statement), len(rows)))
+            if replace:
+                objects = [replacement(obj) for obj in objects]
+            results.extend(objects)
+        return results
+
+    def get_tables(self, text, session=None):
+        """
+        Return the names of the tables used by the queries of the statement.
+        """
+        statement = self._parse(text)
+        tables = set()
+        for query in statement.get_queries(self, session):
+            tables.update(t.name for t in find_tables(query.statement))
+        return sorted(tables)
 
 
 ## list of search strategies to be tried on each search string
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2008-2010 Brett Adams
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+"""
+Optional full-text indexes for the value list searches.
+
+For every table registered with :meth:`bauble.search.MapperSearch.add_meta`
+a companion table named <table>_fts holds the text of the searched
+properties of each row, keyed by the id of the row:
+
+* on SQLite it is an FTS5 virtual table, the rowid being the id
+* on PostgreSQL it is a table with a tsvector column and a GIN index
+
+The companion tables are created with the searchindex command and kept
+in sync by :class:`bauble.db.SearchIndexExtension`, or by
+:func:`rebuild_index` after the changes bypassing the mappers, like the
+imports.  When the companion
+table of a class exists the value list searches match the values as
+word prefixes through the index instead of scanning the table with LIKE.
+
+The same command also creates the indexes serving the LIKE comparisons
+of the domain expressions, see :func:`create_like_indexes`.  These can
+also be created alone, keeping the LIKE semantics of the value list
+searches.
+"""
+
+import re
+
+import gtk
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+import bauble.db as db
+from bauble.i18n import _
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+SUFFIX = '_fts'
+
+_present = None  # (database generation, set of indexed table names)
+
+
+def get_backend(engine=None):
+    """
+    Return the name of the full-text backend for engine, or None if the
+    database doesn't support one.
+    """
+    engine = engine or db.engine
+    if engine is None:
+        return None
+    if engine.name in ('sqlite', 'postgresql'):
+        return engine.name
+    return None
+
+
+def _get_properties():
+    """
+    Return a dict of table name to (class, properties) for the classes
+    registered with MapperSearch.add_meta()
+    """
+    import bauble.search as search
+    mapper_search = search.get_strategy('MapperSearch')
+    result = {}
+    for cls, properties in mapper_search._properties.iteritems():
+        result[cls.__tablename__] = cls, properties
+    return result
+
+
+def indexed_tables():
+    """
+    Return the names of the tables that have a full-text index in the
+    current database.
+    """
+    global _present
+    generation = db.get_generations()[0]
+    if _present is None or _present[0] != generation:
+        names = set()
+        if get_backend() is not None:
+            existing = set(db.engine.table_names())
+            names = set(name for name in _get_properties()
+                        if name + SUFFIX in existing)
+        _present = generation, names
+    return _present[1]
+
+
+def is_indexed(table_name):
+    return table_name in indexed_tables()
+
+
+def _index_table(table_name):
+    if get_backend() == 'sqlite':
+        return table(table_name + SUFFIX, column('rowid'), column('content'))
+    return table(table_name + SUFFIX, column('id'), column('content'))
+
+
+def _text_of(instance, properties):
+    values = [getattr(instance, p, None) for p in properties]
+    return u' '.join(utils.utf8(v) for v in values if v is not None)
+
+
+def _insert_sql():
+    if get_backend() == 'sqlite':
+        return 'INSERT INTO %s (rowid, content) VALUES (:id, :content)'
+    return "INSERT INTO %s (id, content) " \
+        "VALUES (:id, to_tsvector('simple', :content))"
+
+
+def _delete_sql():
+    if get_backend() == 'sqlite':
+        return 'DELETE FROM %s WHERE rowid = :id'
+    return 'DELETE FROM %s WHERE id = :id'
+
+
+def update_row(connection, mapper, instance):
+    """
+    Replace the index entry of instance, called after an insert or an
+    update of instance.
+    """
+    table_name = mapper.local_table.name
+    if not is_indexed(table_name):
+        return
+    cls, properties = _get_properties()[table_name]
+    name = table_name + SUFFIX
+    connection.execute(sa.text(_delete_sql() % name), id=instance.id)
+    connection.execute(sa.text(_insert_sql() % name), id=instance.id,
+                       content=_text_of(instance, properties))
+    db.table_changed(name)
+
+
+def delete_row(connection, mapper, instance):
+    """
+    Remove the index entry of instance, called after instance is deleted.
+    """
+    table_name = mapper.local_table.name
+    if not is_indexed(table_name):
+        return
+    name = table_name + SUFFIX
+    connection.execute(sa.text(_delete_sql() % name), id=instance.id)
+    db.table_changed(name)
+
+
+def drop_index(engine=None):
+    """
+    Drop all the full-text index tables.
+    """
+    global _present
+    engine = engine or db.engine
+    existing = set(engine.table_names())
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        for table_name in _get_properties():
+            name = table_name + SUFFIX
+            if name in existing:
+                connection.execute('DROP TABLE %s' % name)
+                db.table_changed(name)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+        _present = None
+
+
+def create_index(engine=None, chunk_size=500):
+    """
+    (Re)create the full-text index tables of all the classes registered
+    with MapperSearch.add_meta() and fill them with the current content
+    of the database.
+    """
+    global _present
+    engine = engine or db.engine
+    backend = get_backend(engine)
+    if backend is None:
+        raise NotImplementedError(
+            _('Full-text search is not supported on %s') % engine.name)
+    drop_index(engine)
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        for table_name, (cls, properties) in _get_properties().iteritems():
+            name = table_name + SUFFIX
+            if backend == 'sqlite':
+                connection.execute('CREATE VIRTUAL TABLE %s USING '
+                                   'fts5(content)' % name)
+            else:
+                connection.execute('CREATE TABLE %s (id integer PRIMARY KEY, '
+                                   'content tsvector)' % name)
+                connection.execute('CREATE INDEX %s_idx ON %s USING '
+                                   'gin(content)' % (name, name))
+            _fill_index(connection, cls, properties, chunk_size)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+        _present = None
+
+
+def rebuild_index(table_names, engine=None, chunk_size=500):
+    """
+    Fill again the full-text index tables of the tables in table_names
+    that have one, after their rows were changed bypassing the mappers,
+    like the importers do.
+    """
+    engine = engine or db.engine
+    properties_of = _get_properties()
+    table_names = [name for name in table_names if is_indexed(name)]
+    if not table_names:
+        return
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        for table_name in table_names:
+            cls, properties = properties_of[table_name]
+            connection.execute('DELETE FROM %s' % (table_name + SUFFIX))
+            _fill_index(connection, cls, properties, chunk_size)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def _fill_index(connection, cls, properties, chunk_size):
+    """
+    Insert the index entries of all the rows of the table of cls in its
+    empty index table.
+    """
+    source = cls.__table__
+    name = source.name + SUFFIX
+    columns = [source.c.id] + [source.c[p] for p in properties]
+    insert = sa.text(_insert_sql() % name)
+    rows = connection.execute(sa.select(columns)).fetchall()
+    for i in range(0, len(rows), chunk_size):
+        values = [{'id': row[0],
+                   'content': u' '.join(
+                       utils.utf8(v) for v in row[1:] if v is not None)}
+                  for row in rows[i:i + chunk_size]]
+        connection.execute(insert, values)
+    db.table_changed(name)
+
+
+def _like_index_names(engine):
+    """
+    Return a list of (index name, table name, column name) for the
+    properties registered with MapperSearch.add_meta().
+    """
+    suffix = 'trgm_idx' if engine.name == 'postgresql' else 'lower_idx'
+    result = []
+    for table_name, (cls, properties) in _get_properties().iteritems():
+        for prop in properties:
+            result.append(('%s_%s_%s' % (table_name, prop, suffix),
+                           table_name, prop))
+    return result
+
+
+def create_like_indexes(engine=None):
+    """
+    Create the indexes serving the case insensitive LIKE comparisons of
+    the domain expressions on the properties registered with
+    MapperSearch.add_meta(), see :func:`bauble.utils.ilike`
+
+    On PostgreSQL these are pg_trgm GIN indexes, which also serve the
+    contains, like '%value%', comparisons.  On SQLite these are lower()
+    functional indexes, which only serve the prefix comparisons.
+    """
+    engine = engine or db.engine
+    backend = get_backend(engine)
+    if backend is None:
+        raise NotImplementedError(
+            _('Search indexes are not supported on %s') % engine.name)
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        if backend == 'postgresql':
+            connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            ddl = 'CREATE INDEX IF NOT EXISTS %s ON %s ' \
+                'USING gin (%s gin_trgm_ops)'
+        else:
+            ddl = 'CREATE INDEX IF NOT EXISTS %s ON %s (lower(%s))'
+        for name, table_name, column_name in _like_index_names(engine):
+            connection.execute(ddl % (name, table_name, column_name))
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def drop_like_indexes(engine=None):
+    """
+    Drop the indexes created by :func:`create_like_indexes`
+    """
+    engine = engine or db.engine
+    if get_backend(engine) is None:
+        return
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        for name, table_name, column_name in _like_index_names(engine):
+            connection.execute('DROP INDEX IF EXISTS %s' % name)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def _match_expression(values):
+    """
+    Return the full-text query matching any of values as word prefixes,
+    or None if the values contain no words.
+    """
+    terms = []
+    for value in values:
+        words = re.findall(r'\w+', unicode(value), re.UNICODE)
+        if not words:
+            continue
+        if get_backend() == 'sqlite':
+            terms.append(u'"%s"*' % u' '.join(words))
+        else:
+            terms.append(u'(%s)' % u' & '.join(w + u':*' for w in words))
+    if not terms:
+        return None
+    if get_backend() == 'sqlite':
+        return u' OR '.join(terms)
+    return u' | '.join(terms)
+
+
+def match_ids(table_name, values):
+    """
+    Return a select of the ids of the rows of table_name matching any of
+    values, or None if values can't be searched in the index.
+    """
+    expression = _match_expression(values)
+    if expression is None:
+        return None
+    index = _index_table(table_name)
+    if get_backend() == 'sqlite':
+        return sa.select([index.c.rowid]).\
+            where(index.c.content.op('MATCH')(expression))
+    return sa.select([index.c.id]).\
+        where(index.c.content.op('@@')(
+            sa.func.to_tsquery('simple', expression)))
+
+
+class SearchIndexCommandHandler(pluginmgr.CommandHandler):
+    """
+    :searchindex builds the full-text index and the LIKE indexes,
+    :searchindex=fulltext only the full-text index, :searchindex=like
+    only the LIKE indexes, :searchindex=drop removes them all
+    """
+
+    command = 'searchindex'
+
+    def __call__(self, cmd, arg):
+        if arg == 'drop':
+            drop_index()
+            drop_like_indexes()
+            utils.message_dialog(_('The search indexes were removed.'))
+            return
+        if arg not in (None, '', 'like', 'fulltext'):
+            utils.message_dialog(
+                _('Unknown search index: %s') % utils.xml_safe(arg),
+                gtk.MESSAGE_ERROR)
+            return
+        try:
+            if arg != 'fulltext':
+                create_like_indexes()
+            if arg != 'like':
+                create_index()
+        except Exception, e:
+            utils.message_dialog(utils.xml_safe(unicode(e)),
+                                 gtk.MESSAGE_ERROR)
+            return
+        utils.message_dialog(_('The search indexes were created.'))
+
+
+pluginmgr.register_command(SearchIndexCommandHandler)
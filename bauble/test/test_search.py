@@ -21,7 +21,7 @@
 # test_search.py
 #
 import unittest
-#from nose import SkipTest
+from nose import SkipTest
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,6 +31,7 @@ from pyparsing import ParseException
 
 import bauble.db as db
 import bauble.search as search
+import bauble.search_index as search_index
 from bauble.test import BaubleTestCase
 
 
@@ -128,6 +129,34 @@ class SearchParserTests(unittest.TestCase):
         self.assertEquals(results.getName(), 'value')
         self.assertEquals(results.value.express(), datetime(1970, 1, 1))
 
+    def test_now_token_is_not_frozen(self):
+        "typed values are constructed when expressed, not when parsed"
+
+        from datetime import datetime
+        ticks = iter([datetime(2015, 1, 1), datetime(2015, 1, 2)])
+        constructor = search.TypedValueToken.constructor
+        saved = constructor['now']
+        constructor['now'] = (lambda: ticks.next(), id)
+        try:
+            results = parser.value.parseString('|now||')
+            first = results.value.express()
+            second = results.value.express()
+        finally:
+            constructor['now'] = saved
+        self.assertEquals(first, datetime(2015, 1, 1))
+        self.assertEquals(second, datetime(2015, 1, 2))
+
+    def test_parse_string_is_cached(self):
+        "parsing the same text twice gives the cached results"
+
+        p = search.SearchParser(cache_size=2)
+        first = p.parse_string(u'genus where genus=genus1')
+        self.assertTrue(p.parse_string(u' genus where genus=genus1 ')
+                        is first)
+        p.parse_string(u'fam=a')
+        p.parse_string(u'fam=b')
+        self.assertFalse(u'genus where genus=genus1' in p.cache)
+
     def test_value_token(self):
         "value should only return the first string or raise a parse exception"
 
@@ -360,6 +389,336 @@ class SearchTests(BaubleTestCase):
         results = mapper_search.search('family contains FAM', self.session)
         self.assertEquals(len(results), 4)  # they case insensitively do
 
+    def test_search_keeps_no_state(self):
+        "the shared strategy keeps neither the session nor the results"
+        mapper_search = search.get_strategy('MapperSearch')
+        families = mapper_search.search('family=*', self.session)
+        genera = mapper_search.search('genus=*', self.session)
+        self.assertEquals(families, set([self.family]))
+        self.assertEquals(genera, set([self.genus]))
+        self.assertFalse(hasattr(mapper_search, '_session'))
+
+    def test_search_by_expression_single_statement(self):
+        "domain expression on several properties is one statement"
+        mapper_search = search.get_strategy('MapperSearch')
+
+        results = mapper_search.parser.parse_string(u'sp=abc def')
+        queries = results.statement.get_queries(mapper_search, self.session)
+        self.assertEquals(len(queries), 1)
+
+        results = mapper_search.parser.parse_string(u'family contains fam')
+        queries = results.statement.get_queries(mapper_search, self.session)
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(queries[0].all(), [self.family])
+
+    def test_search_by_query_shorthand_domain(self):
+        "query statements accept the domain shorthand"
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('gen where genus=genus1',
+                                       self.session)
+        self.assertEquals(results, set([self.genus]))
+
+    def test_search_results_cache_invalidated(self):
+        "cached search results are dropped when the table changes"
+        results = search.search(u'genus1', self.session)
+        self.assertEquals(results, [self.genus])
+        results = search.search(u'genus1', self.session)
+        self.assertEquals(results, [self.genus])
+        self.genus.genus = u'genus2'
+        self.session.commit()
+        results = search.search(u'genus1', self.session)
+        self.assertEquals(results, [])
+
+    def test_search_results_cache_sees_other_clients(self):
+        "cached search results are dropped on a change in the history"
+        from datetime import datetime
+        results = search.search(u'genus1', self.session)
+        self.assertEquals(results, [self.genus])
+        # another client: the local counters don't move
+        genus = self.Genus.__table__
+        history = db.History.__table__
+        db.engine.execute(genus.update().where(genus.c.id == self.genus.id).
+                          values(genus=u'genus2'))
+        db.engine.execute(history.insert().values(
+            table_name=u'genus', table_id=self.genus.id, values=u'',
+            operation=u'update', timestamp=datetime.now()))
+        self.session.expire_all()
+        results = search.search(u'genus1', self.session)
+        self.assertEquals(results, [])
+
+    def test_search_dependent_strategy_gets_base_results(self):
+        "a strategy with a base_strategy is given the base results"
+        received = []
+
+        class FamilyOfGenusSearch(search.SearchStrategy):
+            base_strategy = 'MapperSearch'
+
+            def search(self, text, session, base_results=None):
+                received.append(base_results)
+                return [r.family for r in base_results]
+
+        search._search_strategies['FamilyOfGenusSearch'] = \
+            FamilyOfGenusSearch()
+        try:
+            results = search.search(u'genus1', self.session)
+        finally:
+            del search._search_strategies['FamilyOfGenusSearch']
+        self.assertEquals(received, [[self.genus]])
+        self.assertEquals(sorted(results), sorted([self.genus, self.family]))
+
+    def test_search_pages(self):
+        "results are counted first and then loaded a page at a time"
+        genera = [self.Genus(family=self.family, genus=u'genus1%02d' % i)
+                  for i in range(5)]
+        self.session.add_all(genera)
+        self.session.commit()
+        results = search.search_pages(u'genus where genus like genus1%',
+                                      self.session, page_size=2)
+        self.assertEquals(results.count, 6)
+        pages = list(results)
+        self.assertEquals([len(page) for page in pages], [2, 2, 2])
+        self.assertEquals(sum(pages, []), [self.genus] + genera)
+
+    def test_search_pages_keys(self):
+        "the pages of keys only load the objects a refining strategy needs"
+        genera = [self.Genus(family=self.family, genus=u'genus1%02d' % i)
+                  for i in range(3)]
+        self.session.add_all(genera)
+        self.session.commit()
+        session = db.Session()
+        results = search.search_pages(u'genus where genus like genus1%',
+                                      session, page_size=2)
+        pages = list(results.keys())
+        self.assertEquals([len(page) for page in pages], [2, 2])
+        self.assertEquals(sum(pages, []),
+                          search.get_keys([self.genus] + genera))
+        self.assertEquals(len(session.identity_map), 0)
+        session.close()
+
+        class FamilyOfGenusSearch(search.SearchStrategy):
+            base_strategy = 'MapperSearch'
+
+            def search(self, text, session, base_results=None):
+                return [r.family for r in base_results]
+
+        search._search_strategies['FamilyOfGenusSearch'] = \
+            FamilyOfGenusSearch()
+        session = db.Session()
+        try:
+            results = search.search_pages(u'genus=genus1', session)
+            pages = list(results.keys())
+        finally:
+            del search._search_strategies['FamilyOfGenusSearch']
+            search._result_cache.clear()
+        self.assertEquals(pages, [[(self.Genus, self.genus.id)],
+                                  [(type(self.family), self.family.id)]])
+        session.close()
+
+    def test_search_pages_distinct_and_cached(self):
+        "paged results count each object once and use the result cache"
+        calls = []
+        genus = self.genus
+
+        class SameGenusSearch(search.SearchStrategy):
+
+            def search(self, text, session):
+                calls.append(text)
+                return [session.merge(genus)]
+
+            def get_tables(self, text, session):
+                return ['genus']
+
+        search._search_strategies['SameGenusSearch'] = SameGenusSearch()
+        try:
+            results = search.search_pages(u'genus1', self.session)
+            self.assertEquals(results.count, 1)
+            self.assertEquals(sum(list(results), []), [self.genus])
+            results = search.search_pages(u'genus1', self.session)
+            self.assertEquals(results.count, 1)
+        finally:
+            del search._search_strategies['SameGenusSearch']
+        self.assertEquals(calls, [u'genus1'])
+
+    def test_query_joins_each_path_once(self):
+        "each relation path is joined once, DISTINCT only for to-many"
+        genus2 = self.Genus(family=self.family, genus=u'genus2')
+        self.session.add(genus2)
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+
+        s = 'genus where family.family=family1 AND family.qualifier="s. lat."'
+        results = mapper_search.search(s, self.session)
+        self.assertEquals(results, set([self.genus, genus2]))
+        query, = mapper_search._parse(s).\
+            get_queries(mapper_search, self.session)
+        sql = str(query.statement).upper()
+        self.assertEquals(sql.count('JOIN'), 1)
+        self.assertFalse('DISTINCT' in sql)
+
+        s = 'family where genera.genus=genus1 OR genera.genus=genus2'
+        query, = mapper_search._parse(s).\
+            get_queries(mapper_search, self.session)
+        self.assertEquals(query.all(), [self.family])
+        self.assertTrue('DISTINCT' in str(query.statement).upper())
+
+        # NOT of a to-many condition: none of the genera matches
+        s = 'family where NOT genera.genus=genus2'
+        results = mapper_search.search(s, self.session)
+        self.assertEquals(results, set())
+        s = 'family where NOT genera.genus=genus3'
+        results = mapper_search.search(s, self.session)
+        self.assertEquals(results, set([self.family]))
+
+    def test_aggregate_query(self):
+        "aggregate predicates and group by are computed in the database"
+        family2 = self.Family(family=u'family2')
+        family3 = self.Family(family=u'family3')
+        self.session.add_all([
+            family2, family3,
+            self.Genus(family=family2, genus=u'genus2'),
+            self.Genus(family=family2, genus=u'genus3')])
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+
+        results = mapper_search.search('family where count(genera) > 1',
+                                       self.session)
+        self.assertEquals(results, set([family2]))
+        results = mapper_search.search('family where count(genera) = 0',
+                                       self.session)
+        self.assertEquals(results, set([family3]))
+        results = mapper_search.search(
+            'family where max(genera.genus) = genus3 OR family=family3',
+            self.session)
+        self.assertEquals(results, set([family2, family3]))
+        results = mapper_search.search(
+            'genus where genus like genus% group by family', self.session)
+        self.assertEquals(results, set([self.family, family2]))
+
+        # the groups carry the number of their matching objects, or an
+        # aggregate of them
+        statement = mapper_search._parse(
+            'genus where genus like genus% group by family').content
+        self.assertEquals(
+            set(statement.get_group_values(mapper_search, self.session)),
+            set([(self.family, 1), (family2, 2)]))
+        statement = mapper_search._parse(
+            'genus where genus like genus% group by family max(genus)').\
+            content
+        self.assertEquals(
+            set(statement.get_group_values(mapper_search, self.session)),
+            set([(self.family, u'genus1'), (family2, u'genus3')]))
+        query, = statement.get_queries(mapper_search, self.session)
+        self.assertTrue('GROUP BY' in str(query.statement).upper())
+
+    def test_load_options(self):
+        "the loader options passed to add_meta load the related objects"
+        self.assertTrue(search.get_load_options(self.Genus))
+        session = db.Session()
+        genus, = search.search(u'genus=genus1', session)
+        self.assertTrue('family' in genus.__dict__)
+        session.close()
+        # the search queries themselves don't load them
+        session = db.Session()
+        genus, = search.get_strategy('MapperSearch').search(u'genus=genus1',
+                                                            session)
+        self.assertFalse('family' in genus.__dict__)
+        session.close()
+        session = db.Session()
+        genus, = search.get_objects([(self.Genus, self.genus.id)], session)
+        self.assertTrue('family' in genus.__dict__)
+        session.close()
+
+    def test_explain(self):
+        "explain reports the parse tree, the SQL and the timings"
+        explanation = search.explain(u'genus where family.family=family1',
+                                     self.session)
+        self.assertEquals(explanation.keys, [(self.Genus, self.genus.id)])
+        self.assertTrue('family1' in explanation.parse_tree)
+        name, sql, plan, rows = explanation.queries[0]
+        self.assertEquals(name, 'MapperSearch')
+        self.assertTrue('JOIN family' in sql, sql)
+        self.assertEquals(rows, 1)
+        self.assertTrue(plan)
+        phases = [phase for phase, seconds in explanation.timings]
+        self.assertEquals(phases[:3], ['parse', 'sql', 'hydration'])
+        self.assertTrue('JOIN family' in unicode(explanation))
+
+    def test_background_search_drops_superseded_results(self):
+        "only the results of the last background search are delivered"
+        import gtk
+        delivered = []
+        background = search.BackgroundSearch(
+            lambda *args: delivered.append(args))
+        first, first_connections = background.prepare()
+        second, second_connections = background.prepare()
+        self.assertTrue(first_connections.cancelled)
+        # run the searches in this thread, it's the one seeing the
+        # in-memory test database
+        background._run(first, u'genus=genus2', first_connections)
+        background._run(second, u'genus=genus1', second_connections)
+        while gtk.events_pending():
+            gtk.main_iteration()
+        self.assertEquals(len(delivered), 1)
+        text, keys, error, details = delivered[0]
+        self.assertEquals(error, None)
+        self.assertEquals(text, u'genus=genus1')
+        self.assertEquals(keys, [(self.Genus, self.genus.id)])
+
+    def test_background_search_cancels_concurrent_queries(self):
+        "cancelling a background search cancels the concurrent strategies"
+        import itertools
+        import threading
+        started = []
+        all_started = threading.Event()
+        release = threading.Event()
+        cancelled = []
+
+        class BlockingSearch(search.SearchStrategy):
+
+            def search_keys(self, text, session):
+                started.append(text)
+                if len(started) == 2:
+                    all_started.set()
+                release.wait(10)
+                return []
+
+        handles = itertools.count()
+        saved = (dict(search._search_strategies),
+                 search._can_search_concurrently, db.get_cancel_handle,
+                 db.cancel_statement, db.get_history_id)
+        search._search_strategies.clear()
+        search._search_strategies['BlockingSearch1'] = BlockingSearch()
+        search._search_strategies['BlockingSearch2'] = BlockingSearch()
+        # the worker and the pool threads only pretend to use the
+        # database, the in-memory test database is not shared with them
+        search._can_search_concurrently = lambda: True
+        db.get_cancel_handle = lambda connection: ('test', handles.next())
+        db.cancel_statement = cancelled.append
+        db.get_history_id = lambda: 0
+        try:
+            background = search.BackgroundSearch(lambda *args: None)
+            generation, connections = background.prepare()
+            worker = threading.Thread(
+                target=background._run,
+                args=(generation, u'blocking', connections))
+            worker.start()
+            self.assertTrue(all_started.wait(10))
+            background.cancel()
+            # the worker's connection and the ones of both strategies
+            self.assertEquals(len(cancelled), 3)
+            self.assertEquals(len(set(cancelled)), 3)
+            release.set()
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+        finally:
+            release.set()
+            strategies, search._can_search_concurrently, \
+                db.get_cancel_handle, db.cancel_statement, \
+                db.get_history_id = saved
+            search._search_strategies.clear()
+            search._search_strategies.update(strategies)
+            search._result_cache.clear()
+
     def test_search_by_query11(self):
         "query with MapperSearch, single table, single test"
 
@@ -931,3 +1290,128 @@ class BuildingSQLStatements(BaubleTestCase):
         results = sp.parse_string('species where id between 0 and 1')
         self.assertEqual(str(results.statement),
                          "SELECT * FROM species WHERE (BETWEEN id 0.0 1.0)")
+
+
+class SearchIndexTests(BaubleTestCase):
+
+    def setUp(self):
+        super(SearchIndexTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Genus = Genus
+        self.family = Family(family=u'family1')
+        self.genus = Genus(family=self.family, genus=u'Maxillaria')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+        try:
+            search_index.create_index()
+        except Exception, e:
+            raise SkipTest('no full-text support: %s' % e)
+
+    def tearDown(self):
+        search_index.drop_index()
+        super(SearchIndexTests, self).tearDown()
+
+    def test_value_search_uses_index(self):
+        "value searches match word prefixes through the index"
+        self.assertTrue(search_index.is_indexed('genus'))
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('maxill', self.session)
+        self.assertEquals(results, set([self.genus]))
+        # no infix matching through the index
+        results = mapper_search.search('illaria', self.session)
+        self.assertEquals(results, set())
+
+    def test_index_follows_changes(self):
+        "the index is updated on insert, update and delete"
+        mapper_search = search.get_strategy('MapperSearch')
+        genus = self.Genus(family=self.family, genus=u'Masdevallia')
+        self.session.add(genus)
+        self.session.commit()
+        results = mapper_search.search('masdev', self.session)
+        self.assertEquals(results, set([genus]))
+        genus.genus = u'Dracula'
+        self.session.commit()
+        results = mapper_search.search('masdev', self.session)
+        self.assertEquals(results, set())
+        results = mapper_search.search('dracula', self.session)
+        self.assertEquals(results, set([genus]))
+        self.session.delete(genus)
+        self.session.commit()
+        results = mapper_search.search('dracula', self.session)
+        self.assertEquals(results, set())
+
+    def test_index_non_ascii(self):
+        "non-ASCII values are indexed and found"
+        created = self.Genus(family=self.family, genus=u'B\xe9gonia')
+        self.session.add(created)
+        self.session.commit()
+
+        def found(value):
+            ids = search_index.match_ids('genus', [value])
+            return set(row[0] for row in db.engine.execute(ids))
+
+        # indexed by the mapper extension
+        self.assertEquals(found(u'b\xe9gon'), set([created.id]))
+        # indexed when the index is built
+        search_index.create_index()
+        self.assertEquals(found(u'b\xe9gon'), set([created.id]))
+
+    def test_like_indexes_serve_prefix_searches(self):
+        "domain expressions with a prefix pattern use the lower() index"
+        search_index.create_like_indexes()
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('genus like maxi%', self.session)
+        self.assertEquals(results, set([self.genus]))
+        statement = mapper_search.parser.parse_string(
+            'genus like maxi%').statement
+        query, = statement.get_queries(mapper_search, self.session)
+        compiled = query.statement.compile(db.engine)
+        params = [compiled.params[k] for k in compiled.positiontup]
+        plan = db.engine.execute('EXPLAIN QUERY PLAN %s' % compiled,
+                                 *params).fetchall()
+        self.assertTrue('genus_genus_lower_idx' in str(plan), plan)
+        search_index.drop_like_indexes()
+
+
+class SavedSearchTests(BaubleTestCase):
+
+    def setUp(self):
+        super(SavedSearchTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family = Family
+        self.Genus = Genus
+        self.family = Family(family=u'family1')
+        self.genus = Genus(family=self.family, genus=u'genus1')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+
+    def test_saved_search(self):
+        "the results of a saved search follow the changes"
+        import bauble.saved_search as saved_search
+        saved_search.save(self.session, u'gen', u'genus where genus like g%')
+        self.assertEquals(saved_search.get_names(self.session), [u'gen'])
+        self.assertEquals(saved_search.get_keys(self.session, u'gen'),
+                          [(self.Genus, self.genus.id)])
+
+        # a change of the searched table refreshes the changed rows only
+        genus2 = self.Genus(family=self.family, genus=u'genus2')
+        self.session.add(genus2)
+        self.genus.genus = u'Agenus'
+        self.session.commit()
+        self.assertEquals(saved_search.get_keys(self.session, u'gen'),
+                          [(self.Genus, genus2.id)])
+
+        # a change of a joined table runs the query again
+        saved_search.save(self.session, u'fam',
+                          u'genus where family.family=family2')
+        self.assertEquals(saved_search.get_keys(self.session, u'fam'), [])
+        self.family.family = u'family2'
+        self.session.commit()
+        self.assertEquals(
+            sorted(saved_search.get_keys(self.session, u'fam')),
+            sorted([(self.Genus, self.genus.id), (self.Genus, genus2.id)]))
+
+        saved_search.remove(self.session, u'fam')
+        self.assertEquals(saved_search.get_names(self.session), [u'gen'])
@@ -31,3 +31,38 @@ class Utils(BaubleTestCase):
 
     def test_topological_sort_loop(self):
         self.assertEqual(utils.topological_sort([1,2], [(2,1), (1,2)]), None)
+
+    def test_lru_cache_drops_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_lru_cache_zero_size_disables(self):
+        cache = utils.LRUCache(0)
+        cache['a'] = 1
+        self.assertEqual(len(cache), 0)
+        cache.resize(1)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(len(cache), 1)
+
+    def test_ilike_prefix_is_a_range(self):
+        from bauble.plugins.plants.genus import Genus
+        clause = str(utils.ilike(Genus.genus, u'Max%'))
+        self.assertTrue('lower(genus.genus) >=' in clause, clause)
+        self.assertTrue('lower(genus.genus) <' in clause, clause)
+        clause = str(utils.ilike(Genus.genus, u'%axi%'))
+        self.assertTrue('LIKE' in clause, clause)
+        clause = str(utils.ilike(Genus.genus, u'M_x%'))
+        self.assertTrue('LIKE' in clause, clause)
+
+    def test_natsort_string_sorts_like_natsort_key(self):
+        codes = ['2015.10', '2015.9', 'a10', 'a9', 'a 1', 'a1', '010', '9',
+                 'B', 'a', 'ab', '', '1.5', '1.25', '1.1', '1.11']
+        self.assertEqual(sorted(codes, key=utils.natsort_string),
+                         sorted(codes, key=utils.natsort_key))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+
+from bauble.test import BaubleTestCase
+import bauble.db as db
+import bauble.search as search
+from bauble.view import MoreRows, ResultsModel, SearchView
+
+
+class ResultsModelTests(BaubleTestCase):
+
+    def setUp(self):
+        super(ResultsModelTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.family = Family(family=u'family1')
+        self.genera = [Genus(family=self.family, genus=u'genus%s' % i)
+                       for i in range(10)]
+        self.session.add_all([self.family] + self.genera)
+        self.session.commit()
+        self.model = ResultsModel(self.session, lambda obj: True,
+                                  cache_size=3)
+        self.model.batch_size = 2
+        self.model.append_keys(search.get_keys(self.genera))
+
+    def test_objects_loaded_on_demand(self):
+        model = self.model
+        self.assertEquals(model.iter_n_children(None), 10)
+        self.assertEquals(len(model.get_loaded_objects()), 0)
+        self.assertEquals(model[(5, )][0], self.genera[5])
+        # the following row is loaded in the same batch
+        self.assertEquals(len(model.get_loaded_objects()), 2)
+        self.assertEquals(model[(0, )][0], self.genera[0])
+        self.assertEquals(model[(9, )][0], self.genera[9])
+        self.assertEquals(len(model.get_loaded_objects()), 3)
+
+    def test_children_and_remove(self):
+        model = self.model
+        treeiter = model.get_iter((2, ))
+        self.assertTrue(model.iter_has_child(treeiter))
+        model.set_children(treeiter, [self.family])
+        self.assertEquals(model[(2, 0)][0], self.family)
+        found = model.find(self.family)
+        self.assertEquals(len(found), 1)
+        model.remove(found[0])
+        self.assertFalse(model.iter_has_child(model.get_iter((2, ))))
+        model.remove(model.get_iter((0, )))
+        self.assertEquals(model.iter_n_children(None), 9)
+        self.assertEquals(model[(0, )][0], self.genera[1])
+        self.assertEquals(model.get_path(model.find(self.genera[9])[0]),
+                          (8, ))
+
+    def test_child_counts(self):
+        from bauble.plugins.plants.family import Family
+        counts = db.count_related(self.session, Family, 'genera',
+                                  [self.family.id])
+        self.assertEquals(counts, {self.family.id: 10})
+        family2 = Family(family=u'family2')
+        self.session.add(family2)
+        self.session.commit()
+        model = ResultsModel(
+            self.session, lambda obj: True,
+            child_counts=lambda session, cls, ids:
+            db.count_related(session, cls, 'genera', ids))
+        model.append_keys(search.get_keys([self.family, family2]))
+        self.assertTrue(model.iter_has_child(model.get_iter((0, ))))
+        self.assertFalse(model.iter_has_child(model.get_iter((1, ))))
+        self.assertEquals(model.get_child_count(self.family), 10)
+        self.assertEquals(model.get_child_count(family2), 0)
+
+        # the counts are taken again once a table changed
+        from bauble.plugins.plants.genus import Genus
+        self.session.add(Genus(family=family2, genus=u'genus11'))
+        self.session.commit()
+        self.assertEquals(model.get_child_count(family2), 1)
+        self.assertTrue(model.iter_has_child(model.get_iter((1, ))))
+
+    def test_load_more(self):
+        model = self.model
+        treeiter = model.get_iter((0, ))
+        more = MoreRows(iter([self.genera[2:4], self.genera[4:5]]), 2)
+        model.set_children(treeiter, self.genera[:2], more)
+        self.assertEquals(model.iter_n_children(treeiter), 3)
+        self.assertTrue(isinstance(model[(0, 2)][0], MoreRows))
+        model.load_more(model.get_iter((0, 2)))
+        self.assertEquals(model.iter_n_children(treeiter), 5)
+        self.assertEquals(model[(0, 3)][0], self.genera[3])
+        self.assertTrue(isinstance(model[(0, 4)][0], MoreRows))
+        # the last page is not full, no more row after it
+        model.load_more(model.get_iter((0, 4)))
+        self.assertEquals(model.iter_n_children(treeiter), 5)
+        self.assertEquals(model[(0, 4)][0], self.genera[4])
+
+    def test_children_pages(self):
+        meta = SearchView.ViewMeta.Meta()
+        meta.set(children='genera')
+        pages = list(meta.get_children_pages(self.family, 4))
+        self.assertEquals([len(page) for page in pages], [4, 4, 2])
+        self.assertEquals(sum(pages, []), self.genera)
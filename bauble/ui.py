@@ -24,6 +24,7 @@
 import os
 import traceback
 
+import gobject
 import gtk
 
 import logging
@@ -35,7 +36,8 @@ import bauble.db as db
 from bauble.i18n import _
 import bauble.paths as paths
 import bauble.pluginmgr as pluginmgr
-from bauble.prefs import prefs
+from bauble.prefs import prefs, search_as_you_type_pref, \
+    search_as_you_type_delay_pref
 import bauble.search as search
 import bauble.utils as utils
 import bauble.utils.desktop as desktop
@@ -94,6 +96,8 @@ class GUI(object):
 
         main_entry = combo.child
         main_entry.connect('activate', self.on_main_entry_activate)
+        main_entry.connect('changed', self.on_main_entry_changed)
+        self._search_timeout_id = None
         accel_group = gtk.AccelGroup()
         main_entry.add_accelerator("grab-focus", accel_group, ord('L'),
                                    gtk.gdk.CONTROL_MASK, gtk.ACCEL_VISIBLE)
@@ -140,11 +144,14 @@ class GUI(object):
         hbox.show()
 
         from pyparsing import StringStart, Word, alphanums, restOfLine, \
-            StringEnd
+            StringEnd, Optional
         cmd = StringStart() + ':' + Word(
             alphanums + '-_').setResultsName('cmd')
         arg = restOfLine.setResultsName('arg')
-        self.cmd_parser = (cmd + StringEnd()) | (cmd + '=' + arg) | arg
+        # the argument follows either '=' or a space, as in
+        # :explain genus where family.family=Orchidaceae
+        self.cmd_parser = (cmd + StringEnd()) | \
+            (cmd + Optional('=') + arg) | arg
 
         combo.grab_focus()
 
@@ -203,9 +210,39 @@ class GUI(object):
     def on_main_entry_activate(self, widget, data=None):
         self.widgets.go_button.emit("clicked")
 
+    def on_main_entry_changed(self, entry):
+        '''
+        (re)start the countdown to searching as you type
+        '''
+        if not prefs[search_as_you_type_pref]:
+            return
+        self._cancel_search_as_you_type()
+        self._search_timeout_id = gobject.timeout_add(
+            int(prefs[search_as_you_type_delay_pref]),
+            self._search_as_you_type)
+
+    def _cancel_search_as_you_type(self):
+        if self._search_timeout_id is not None:
+            gobject.source_remove(self._search_timeout_id)
+            self._search_timeout_id = None
+
+    def _search_as_you_type(self):
+        self._search_timeout_id = None
+        text = self.widgets.main_comboentry.child.get_text().strip()
+        view = self.get_view()
+        # commands are only run when the search button is clicked, and
+        # the results are shown in the search view only if it's already
+        # there
+        if len(text) < 2 or text.startswith(':') or \
+                not isinstance(view, SearchView):
+            return False
+        view.search_as_you_type(text)
+        return False
+
     def on_go_button_clicked(self, widget):
         '''
         '''
+        self._cancel_search_as_you_type()
         self.close_message_box()
         text = self.widgets.main_comboentry.child.get_text()
         if text == '':
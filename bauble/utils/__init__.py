@@ -772,6 +772,44 @@ def natsort_key(obj):
     return (chunks, item)
 
 
+_natsort_nibbles = 'bcdefghijklmnopq'
+_natsort_digits = 'bcdefghijk'
+
+
+def natsort_string(obj, length=255):
+    """
+    Return a string that sorts like natsort_key(obj) when compared as a
+    plain string, so that it can be stored in an indexed column and the
+    database can do the natural sorting with ORDER BY.
+
+    The string is made of digits and lower case letters only, so that it
+    sorts the same with any database collation:
+
+    - a number is '0', its length on two digits, its digits and 'a'
+    - a text is '1', two letters per byte of its UTF-8 encoding and 'a'
+
+    All the letters used for the contents come after 'a', which makes
+    each chunk sort before its own extensions.
+
+    :param length: the maximum length of the returned string
+    """
+    item = utf8(obj).encode('utf-8')
+    parts = []
+    for chunk in __natsort_rx.split(item):
+        if chunk and chunk[0] in '0123456789':
+            integer, dot, fraction = chunk.partition('.')
+            integer = integer.lstrip('0') or '0'
+            digits = '%02d' % min(len(integer), 99) + integer + \
+                fraction.rstrip('0')
+            parts.append('0' + ''.join(_natsort_digits[int(d)]
+                                       for d in digits) + 'a')
+        else:
+            parts.append('1' + ''.join(_natsort_nibbles[ord(c) >> 4] +
+                                       _natsort_nibbles[ord(c) & 15]
+                                       for c in chunk) + 'a')
+    return ''.join(parts)[:length]
+
+
 def delete_or_expunge(obj):
     """
     If the object is in object_session(obj).new then expunge it from the
@@ -790,38 +828,52 @@ def delete_or_expunge(obj):
         del obj
 
 
-def reset_sequence(column):
+def get_sequence_name(column):
+    """
+    Return the name of the PostgreSQL sequence of column, its Sequence()
+    or the sequence of an autoincrement Integer column, or None if the
+    column doesn't have one.
+    """
+    from sqlalchemy.types import Integer
+    from sqlalchemy import schema
+    if hasattr(column, 'default') and \
+            isinstance(column.default, schema.Sequence):
+        return column.default.name
+    elif (isinstance(column.type, Integer) and column.autoincrement) and \
+            (column.default is None or
+             (isinstance(column.default, schema.Sequence) and
+              column.default.optional)) and \
+            len(column.foreign_keys) == 0:
+        return '%s_%s_seq' % (column.table.name, column.name)
+    return None
+
+
+def reset_sequence(column, connection=None):
     """
     If column.sequence is not None or the column is an Integer and
     column.autoincrement is true then reset the sequence for the next
     available value for the column...if the column doesn't have a
     sequence then do nothing and return
 
-    The SQL statements are executed directly from db.engine
+    The SQL statements are executed directly from db.engine, or in a
+    savepoint of the transaction of connection if it is not None
 
     This function only works for PostgreSQL database.  It does nothing
     for other database engines.
     """
     import bauble.db as db
-    from sqlalchemy.types import Integer
-    from sqlalchemy import schema
     if not db.engine.name == 'postgresql':
         return
 
-    sequence_name = None
-    if hasattr(column, 'default') and \
-            isinstance(column.default, schema.Sequence):
-        sequence_name = column.default.name
-    elif (isinstance(column.type, Integer) and column.autoincrement) and \
-            (column.default is None or
-             (isinstance(column.default, schema.Sequence) and
-              column.default.optional)) and \
-            len(column.foreign_keys) == 0:
-        sequence_name = '%s_%s_seq' % (column.table.name, column.name)
-    else:
+    sequence_name = get_sequence_name(column)
+    if sequence_name is None:
         return
-    conn = db.engine.connect()
-    trans = conn.begin()
+    if connection is None:
+        conn = db.engine.connect()
+        trans = conn.begin()
+    else:
+        conn = connection
+        trans = conn.begin_nested()
     try:
         # the FOR UPDATE locks the table for the transaction
         stmt = "SELECT %s from %s FOR UPDATE;" % (
@@ -845,7 +897,66 @@ def reset_sequence(column):
     else:
         trans.commit()
     finally:
-        conn.close()
+        if connection is None:
+            conn.close()
+
+
+def reset_sequences(tables=None, connection=None):
+    """
+    Reset the sequences of the columns of tables for the next available
+    value of each column, like :func:`reset_sequence`, in a single
+    transaction: each table is locked against writes and its sequences
+    set from the max of their columns, computed by the database.
+
+    This function only works for PostgreSQL database.  It does nothing
+    for other database engines.
+
+    :param tables: the tables whose sequences are reset, default all the
+      tables of bauble.db.metadata
+    :param connection: if not None, the sequences are reset in a
+      savepoint of its transaction
+    :returns: the number of sequences reset
+    """
+    import bauble.db as db
+    engine = connection.engine if connection is not None else db.engine
+    if not engine.name == 'postgresql':
+        return 0
+    if tables is None:
+        tables = db.metadata.sorted_tables
+    if connection is None:
+        conn = engine.connect()
+        trans = conn.begin()
+    else:
+        conn = connection
+        trans = conn.begin_nested()
+    preparer = engine.dialect.identifier_preparer
+    count = 0
+    try:
+        for table in tables:
+            sequences = [(column, get_sequence_name(column))
+                         for column in table.c
+                         if get_sequence_name(column) is not None]
+            if not sequences:
+                continue
+            # readers are not blocked, writers wait for the transaction
+            table_name = preparer.format_table(table)
+            conn.execute('LOCK TABLE %s IN EXCLUSIVE MODE' % table_name)
+            setvals = ["setval('%s', COALESCE(max(%s), 0) + 1, false)"
+                       % (sequence_name, preparer.quote_identifier(
+                           column.name))
+                       for column, sequence_name in sequences]
+            conn.execute('SELECT %s FROM %s' % (', '.join(setvals),
+                                                table_name))
+            count += len(sequences)
+    except:
+        trans.rollback()
+        raise
+    else:
+        trans.commit()
+    finally:
+        if connection is None:
+            conn.close()
+    return count
 
 
 def make_label_clickable(label, on_clicked, *args):
@@ -913,14 +1024,45 @@ def which(filename, path=None):
 def ilike(col, val, engine=None):
     """
     Return a cross platform ilike function.
+
+    On PostgreSQL this is ILIKE, which a pg_trgm index can serve.
+    Elsewhere col is compared in lower case; a pattern that is a plain
+    ASCII prefix, like 'abc%', becomes a range on lower(col) so that a
+    functional lower() index can serve it.  See
+    :func:`bauble.search_index.create_like_indexes`.
     """
-    from sqlalchemy import func
+    from sqlalchemy import func, and_
     if not engine:
         engine = bauble.db.engine
     if engine.name == 'postgresql':
         return col.op('ILIKE')(val)
-    else:
-        return func.lower(col).like(func.lower(val))
+    prefix = _like_prefix(val)
+    if prefix:
+        prefix = prefix.lower()
+        upper = prefix[:-1] + type(prefix)(chr(ord(prefix[-1]) + 1))
+        return and_(func.lower(col) >= prefix, func.lower(col) < upper)
+    return func.lower(col).like(func.lower(val))
+
+
+def _like_prefix(pattern):
+    """
+    Return the prefix if pattern only matches the strings starting with
+    it, i.e. the pattern ends with % and has no other wildcards, else
+    return None.  Only ASCII prefixes are returned since the lower()
+    function of SQLite doesn't know about the rest.
+    """
+    if not isinstance(pattern, basestring) or not pattern.endswith('%'):
+        return None
+    prefix = pattern[:-1]
+    if not prefix or '%' in prefix or '_' in prefix:
+        return None
+    try:
+        prefix.encode('ascii')
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        return None
+    if prefix[-1] == '\x7f':
+        return None
+    return prefix
 
 
 def range_builder(text):
@@ -1061,6 +1203,70 @@ def topological_sort(items, partial_order):
     return sorted
 
 
+class LRUCache(object):
+    """
+    A bounded mapping that forgets its least recently used items.
+
+    Reading an item with get() marks it as recently used, storing an
+    item beyond `size` drops the oldest one.  A size of 0 disables the
+    cache.  Access is serialised with a lock so the cache can be shared
+    between threads.
+    """
+
+    def __init__(self, size=128):
+        from collections import OrderedDict
+        import threading
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = size
+
+    def resize(self, size):
+        """
+        Change the maximum number of items, dropping the oldest ones if
+        the cache holds more than `size` items.
+        """
+        with self._lock:
+            self.size = max(size, 0)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if self.size <= 0:
+                return
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def values(self):
+        with self._lock:
+            return self._items.values()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
 class GenericMessageBox(gtk.EventBox):
     """
     Abstract class for showing a message box at the top of an editor.
@@ -279,3 +279,25 @@ class ResetSequenceTests(BaubleTestCase):
         utils.reset_sequence(table.c.id)
         currval = self.get_currval(table.c.id)
         self.assert_(currval > rangemax, currval)
+
+    def test_reset_sequences(self):
+        """
+        Test that utils.reset_sequences sets the sequences of the tables
+        for the next available id, and of the empty tables too.
+        """
+        table = Table('test_reset_sequence', self.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('name', Unicode(10)))
+        empty = Table('test_reset_sequence_empty', self.metadata,
+                      Column('id', Integer, primary_key=True))
+        self.metadata.create_all()
+        rangemax = 10
+        for i in range(1, rangemax+1):
+            table.insert().values(id=i).execute()
+        utils.reset_sequences([table, empty])
+        table.insert().values(name=u'next').execute()
+        self.assertEquals(
+            select([table.c.id]).where(table.c.name == u'next').scalar(),
+            rangemax + 1)
+        empty.insert().values().execute()
+        self.assertEquals(select([func.max(empty.c.id)]).scalar(), 1)
@@ -23,8 +23,10 @@
 import itertools
 import os
 import sys
+import time
 import traceback
 import cgi
+import functools
 
 import logging
 logger = logging.getLogger(__name__)
@@ -37,6 +39,7 @@ import pango
 from bauble.i18n import _
 from pyparsing import ParseException
 from sqlalchemy.orm import object_session
+from sqlalchemy.orm.properties import RelationshipProperty
 import sqlalchemy.exc as saexc
 
 import bauble
@@ -45,6 +48,7 @@ from bauble.error import check, BaubleError
 from bauble import paths
 from bauble import pluginmgr
 from bauble import prefs
+from bauble import saved_search
 from bauble import search
 from bauble import utils
 from bauble import editor
@@ -357,6 +361,338 @@ class LinksExpander(InfoExpander):
             self.dynamic_box.show_all()
 
 
+class _ResultNode(object):
+    """
+    A row of a ResultsModel.  The top level rows only know their position
+    and the model looks up their key and object, the child rows hold
+    their object.
+    """
+    __slots__ = ('parent', 'position', 'value', 'children')
+
+    def __init__(self, parent, position, value=None):
+        self.parent = parent
+        self.position = position
+        self.value = value
+        self.children = None  # None until the children are set
+
+
+class MoreRows(object):
+    """
+    The value of the last child row of a row whose children are shown a
+    page at a time, activating it replaces it with the next page.
+
+    :param pages: an iterator over the remaining pages of children
+    :param page_size: the size of the pages, a shorter page is the last
+    """
+
+    def __init__(self, pages, page_size):
+        self.pages = pages
+        self.page_size = page_size
+
+
+class ResultsModel(gtk.GenericTreeModel):
+    """
+    A tree model with one object column for the search results.
+
+    The top level rows are an array of (class, id) pairs, the objects
+    are loaded in session only when a row is asked for its value, i.e.
+    when it is shown, a batch of the following rows at a time, and are
+    kept in an LRU cache.  The child rows are set with
+    :meth:`set_children` when their parent is expanded and hold their
+    objects.
+
+    :param session: the session to load the objects in
+    :param has_children: a callable telling whether an object might have
+      children, the rows of these objects can be expanded
+    :param cache_size: the number of top level objects kept loaded
+    :param load_options: a callable returning the loader options of the
+      queries loading the objects of a class, see
+      :func:`bauble.search.get_objects`
+    :param child_counts: a callable as child_counts(session, cls, ids)
+      returning a dict of id to the number of children of the object of
+      cls with that id, or None if they can't be counted.  The children
+      of each batch of loaded objects are counted with it, and only the
+      rows with children can then be expanded.  The counts are dropped
+      when any table changes, see :func:`bauble.db.table_changed`.
+    """
+
+    batch_size = 100
+
+    def __init__(self, session, has_children, cache_size=1000,
+                 load_options=None, child_counts=None):
+        gtk.GenericTreeModel.__init__(self)
+        # the nodes are kept alive by the model, not by the tree iters
+        self.props.leak_references = False
+        self.session = session
+        self._has_children = has_children
+        self._load_options = load_options
+        self._child_counts = child_counts
+        self._counts = {}  # (class, id) -> number of children
+        self._counts_snapshot = db.get_generations()
+        self._recount = False
+        self._keys = []
+        self._nodes = {}  # position -> top level _ResultNode
+        self._objects = utils.LRUCache(cache_size)
+
+    def append_keys(self, keys):
+        """
+        Append top level rows for keys, without notifying the views,
+        this is meant to fill the model before it is set on a view.
+        """
+        self._keys.extend(keys)
+
+    def append(self, obj):
+        """
+        Append a top level row for obj and return its tree iter.
+        """
+        key = (type(obj), obj.id)
+        self._keys.append(key)
+        self._objects[key] = obj
+        node = self._get_node(len(self._keys) - 1)
+        treeiter = self.create_tree_iter(node)
+        self.row_inserted((node.position, ), treeiter)
+        return treeiter
+
+    def find(self, obj):
+        """
+        Return the tree iters of the rows of obj, child rows are only
+        looked for among the expanded rows.
+        """
+        key = (type(obj), getattr(obj, 'id', None))
+        found = [self._get_node(i) for i, k in enumerate(self._keys)
+                 if k == key]
+
+        def walk(nodes):
+            for node in nodes:
+                if node.children:
+                    found.extend(c for c in node.children if c.value == obj)
+                    walk(node.children)
+        walk(self._nodes.values())
+        return [self.create_tree_iter(node) for node in found]
+
+    def remove(self, treeiter):
+        """
+        Remove the row of treeiter and its children.
+        """
+        node = self.get_user_data(treeiter)
+        path = self.on_get_path(node)
+        if node.parent is None:
+            del self._keys[node.position]
+            nodes = {}
+            for position, n in self._nodes.iteritems():
+                if n.position > node.position:
+                    n.position -= 1
+                if n is not node:
+                    nodes[n.position] = n
+            self._nodes = nodes
+            self.row_deleted(path)
+        else:
+            siblings = node.parent.children
+            del siblings[node.position]
+            for n in siblings[node.position:]:
+                n.position -= 1
+            self.row_deleted(path)
+            if not siblings:
+                parent_iter = self.create_tree_iter(node.parent)
+                self.row_has_child_toggled(path[:-1], parent_iter)
+
+    def set_children(self, treeiter, objects, more=None):
+        """
+        Replace the children of the row of treeiter with rows for objects.
+
+        :param more: a :class:`MoreRows` for the pages of children not
+          in objects yet, it's shown as the last child row.
+        """
+        node = self.get_user_data(treeiter)
+        path = self.on_get_path(node)
+        while node.children:
+            child = node.children.pop()
+            self.row_deleted(path + (child.position, ))
+        node.children = []
+        self._append_children(node, objects, more)
+        self.row_has_child_toggled(path, treeiter)
+
+    def load_more(self, treeiter):
+        """
+        Replace the :class:`MoreRows` row of treeiter with the rows of
+        the next page of children, followed by a new MoreRows row if the
+        page is full.
+        """
+        node = self.get_user_data(treeiter)
+        more = node.value
+        parent = node.parent
+        objects = next(more.pages, [])
+        del parent.children[node.position]
+        self.row_deleted(self.on_get_path(node))
+        if len(objects) < more.page_size:
+            more = None
+        self._append_children(parent, objects, more)
+
+    def _append_children(self, node, objects, more=None):
+        self._count_children(objects)
+        path = self.on_get_path(node)
+        values = list(objects)
+        if more is not None:
+            values.append(more)
+        for value in values:
+            child = _ResultNode(node, len(node.children), value)
+            node.children.append(child)
+            self.row_inserted(path + (child.position, ),
+                              self.create_tree_iter(child))
+
+    def get_child_count(self, obj):
+        """
+        Return the number of children of obj, or None if they weren't
+        counted.
+        """
+        self._check_counts()
+        if self._recount:
+            # the objects already loaded are counted again together
+            self._recount = False
+            self._count_children(self.get_loaded_objects())
+        return self._counts.get((type(obj), getattr(obj, 'id', None)))
+
+    def clear_counts(self):
+        """
+        Forget the numbers of children counted so far, the loaded
+        objects are counted again when a count is next asked for.
+        """
+        self._counts = {}
+        self._counts_snapshot = db.get_generations()
+        self._recount = True
+
+    def _check_counts(self):
+        if not db.unchanged_since(self._counts_snapshot):
+            self.clear_counts()
+
+    def _count_children(self, objects):
+        if self._child_counts is None:
+            return
+        self._check_counts()
+        ids_by_class = {}
+        for obj in objects:
+            if (type(obj), obj.id) not in self._counts:
+                ids_by_class.setdefault(type(obj), []).append(obj.id)
+        for cls, ids in ids_by_class.iteritems():
+            counts = self._child_counts(self.session, cls, ids)
+            if counts is None:
+                continue
+            for obj_id in ids:
+                self._counts[(cls, obj_id)] = counts.get(obj_id, 0)
+
+    def get_loaded_objects(self):
+        """
+        Return the objects loaded by the model.
+        """
+        objects = list(self._objects.values())
+
+        def walk(nodes):
+            for node in nodes:
+                if node.children:
+                    objects.extend(c.value for c in node.children
+                                   if not isinstance(c.value, MoreRows))
+                    walk(node.children)
+        walk(self._nodes.values())
+        return objects
+
+    def _get_node(self, position):
+        node = self._nodes.get(position)
+        if node is None:
+            node = self._nodes[position] = _ResultNode(None, position)
+        return node
+
+    def _get_object(self, node):
+        if node.parent is not None:
+            return node.value
+        key = self._keys[node.position]
+        obj = self._objects.get(key)
+        if obj is None:
+            # load a batch of the following rows at once, they are
+            # likely to be shown next
+            batch = [k for k in self._keys[node.position:
+                                           node.position + self.batch_size]
+                     if k not in self._objects]
+            loaded = search.get_objects(batch, self.session,
+                                        load_options=self._load_options)
+            for obj in loaded:
+                self._objects[(type(obj), obj.id)] = obj
+            self._count_children(loaded)
+            obj = self._objects.get(key)
+        return obj
+
+    def on_get_flags(self):
+        return 0
+
+    def on_get_n_columns(self):
+        return 1
+
+    def on_get_column_type(self, index):
+        return gobject.TYPE_PYOBJECT
+
+    def on_get_iter(self, path):
+        if path[0] >= len(self._keys):
+            return None
+        node = self._get_node(path[0])
+        for index in path[1:]:
+            if not node.children or index >= len(node.children):
+                return None
+            node = node.children[index]
+        return node
+
+    def on_get_path(self, node):
+        path = []
+        while node is not None:
+            path.insert(0, node.position)
+            node = node.parent
+        return tuple(path)
+
+    def on_get_value(self, node, column):
+        return self._get_object(node)
+
+    def on_iter_next(self, node):
+        if node.parent is None:
+            if node.position + 1 < len(self._keys):
+                return self._get_node(node.position + 1)
+            return None
+        siblings = node.parent.children
+        if node.position + 1 < len(siblings):
+            return siblings[node.position + 1]
+        return None
+
+    def on_iter_children(self, node):
+        if node is None:
+            return self.on_iter_nth_child(None, 0)
+        return self.on_iter_nth_child(node, 0)
+
+    def on_iter_has_child(self, node):
+        if node.children is not None:
+            return len(node.children) > 0
+        obj = self._get_object(node)
+        if obj is None:
+            return False
+        count = self.get_child_count(obj)
+        if count is not None:
+            return count > 0
+        return self._has_children(obj)
+
+    def on_iter_n_children(self, node):
+        if node is None:
+            return len(self._keys)
+        return len(node.children or [])
+
+    def on_iter_nth_child(self, node, n):
+        if node is None:
+            if 0 <= n < len(self._keys):
+                return self._get_node(n)
+            return None
+        if node.children and 0 <= n < len(node.children):
+            return node.children[n]
+        return None
+
+    def on_iter_parent(self, node):
+        return node.parent
+
+
 class SearchView(pluginmgr.View):
     """
     The SearchView is the main view for Bauble.  It manages the search
@@ -374,11 +710,13 @@ class SearchView(pluginmgr.View):
             def __init__(self):
                 self.children = None
                 self.infobox = None
+                self.children_relation = None
                 self.markup_func = None
                 self.actions = []
+                self.load_options = []
 
             def set(self, children=None, infobox=None, context_menu=None,
-                    markup_func=None):
+                    markup_func=None, load_options=None):
                 '''
                 :param children: where to find the children for this type,
                     can be a callable of the form C{children(row)}
@@ -393,11 +731,18 @@ class SearchView(pluginmgr.View):
                 the instances __str__() function is called...the
                 strings returned by this function should escape any
                 non markup characters
+
+                :param load_options: a list of loader options, like
+                subqueryload('vernacular_names'), for the related objects
+                used by markup_func, they are added to the ones passed to
+                MapperSearch.add_meta() when the rows are loaded
                 '''
                 self.children = children
+                self.children_relation = self._get_relation_name(children)
                 self.infobox = infobox
                 self.markup_func = markup_func
                 self.context_menu = context_menu
+                self.load_options = list(load_options or [])
                 self.actions = []
                 if self.context_menu:
                     self.actions = filter(lambda x: isinstance(x, Action),
@@ -416,6 +761,52 @@ class SearchView(pluginmgr.View):
                     return self.children(obj)
                 return getattr(obj, self.children)
 
+            @staticmethod
+            def _get_relation_name(children):
+                """
+                Return the name of the relation of the children, when
+                children is the name of a relation or the natsort of one.
+                """
+                if isinstance(children, basestring):
+                    return children
+                if isinstance(children, functools.partial) and \
+                        children.func is db.natsort and \
+                        '.' not in children.args[0]:
+                    return children.args[0]
+                return None
+
+            def get_children_pages(self, obj, page_size):
+                """
+                Return an iterator over lists of at most page_size
+                children of obj, fetched with ordered and limited
+                queries, see :func:`bauble.search.keyset_pages`, or None
+                if the children aren't a relation of obj.
+                """
+                if self.children_relation is None:
+                    return None
+                prop = getattr(getattr(type(obj), self.children_relation,
+                                       None), 'property', None)
+                session = object_session(obj)
+                if not isinstance(prop, RelationshipProperty) or \
+                        not prop.uselist or session is None:
+                    return None
+                cls = prop.mapper.class_
+                query = session.query(cls).\
+                    with_parent(obj, self.children_relation).\
+                    options(*get_load_options(cls))
+                return search.keyset_pages(query, cls, page_size)
+
+            def get_child_counts(self, session, cls, ids):
+                """
+                Return a dict of id to the number of children of the
+                objects of cls with ids, or None if the children can't
+                be counted with a query, see :func:`bauble.db.count_related`
+                """
+                if self.children_relation is None:
+                    return None
+                return db.count_related(session, cls, self.children_relation,
+                                        ids)
+
         def __getitem__(self, item):
             if item not in self:  # create on demand
                 self[item] = self.Meta()
@@ -455,6 +846,10 @@ class SearchView(pluginmgr.View):
         self.session = db.Session()
         self.add_notes_page_to_bottom_notebook()
 
+        # runs the searches typed in the main entry, see search_as_you_type
+        self.background_search = search.BackgroundSearch(
+            self.on_background_results)
+
     def add_notes_page_to_bottom_notebook(self):
         '''add notebook page for notes
 
@@ -614,7 +1009,8 @@ class SearchView(pluginmgr.View):
         model, rows = self.results_view.get_selection().get_selected_rows()
         if model is None:
             return None
-        return [model[row][0] for row in rows]
+        return [model[row][0] for row in rows
+                if not isinstance(model[row][0], MoreRows)]
 
     def on_cursor_changed(self, view):
         '''
@@ -670,6 +1066,10 @@ class SearchView(pluginmgr.View):
 
     nresults_statusbar_context = 'searchview.nresults'
 
+    # the number of children shown when a row is expanded, the others
+    # are loaded a page at a time through a "load more" row
+    children_page_size = 100
+
     def search(self, text):
         """
         search the database using text
@@ -678,16 +1078,16 @@ class SearchView(pluginmgr.View):
         # has the same text in it, this is in case this method was called from
         # outside the class so the entry and search results match
         logger.debug('SearchView.search(%s)' % text)
+        self.background_search.cancel()
         error_msg = None
         error_details_msg = None
         self.session.close()
         # create a new session for each search...maybe we shouldn't
         # even have session as a class attribute
         self.session = db.Session()
-        bold = '<b>%s</b>'
         results = []
         try:
-            results = search.search(text, self.session)
+            results = search.search_pages(text, self.session)
         except ParseException, err:
             error_msg = _('Error in search string at column %s') % err.column
         except (BaubleError, AttributeError, Exception, SyntaxError), e:
@@ -700,33 +1100,28 @@ class SearchView(pluginmgr.View):
             return
 
         # not error
-        utils.clear_model(self.results_view)
+        self.clear_results()
         self.update_infobox()
         statusbar = bauble.gui.widgets.statusbar
         sbcontext_id = statusbar.get_context_id('searchview.nresults')
         statusbar.pop(sbcontext_id)
-        if len(results) == 0:
-            model = gtk.ListStore(str)
-            msg = bold % cgi.escape(
-                _('Couldn\'t find anything for search: "%s"') % text)
-            model.append([msg])
-            self.results_view.set_model(model)
+        if results.count == 0:
+            self.set_nothing_found(text)
         else:
-            if len(results) > 5000:
+            if results.count > 5000:
                 msg = _('This query returned %s results.  It may take a '
                         'long time to get all the data. Are you sure you '
-                        'want to continue?') % len(results)
+                        'want to continue?') % results.count
                 if not utils.yes_no_dialog(msg):
                     return
             statusbar.push(sbcontext_id, _("Retrieving %s search "
-                                           "results...") % len(results))
+                                           "results...") % results.count)
             try:
                 # don't bother with a task if the results are small,
                 # this keeps the screen from flickering when the main
                 # window is set to a busy state
-                import time
                 start = time.time()
-                if len(results) > 1000:
+                if results.count > 1000:
                     self.populate_results(results)
                 else:
                     task = self._populate_worker(results)
@@ -741,21 +1136,79 @@ class SearchView(pluginmgr.View):
             else:
                 statusbar.pop(sbcontext_id)
                 statusbar.push(sbcontext_id,
-                               _("%s search results") % len(results))
+                               _("%s search results") % results.count)
                 self.results_view.set_cursor(0)
                 gobject.idle_add(lambda: self.results_view.scroll_to_cell(0))
 
         self.update_bottom_notebook()
 
-    def remove_children(self, model, parent):
+    def search_as_you_type(self, text):
+        """
+        Search the database using text without blocking the main loop.
+
+        The query runs on a worker thread in its own session and
+        cancels the query of the previous call if it's still running,
+        the results replace the current ones when they are ready.
+        Errors are only logged since text is usually incomplete while
+        it's being typed.
+        """
+        if not db.can_use_threads():
+            # the worker thread wouldn't see the same database
+            self.search(text)
+            return
+        self.background_search.start(text)
+
+    def on_background_results(self, text, keys, error, details):
+        if error is not None:
+            logger.debug('search as you type of %s failed: %s'
+                         % (text, utils.utf8(error)))
+            logger.debug(details)
+            return
+        self.session.close()
+        self.session = db.Session()
+        self.show_keys(text, keys)
+
+    def show_keys(self, text, keys):
+        """
+        Replace the results with the objects identified by keys, a list
+        of (class, id) pairs found searching text.
+        """
+        self.clear_results()
+        self.update_infobox()
+        statusbar = bauble.gui.widgets.statusbar
+        sbcontext_id = statusbar.get_context_id('searchview.nresults')
+        statusbar.pop(sbcontext_id)
+        if not keys:
+            self.set_nothing_found(text)
+        else:
+            model = ResultsModel(self.session, self._get_has_children(),
+                                 load_options=get_load_options,
+                                 child_counts=get_child_counts)
+            model.append_keys(keys)
+            self.results_view.set_model(model)
+            statusbar.push(sbcontext_id, _("%s search results") % len(keys))
+        self.update_bottom_notebook()
+
+    def set_nothing_found(self, text):
         """
-        Remove all children of some parent in the model, reverse
-        iterate through them so you don't invalidate the iter
+        Show in the results view that searching text found nothing.
         """
-        while model.iter_has_child(parent):
-            nkids = model.iter_n_children(parent)
-            child = model.iter_nth_child(parent, nkids-1)
-            model.remove(child)
+        model = gtk.ListStore(str)
+        msg = '<b>%s</b>' % cgi.escape(
+            _('Couldn\'t find anything for search: "%s"') % text)
+        model.append([msg])
+        self.results_view.set_model(model)
+
+    def clear_results(self):
+        """
+        Remove the model from the results view.
+        """
+        model = self.results_view.get_model()
+        if isinstance(model, ResultsModel):
+            # don't walk the model, it would load all the objects
+            self.results_view.set_model(None)
+        else:
+            utils.clear_model(self.results_view)
 
     def on_test_expand_row(self, view, treeiter, path, data=None):
         '''
@@ -765,15 +1218,22 @@ class SearchView(pluginmgr.View):
         model = view.get_model()
         row = model.get_value(treeiter, 0)
         view.collapse_row(path)
-        self.remove_children(model, treeiter)
+        more = None
         try:
-            kids = self.row_meta[type(row)].get_children(row)
+            meta = self.row_meta[type(row)]
+            pages = meta.get_children_pages(row, self.children_page_size)
+            if pages is None:
+                kids = meta.get_children(row)
+            else:
+                kids = next(pages, [])
+                if len(kids) == self.children_page_size:
+                    more = MoreRows(pages, self.children_page_size)
             if len(kids) == 0:
+                model.set_children(treeiter, [])
                 return True
         except saexc.InvalidRequestError, e:
             logger.debug(utils.utf8(e))
-            model = self.results_view.get_model()
-            for found in utils.search_tree_model(model, row):
+            for found in model.find(row):
                 model.remove(found)
             return True
         except Exception, e:
@@ -781,7 +1241,7 @@ class SearchView(pluginmgr.View):
             logger.debug(traceback.format_exc())
             return True
         else:
-            self.append_children(model, treeiter, kids)
+            model.set_children(treeiter, kids, more)
             return False
 
     def populate_results(self, results, check_for_kids=False):
@@ -797,88 +1257,96 @@ class SearchView(pluginmgr.View):
         """
         Generator function for adding the search results to the
         model. This method is usually called by self.populate_results()
+
+        Only the (class, id) pairs of the results are kept in the model,
+        see :class:`ResultsModel`.
+
+        :param results: a :class:`bauble.search.PagedResults` or a list,
+          the pages of keys of PagedResults are added as they are found,
+          the model only loads the objects of the rows shown.
         """
-        nresults = len(results)
-        model = gtk.TreeStore(object)
-        model.set_default_sort_func(lambda *args: -1)
-        model.set_sort_column_id(-1, gtk.SORT_ASCENDING)
-        utils.clear_model(self.results_view)
+        model = ResultsModel(self.session,
+                             self._get_has_children(check_for_kids),
+                             load_options=get_load_options,
+                             child_counts=get_child_counts)
+        self.clear_results()
+
+        if isinstance(results, search.PagedResults):
+            nresults = results.count
+            pages = results.keys()
+        else:
+            nresults = len(results)
+            results = self._sort_results(results)
+            pages = (search.get_keys(results[i:i + 200])
+                     for i in range(0, nresults, 200))
 
-        groups = []
+        added = set()
+        for page in pages:
+            keys = []
+            for key in page:
+                if key not in added:  # only add unique object
+                    added.add(key)
+                    keys.append(key)
+            model.append_keys(keys)
+            percent = float(len(added))/float(max(nresults, 1))
+            if 0 < percent < 1.0:
+                bauble.gui.progressbar.set_fraction(percent)
+            yield
+        self.results_view.freeze_child_notify()
+        self.results_view.set_model(model)
+        self.results_view.thaw_child_notify()
 
+    def _get_has_children(self, check_for_kids=False):
+        if check_for_kids:
+            return lambda obj: \
+                len(self.row_meta[type(obj)].get_children(obj)) > 0
+        return lambda obj: self.row_meta[type(obj)].children is not None
+
+    @staticmethod
+    def _sort_results(results):
+        """
+        Return results grouped by type, each group natural sorted by the
+        string of the objects, see :func:`bauble.db.sort_key`.
+        """
         # sort by type so that groupby works properly
         results = sorted(results, key=lambda x: type(x))
 
+        groups = []
         for key, group in itertools.groupby(results, key=lambda x: type(x)):
             # return groups by type and natural sort each of the
             # groups by their strings
-            groups.append(sorted(group, key=utils.natsort_key, reverse=True))
+            groups.append(sorted(group, key=db.sort_key))
 
         # sort the groups by type so we more or less always get the
         # results by type in the same order
-        groups = sorted(groups, key=lambda x: type(x[0]), reverse=True)
-
-        update_every = 200
-        steps_so_far = 0
-
-        # iterate over slice of size "steps", yield after adding each
-        # slice to the model
-        #for obj in itertools.islice(itertools.chain(*groups), 0,None, steps):
-        #for obj in itertools.islice(itertools.chain(results), 0,None, steps):
-
-        added = set()
-        for obj in itertools.chain(*groups):
-            if obj in added:  # only add unique object
-                continue
-            else:
-                added.add(obj)
-            parent = model.prepend(None, [obj])
-            obj_type = type(obj)
-            if check_for_kids:
-                kids = self.row_meta[obj_type].get_children(obj)
-                if len(kids) > 0:
-                    model.prepend(parent, ['-'])
-            elif self.row_meta[obj_type].children is not None:
-                model.prepend(parent, ['-'])
-            #steps_so_far += chunk_size
-            steps_so_far += 1
-            if steps_so_far % update_every == 0:
-                percent = float(steps_so_far)/float(nresults)
-                if 0 < percent < 1.0:
-                    bauble.gui.progressbar.set_fraction(percent)
-                yield
-        self.results_view.freeze_child_notify()
-        self.results_view.set_model(model)
-        self.results_view.thaw_child_notify()
-
-    def append_children(self, model, parent, kids):
-        """
-        append object to a parent iter in the model
-
-        :param model: the model the append to
-        :param parent:  the parent gtk.TreeIter
-        :param kids: a list of kids to append
-        @return: the model with the kids appended
-        """
-        check(parent is not None, "append_children(): need a parent")
-        for k in kids:
-            i = model.append(parent, [k])
-            if self.row_meta[type(k)].children is not None:
-                model.append(i, ["_dummy"])
-        return model
+        groups = sorted(groups, key=lambda x: type(x[0]))
+        return list(itertools.chain(*groups))
 
     def cell_data_func(self, col, cell, model, treeiter):
-        path = model.get_path(treeiter)
-        tree_rect = self.results_view.get_visible_rect()
-        cell_rect = self.results_view.get_cell_area(path, col)
-        if cell_rect.y > tree_rect.height:
-            # only update the cells if they're visible...this
-            # drastically speeds up populating the view with large
-            # datasets
-            return
+        # the ResultsModel only loads the objects of the rows that are
+        # shown, so there's no need to check for visibility here
         value = model[treeiter][0]
-        if isinstance(value, basestring):
+        if value is None:
+            # the object was deleted since the search
+            cell.set_property('markup', '')
+            ref = gtk.TreeRowReference(model, model.get_path(treeiter))
+
+            def remove_deleted():
+                if ref.valid():
+                    model.remove(model.get_iter(ref.get_path()))
+            gobject.idle_add(remove_deleted)
+        elif isinstance(value, basestring):
             cell.set_property('markup', value)
+        elif isinstance(value, MoreRows):
+            parent_iter = model.iter_parent(treeiter)
+            shown = model.iter_n_children(parent_iter) - 1
+            total = model.get_child_count(model[parent_iter][0])
+            if total:
+                msg = _('load more... (%(shown)s of %(total)s shown)') % \
+                    {'shown': shown, 'total': total}
+            else:
+                msg = _('load more...')
+            cell.set_property('markup', '<i>%s</i>' % utils.xml_safe(msg))
         else:
             # if the value isn't part of a session then add it to the
             # view's session so that we can access its child
@@ -904,6 +1372,13 @@ class SearchView(pluginmgr.View):
                 else:
                     main = utils.xml_safe(str(value))
                     substr = '(%s)' % type(value).__name__
+                count = None
+                if isinstance(model, ResultsModel):
+                    count = model.get_child_count(value)
+                if count:
+                    substr = '%s - %s %s' % (
+                        utils.utf8(substr), count,
+                        _(self.row_meta[type(value)].children_relation))
                 cell.set_property(
                     'markup', '%s\n%s' %
                     (_mainstr_tmpl % utils.utf8(main),
@@ -915,10 +1390,8 @@ class SearchView(pluginmgr.View):
 
                 def remove():
                     model = self.results_view.get_model()
-                    self.results_view.set_model(None)  # detach model
-                    for found in utils.search_tree_model(model, value):
+                    for found in model.find(value):
                         model.remove(found)
-                    self.results_view.set_model(model)
                 gobject.idle_add(remove)
 
     def get_expanded_rows(self):
@@ -1036,11 +1509,11 @@ class SearchView(pluginmgr.View):
         # and Accession right now....it's a bit of a hack since there's
         # no real interface that the method complies to...but it does
         # fix our string caching issues
-        def invalidate_cache(model, path, treeiter, data=None):
-            obj = model[path][0]
-            if hasattr(obj, 'invalidate_str_cache'):
-                obj.invalidate_str_cache()
-        model.foreach(invalidate_cache)
+        if isinstance(model, ResultsModel):
+            model.clear_counts()
+            for obj in model.get_loaded_objects():
+                if hasattr(obj, 'invalidate_str_cache'):
+                    obj.invalidate_str_cache()
         expanded_rows = self.get_expanded_rows()
         self.results_view.collapse_all()
         # expand_to_all_refs will invalidate the ref so get the path first
@@ -1058,6 +1531,10 @@ class SearchView(pluginmgr.View):
         '''
         logger.debug("SearchView::on_view_row_activated %s %s %s %s"
                      % (view, path, column, data))
+        model = view.get_model()
+        if isinstance(model[path][0], MoreRows):
+            model.load_more(model.get_iter(path))
+            return
         view.expand_row(path, False)
 
     def create_gui(self):
@@ -1239,6 +1716,136 @@ class HistoryCommandHandler(pluginmgr.CommandHandler):
 pluginmgr.register_command(HistoryCommandHandler)
 
 
+def get_load_options(cls):
+    """
+    Return the loader options of the objects of cls shown in the search
+    view, the ones set in SearchView.row_meta and the ones passed to
+    MapperSearch.add_meta()
+    """
+    return search.get_load_options(cls) + \
+        SearchView.row_meta[cls].load_options
+
+
+def get_child_counts(session, cls, ids):
+    """
+    Return a dict of id to the number of children shown in the search
+    view of the objects of cls with ids, or None if they can't be
+    counted, see :meth:`SearchView.ViewMeta.Meta.get_child_counts`
+    """
+    return SearchView.row_meta[cls].get_child_counts(session, cls, ids)
+
+
+class ExplainCommandHandler(pluginmgr.CommandHandler):
+    """
+    :explain=<search string> runs the search and shows how it's done,
+    see :func:`bauble.search.explain`, adding the time it takes to
+    populate the search view with the first rows of the results.
+    """
+
+    command = ['explain', 'profile']
+
+    # about the number of rows visible in the search view
+    shown_rows = 100
+
+    def __call__(self, cmd, arg):
+        if not arg or not arg.strip():
+            utils.message_dialog(_('Usage: :explain=<search string>'))
+            return
+        session = db.Session()
+        try:
+            explanation = search.explain(arg.strip(), session)
+            start = time.time()
+            row_meta = SearchView.row_meta
+            model = ResultsModel(
+                session, lambda o: row_meta[type(o)].children is not None,
+                load_options=get_load_options,
+                child_counts=get_child_counts)
+            model.append_keys(explanation.keys)
+            for i in range(min(len(explanation.keys), self.shown_rows)):
+                obj = model[(i, )][0]
+                if obj is not None and row_meta[type(obj)].markup_func:
+                    row_meta[type(obj)].markup_func(obj)
+            explanation.add_timing('view population', time.time() - start)
+        finally:
+            session.close()
+        total = sum(seconds for phase, seconds in explanation.timings)
+        msg = _('%(count)s results in %(time).1f ms') % \
+            {'count': len(explanation.keys), 'time': total * 1000}
+        utils.message_details_dialog(utils.xml_safe(msg),
+                                     unicode(explanation))
+
+
+pluginmgr.register_command(ExplainCommandHandler)
+
+
+class SavedSearchCommandHandler(pluginmgr.CommandHandler):
+    """
+    :saved lists the saved searches, :saved=<name> shows the results of
+    a saved search, :saved=<name>=<search string> saves a search and
+    :saved=<name>= removes it, see :mod:`bauble.saved_search`
+    """
+
+    command = 'saved'
+
+    def __init__(self):
+        super(SavedSearchCommandHandler, self).__init__()
+        self.view = None
+
+    def get_view(self):
+        if self.view is None:
+            self.view = SearchView()
+        return self.view
+
+    def __call__(self, cmd, arg):
+        session = db.Session()
+        try:
+            if not arg or not arg.strip():
+                names = saved_search.get_names(session)
+                if not names:
+                    utils.message_dialog(_('There are no saved searches.'))
+                else:
+                    utils.message_details_dialog(
+                        _('%s saved searches') % len(names),
+                        u'\n'.join(names))
+                return
+            name, sep, text = arg.partition('=')
+            name = name.strip()
+            if sep and not text.strip():
+                saved_search.remove(session, name)
+                utils.message_dialog(_('The saved search %s was removed.')
+                                     % utils.xml_safe(name))
+                return
+            if sep:
+                saved_search.save(session, name, text.strip())
+            keys = saved_search.get_keys(session, name)
+        finally:
+            session.close()
+        view = self.show_search_view()
+        view.session.close()
+        view.session = db.Session()
+        view.show_keys(name, keys)
+
+    def show_search_view(self):
+        """
+        Return the search view shown in the main window, switching to
+        the one of this handler if another kind of view is shown, like
+        :func:`bauble.command_handler` does for the other commands.
+        """
+        old_view = bauble.gui.get_view()
+        if isinstance(old_view, SearchView):
+            return old_view
+        view = self.get_view()
+        if hasattr(old_view, 'accel_group'):
+            bauble.gui.window.remove_accel_group(old_view.accel_group)
+        bauble.gui.set_view(view)
+        if hasattr(view, 'accel_group'):
+            bauble.gui.window.add_accel_group(view.accel_group)
+        return view
+
+
+pluginmgr.register_command(SavedSearchCommandHandler)
+
+
 def select_in_search_results(obj):
     """
     :param obj: the object the select
@@ -1254,13 +1861,20 @@ def select_in_search_results(obj):
     if not isinstance(view, SearchView):
         return None
     model = view.results_view.get_model()
-    found = utils.search_tree_model(model, obj)
+    if not isinstance(model, ResultsModel):
+        model = ResultsModel(
+            view.session,
+            lambda o: view.row_meta[type(o)].children is not None,
+            load_options=get_load_options,
+            child_counts=get_child_counts)
+        view.clear_results()
+        view.results_view.set_model(model)
+    found = model.find(obj)
     row_iter = None
     if len(found) > 0:
         row_iter = found[0]
     else:
-        row_iter = model.append(None, [obj])
-        model.append(row_iter, ['-'])
+        row_iter = model.append(obj)
     view.results_view.set_cursor(model.get_path(row_iter))
     return row_iter
 